@@ -1,4 +1,12 @@
-from nodeconductor.core import utils, tasks
+import json
+
+from celery import current_app
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django_fsm import can_proceed
+
+from nodeconductor.core import metrics, utils, tasks
 
 
 class BaseExecutor(object):
@@ -39,24 +47,149 @@ class BaseExecutor(object):
     @classmethod
     def execute(cls, instance, async=True, countdown=2, is_heavy_task=False, **kwargs):
         """ Execute high level-operation """
-        cls.pre_apply(instance, async=async, **kwargs)
-        result = cls.apply_signature(instance, async=async, countdown=countdown,
-                                     is_heavy_task=is_heavy_task, **kwargs)
-        cls.post_apply(instance, async=async, **kwargs)
+        recorder = metrics.TimingRecorder(cls.__name__, model=instance.__class__.__name__)
+        with recorder.step('pre_apply'):
+            cls.pre_apply(instance, async=async, **kwargs)
+        with recorder.step('apply_signature', async=async):
+            result = cls.apply_signature(instance, async=async, countdown=countdown,
+                                         is_heavy_task=is_heavy_task, **kwargs)
+        with recorder.step('post_apply'):
+            cls.post_apply(instance, async=async, **kwargs)
         return result
 
+    @classmethod
+    def execute_many(cls, instances, async=True, countdown=2, is_heavy_task=False, **kwargs):
+        """ Execute high-level operation for several instances.
+
+            Synchronous actions before signature apply are performed via
+            "pre_apply_many", signatures are published using one broker connection.
+            Returns list of tuples (instance, result). If operation could not be
+            started or failed synchronously, result is the raised exception.
+        """
+        instances = list(instances)
+        recorder = metrics.TimingRecorder(cls.__name__, count=len(instances))
+        results = []
+        accepted = []
+        with recorder.step('pre_apply_many'):
+            pre_apply_results = cls.pre_apply_many(instances, async=async, **kwargs)
+        for instance, error in pre_apply_results:
+            if error is not None:
+                results.append((instance, error))
+            else:
+                accepted.append(instance)
+
+        options = dict(countdown=countdown, is_heavy_task=is_heavy_task)
+        with recorder.step('apply_many', async=async):
+            if async:
+                with current_app.producer_or_acquire() as producer:
+                    results.extend(cls._apply_many(accepted, async=True, producer=producer, options=options, **kwargs))
+            else:
+                results.extend(cls._apply_many(accepted, async=False, options=options, **kwargs))
+
+        order = {id(instance): index for index, instance in enumerate(instances)}
+        return sorted(results, key=lambda item: order[id(item[0])])
+
+    @classmethod
+    def _apply_many(cls, instances, async, options, producer=None, **kwargs):
+        results = []
+        for instance in instances:
+            try:
+                result = cls.apply_signature(instance, async=async, producer=producer, **dict(options, **kwargs))
+            except Exception as e:
+                results.append((instance, e))
+            else:
+                cls.post_apply(instance, async=async, **kwargs)
+                results.append((instance, result))
+        return results
+
     @classmethod
     def pre_apply(cls, instance, **kwargs):
         """ Perform synchronous actions before signature apply """
         pass
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        """ Perform synchronous actions before signature apply for several instances.
+
+            Returns list of tuples (instance, error), error is None if instance
+            is ready for signature apply. By default "pre_apply" is called for each instance,
+            override this method if "pre_apply" could be performed in bulk.
+        """
+        results = []
+        for instance in instances:
+            try:
+                cls.pre_apply(instance, **kwargs)
+            except Exception as e:
+                results.append((instance, e))
+            else:
+                results.append((instance, None))
+        return results
+
+    @classmethod
+    def bulk_state_transition(cls, instances, transition_method, get_fields=None):
+        """ Apply FSM transition to instances and store new state with one UPDATE per model and state.
+
+            Rows of instances are locked first and transition is applied in memory only
+            to instances whose rows still have the same state, so FSM signals are sent
+            only for instances that are updated. Instances that were changed concurrently
+            are reported with StateChangeError.
+            get_fields - function that returns dictionary of extra fields to update for instance.
+        """
+        errors = {}
+        candidates = []
+        for instance in instances:
+            if not can_proceed(getattr(instance, transition_method)):
+                message = 'Could not change state of %s instance `%s` (PK: %s), using method `%s`. ' \
+                          'Current instance state: %s.' % (instance.__class__.__name__, instance, instance.pk,
+                                                           transition_method, instance.human_readable_state)
+                errors[instance] = tasks.StateChangeError(message)
+            else:
+                candidates.append(instance)
+
+        with transaction.atomic():
+            pks = {}
+            for instance in candidates:
+                pks.setdefault(instance.__class__, []).append(instance.pk)
+            locked_states = {}
+            for model, model_pks in pks.items():
+                rows = model._default_manager.select_for_update().filter(pk__in=model_pks).values_list('pk', 'state')
+                locked_states.update({(model, pk): state for pk, state in rows})
+
+            groups = {}
+            for instance in candidates:
+                if locked_states.get((instance.__class__, instance.pk)) != instance.state:
+                    message = 'Could not change state of %s instance `%s` (PK: %s), using method `%s` ' \
+                              'due to concurrent update' % (instance.__class__.__name__, instance, instance.pk,
+                                                            transition_method)
+                    errors[instance] = tasks.StateChangeError(message)
+                    continue
+
+                getattr(instance, transition_method)()
+                fields = get_fields(instance) if get_fields else {}
+                for name, value in fields.items():
+                    setattr(instance, name, value)
+                key = (instance.__class__, instance.state, json.dumps(fields, sort_keys=True, default=force_text))
+                groups.setdefault(key, (fields, []))[1].append(instance)
+
+            now = timezone.now()
+            for (model, target, _), (fields, group) in groups.items():
+                fields = dict(fields, state=target)
+                # queryset update does not touch auto_now fields
+                if 'modified' in [field.name for field in model._meta.get_fields()]:
+                    fields['modified'] = now
+                    for instance in group:
+                        instance.modified = now
+                model._default_manager.filter(pk__in=[instance.pk for instance in group]).update(**fields)
+
+        return [(instance, errors.get(instance)) for instance in instances]
+
     @classmethod
     def post_apply(cls, instance, **kwargs):
         """ Perform synchronous actions after signature apply """
         pass
 
     @classmethod
-    def apply_signature(cls, instance, async=True, countdown=None, is_heavy_task=False, **kwargs):
+    def apply_signature(cls, instance, async=True, countdown=None, is_heavy_task=False, producer=None, **kwargs):
         """ Serialize input data and apply signature """
         serialized_instance = utils.serialize_instance(instance)
 
@@ -65,8 +198,9 @@ class BaseExecutor(object):
         link_error = cls.get_failure_signature(instance, serialized_instance, **kwargs)
 
         if async:
+            options = {'producer': producer} if producer is not None else {}
             return signature.apply_async(link=link, link_error=link_error, countdown=countdown,
-                                         queue=is_heavy_task and 'heavy' or None)
+                                         queue=is_heavy_task and 'heavy' or None, **options)
         else:
             result = signature.apply()
             callback = link if not result.failed() else link_error
@@ -148,12 +282,22 @@ class UpdateExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
         instance.schedule_updating()
         instance.save(update_fields=['state'])
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        return cls.bulk_state_transition(instances, 'schedule_updating')
+
     @classmethod
     def execute(cls, instance, async=True, **kwargs):
         if 'updated_fields' not in kwargs:
             raise ExecutorException('updated_fields keyword argument should be defined for UpdateExecutor.')
         super(UpdateExecutor, cls).execute(instance, async=async, **kwargs)
 
+    @classmethod
+    def execute_many(cls, instances, async=True, **kwargs):
+        if 'updated_fields' not in kwargs:
+            raise ExecutorException('updated_fields keyword argument should be defined for UpdateExecutor.')
+        return super(UpdateExecutor, cls).execute_many(instances, async=async, **kwargs)
+
 
 class DeleteExecutor(DeleteExecutorMixin, BaseExecutor):
     """ Default states transition for object deletion.
@@ -168,6 +312,10 @@ class DeleteExecutor(DeleteExecutorMixin, BaseExecutor):
         instance.schedule_deleting()
         instance.save(update_fields=['state'])
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        return cls.bulk_state_transition(instances, 'schedule_deleting')
+
 
 class ActionExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
     """ Default states transition for executing action with object.
@@ -190,3 +338,10 @@ class ActionExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
         instance.action = cls.action
         instance.action_details = cls.get_action_details(instance, **kwargs)
         instance.save()
+
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        def get_fields(instance):
+            return {'action': cls.action, 'action_details': cls.get_action_details(instance, **kwargs)}
+
+        return cls.bulk_state_transition(instances, 'schedule_updating', get_fields=get_fields)
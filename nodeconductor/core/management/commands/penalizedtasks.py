@@ -0,0 +1,31 @@
+import json
+
+import prettytable
+from celery import current_app
+from django.core.management.base import BaseCommand
+
+from nodeconductor.core.tasks import PenalizedBackgroundTask
+
+
+class Command(BaseCommand):
+    help = "List background tasks that are skipped due to penalty."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-t', '--task',
+            dest='task', default=None,
+            help='Name of the task. Penalties of all tasks are listed by default.',
+        )
+
+    def handle(self, *args, **options):
+        current_app.loader.import_default_modules()
+        tasks = [task for name, task in sorted(current_app.tasks.items())
+                 if isinstance(task, PenalizedBackgroundTask) and options['task'] in (None, name)]
+
+        table = prettytable.PrettyTable(['Task', 'Arguments', 'Failures', 'Skipped runs left'])
+        for task in tasks:
+            # Penalties are listed via registry of the task, it could be overridden by task
+            for penalty in task.get_penalty_registry().get_penalized(task.name):
+                arguments = json.dumps({'args': penalty['args'], 'kwargs': penalty['kwargs']}, sort_keys=True)
+                table.add_row([penalty['task'], arguments, penalty['failures'], penalty['counter']])
+        self.stdout.write(table.get_string())
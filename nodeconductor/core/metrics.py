@@ -0,0 +1,336 @@
+""" Timing records of executors and tasks steps.
+
+    Record is a dictionary with the following keys:
+     - name - name of executor or task class;
+     - step - name of the measured step, for example "pre_apply" or "execute";
+     - duration - duration of the step in seconds;
+     - queries - number of database queries issued during the step;
+     - any extra context, for example "model", "backend_method" or "queue".
+
+    Records are passed to sinks defined in NODECONDUCTOR['TIMING_SINKS'] setting.
+    If no sinks are defined, timings are not measured at all.
+"""
+from __future__ import unicode_literals
+
+import calendar
+import collections
+import json
+import logging
+import threading
+import time
+
+from celery.utils.timeutils import maybe_iso8601
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.lru_cache import lru_cache
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseTimingSink(object):
+    """ Receives timing records """
+
+    def add(self, record):
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """ Return aggregated statistics of records or None if sink does not aggregate them. """
+        return None
+
+
+class LoggingTimingSink(BaseTimingSink):
+    """ Write records to log, so they could be shipped to external storage """
+
+    def add(self, record):
+        logger.info('Timing record: %s', json.dumps(record, sort_keys=True))
+
+
+class MemoryTimingSink(BaseTimingSink):
+    """ Keep last MAX_SAMPLES records of each executor or task step in memory of current process. """
+    MAX_SAMPLES = 1000
+
+    _samples = collections.defaultdict(lambda: collections.deque(maxlen=MemoryTimingSink.MAX_SAMPLES))
+    _lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._samples[(record['name'], record['step'])].append((record['duration'], record.get('queries')))
+
+    def get_stats(self):
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+        return get_stats(samples)
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._samples.clear()
+
+
+class CacheTimingSink(BaseTimingSink):
+    """ Keep aggregated counters of each step in Django cache, so they are shared between processes.
+
+        Counters are accumulated in memory of current process and are added to cache counters
+        with atomic "incr" operation at most once per FLUSH_INTERVAL, so records of the last
+        interval are lost if process is stopped. Durations are counted in histogram with
+        BUCKETS upper bounds, so percentiles are approximated by bucket bounds.
+    """
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+    FLUSH_INTERVAL = 10
+    KEYS_KEY = 'timing_sink_keys'
+    LIFETIME = 7 * 24 * 60 * 60
+
+    _counters = collections.defaultdict(collections.Counter)
+    _max_durations = {}
+    _flushed_at = 0
+    _lock = threading.Lock()
+
+    def _get_cache_key(self, key, counter):
+        return 'timing_sink:%s:%s:%s' % (key + (counter,))
+
+    def _get_counters_names(self):
+        return ['count', 'queries', 'queries_count'] + ['bucket_%s' % index for index in range(len(self.BUCKETS))]
+
+    def add(self, record):
+        key = (record['name'], record['step'])
+        duration = record['duration']
+        bucket = next(index for index, bound in enumerate(self.BUCKETS) if duration <= bound)
+        with self._lock:
+            counters = self._counters[key]
+            counters['count'] += 1
+            counters['bucket_%s' % bucket] += 1
+            if record.get('queries') is not None:
+                counters['queries'] += record['queries']
+                counters['queries_count'] += 1
+            self._max_durations[key] = max(self._max_durations.get(key, 0), duration)
+
+            if time.time() - CacheTimingSink._flushed_at < self.FLUSH_INTERVAL:
+                return
+            CacheTimingSink._flushed_at = time.time()
+            counters, max_durations = dict(self._counters), dict(self._max_durations)
+            self._counters.clear()
+            self._max_durations.clear()
+        self.flush(counters, max_durations)
+
+    def flush(self, counters, max_durations):
+        keys = cache.get(self.KEYS_KEY) or []
+        missing_keys = [list(key) for key in counters if list(key) not in keys]
+        if missing_keys:
+            cache.set(self.KEYS_KEY, keys + missing_keys, self.LIFETIME)
+
+        for key, key_counters in counters.items():
+            for counter, value in key_counters.items():
+                cache_key = self._get_cache_key(key, counter)
+                cache.add(cache_key, 0, self.LIFETIME)
+                cache.incr(cache_key, value)
+            # Maximum could not be changed atomically, so it is approximate.
+            max_key = self._get_cache_key(key, 'max')
+            if max_durations[key] > (cache.get(max_key) or 0):
+                cache.set(max_key, max_durations[key], self.LIFETIME)
+
+    def get_stats(self):
+        keys = [tuple(key) for key in cache.get(self.KEYS_KEY) or []]
+        names = self._get_counters_names() + ['max']
+        values = cache.get_many([self._get_cache_key(key, name) for key in keys for name in names])
+        stats = []
+        for key in sorted(keys):
+            counters = {name: values.get(self._get_cache_key(key, name), 0) for name in names}
+            if not counters['count']:
+                continue
+            buckets = [counters['bucket_%s' % index] for index in range(len(self.BUCKETS))]
+            stats.append({
+                'name': key[0],
+                'step': key[1],
+                'count': counters['count'],
+                'p50': self._get_bucket_percentile(buckets, 0.5, counters['max']),
+                'p95': self._get_bucket_percentile(buckets, 0.95, counters['max']),
+                'max': counters['max'],
+                'avg_queries': (float(counters['queries']) / counters['queries_count']
+                                if counters['queries_count'] else None),
+            })
+        return stats
+
+    def _get_bucket_percentile(self, buckets, fraction, max_duration):
+        """ Return upper bound of bucket that contains nearest-rank percentile, it is not greater than maximum. """
+        rank = max(int(round(fraction * sum(buckets))), 1)
+        total = 0
+        for bound, count in zip(self.BUCKETS, buckets):
+            total += count
+            if total >= rank:
+                return min(bound, max_duration)
+        return max_duration
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._counters.clear()
+            cls._max_durations.clear()
+            cls._flushed_at = 0
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def get_stats(samples):
+    """ Aggregate dictionary {(name, step): [(duration, queries), ...]} to list of statistics. """
+    stats = []
+    for (name, step), values in sorted(samples.items()):
+        if not values:
+            continue
+        durations = sorted(duration for duration, _ in values)
+        queries = [count for _, count in values if count is not None]
+        stats.append({
+            'name': name,
+            'step': step,
+            'count': len(values),
+            'p50': percentile(durations, 0.5),
+            'p95': percentile(durations, 0.95),
+            'max': durations[-1],
+            'avg_queries': float(sum(queries)) / len(queries) if queries else None,
+        })
+    return stats
+
+
+@lru_cache(maxsize=1)
+def get_sinks():
+    paths = settings.NODECONDUCTOR.get('TIMING_SINKS', [])
+    return [import_string(path)() for path in paths]
+
+
+def add_record(record):
+    for sink in get_sinks():
+        try:
+            sink.add(record)
+        except Exception as e:
+            # Instrumentation should never break workflow.
+            logger.exception('Cannot add timing record to sink %s. Error: %s', sink.__class__.__name__, e)
+
+
+class TimingRecorder(object):
+    """ Measure steps of executor or task and pass records to sinks.
+
+    .. code-block:: python
+        recorder = TimingRecorder('MyExecutor', model='Instance')
+        with recorder.step('pre_apply'):
+            do_something()
+    """
+
+    def __init__(self, name, **context):
+        self.name = name
+        self.context = context
+        self.enabled = bool(get_sinks())
+
+    def add(self, step, duration, queries=None, **extra):
+        if not self.enabled:
+            return
+        record = dict(self.context, name=self.name, step=step, duration=duration, queries=queries)
+        record.update(extra)
+        add_record(record)
+
+    def step(self, step, **extra):
+        return _StepTimer(self, step, extra)
+
+    def add_queue_wait(self, request):
+        """ Record time that task message spent in queue. Publish time is stored in message headers. """
+        if not self.enabled or request is None:
+            return
+
+        headers = getattr(request, 'headers', None) or {}
+        published_at = headers.get('published_at')
+        if published_at is None:
+            return
+
+        started_at = published_at
+        if request.eta:
+            # Task with countdown should not be reported as waiting in queue
+            eta = maybe_iso8601(request.eta)
+            started_at = max(published_at, calendar.timegm(eta.utctimetuple()) + eta.microsecond / 1e6)
+
+        delivery_info = getattr(request, 'delivery_info', None) or {}
+        self.add('queue_wait', max(time.time() - started_at, 0), queue=delivery_info.get('routing_key'))
+
+
+class _QueryCountingCursor(object):
+    """ Cursor wrapper that counts executed queries for step timer. """
+
+    def __init__(self, cursor, timer):
+        self.cursor = cursor
+        self.timer = timer
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def execute(self, sql, params=None):
+        self.timer.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.timer.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def callproc(self, procname, params=None):
+        self.timer.queries += 1
+        return self.cursor.callproc(procname, params)
+
+
+class _StepTimer(object):
+    """ Measures duration and number of database queries of the step.
+
+        Queries are counted by wrapping cursors created by connection within the step,
+        so queries log and debug cursor are not used.
+    """
+    CURSOR_FACTORIES = ('make_cursor', 'make_debug_cursor')
+
+    def __init__(self, recorder, step, extra):
+        self.recorder = recorder
+        self.step = step
+        self.extra = extra
+        self.queries = 0
+
+    def __enter__(self):
+        if not self.recorder.enabled:
+            return self
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        # Only instance attributes are replaced, so outer step factories are restored on exit.
+        self.factories = {name: self.connection.__dict__.get(name) for name in self.CURSOR_FACTORIES}
+        for name in self.CURSOR_FACTORIES:
+            setattr(self.connection, name, self._wrap_factory(getattr(self.connection, name)))
+        self.queries = 0
+        self.started_at = time.time()
+        return self
+
+    def _wrap_factory(self, factory):
+        def make_cursor(cursor):
+            return _QueryCountingCursor(factory(cursor), self)
+        return make_cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.recorder.enabled:
+            return
+        duration = time.time() - self.started_at
+        for name, factory in self.factories.items():
+            if factory is None:
+                delattr(self.connection, name)
+            else:
+                setattr(self.connection, name, factory)
+        extra = dict(self.extra)
+        if exc_type is not None:
+            extra['failed'] = True
+        self.recorder.add(self.step, duration, queries=self.queries, **extra)
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import hashlib
+import json
+import numbers
 import re
 import pytz
 import logging
@@ -11,9 +14,10 @@ from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin, UserManager
 from django.core import validators
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone as django_timezone
 from django.utils.encoding import force_text, python_2_unicode_compatible
 from django.utils.lru_cache import lru_cache
@@ -30,6 +34,8 @@ from nodeconductor.logging.loggers import LoggableMixin
 
 logger = logging.getLogger(__name__)
 
+VERSION_FINGERPRINT_TIMEOUT = 24 * 60 * 60
+
 
 class DescribableMixin(models.Model):
     """
@@ -399,6 +405,30 @@ class ReversionMixin(object):
         options = reversion._get_options(self)
         return options.fields or [f.name for f in self._meta.fields if f not in options.exclude]
 
+    def get_version_fingerprint(self):
+        """ Hash of values of versioned fields.
+
+            Numbers are compared as floats to avoid version creation on wrong <float> vs <int> comparison.
+        """
+        values = []
+        for name in self.get_version_fields():
+            value = getattr(self, self._meta.get_field(name).attname)
+            if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                value = float(value)
+            values.append(force_text(value))
+        return hashlib.md5(json.dumps(values).encode('utf-8')).hexdigest()
+
+    def _get_version_fingerprint_key(self):
+        # UUID prevents collisions of reused primary keys
+        return 'version_fingerprint:%s:%s:%s' % (self._meta.label, self.pk, getattr(self, 'uuid', ''))
+
+    def _store_version_fingerprint(self):
+        """ Remember fingerprint of new version when it is committed to database. """
+        fingerprint = self.get_version_fingerprint()
+        key = self._get_version_fingerprint_key()
+
+        transaction.on_commit(lambda: cache.set(key, fingerprint, VERSION_FINGERPRINT_TIMEOUT))
+
     def _is_version_duplicate(self):
         """ Define should new version be created for object or no.
 
@@ -406,22 +436,50 @@ class ReversionMixin(object):
              - no need to compare all revisions - it is OK if right object version exists in any revision;
              - need to compare object attributes (not serialized data) to avoid
                version creation on wrong <float> vs <int> comparison;
+
+            Fingerprint of the latest version is kept in cache,
+            so versions are loaded from database only on cache miss.
         """
         if self.id is None:
             return False
+        fingerprint = self.get_version_fingerprint()
+        latest_fingerprint = cache.get(self._get_version_fingerprint_key())
+        if latest_fingerprint is not None:
+            return fingerprint == latest_fingerprint
+
         try:
             latest_version = Version.objects.get_for_object(self).latest('revision__date_created')
         except Version.DoesNotExist:
             return False
         latest_version_object = latest_version._object_version.object
         fields = self.get_version_fields()
-        return all([getattr(self, f) == getattr(latest_version_object, f) for f in fields])
+        is_duplicate = all([getattr(self, f) == getattr(latest_version_object, f) for f in fields])
+        if is_duplicate:
+            cache.set(self._get_version_fingerprint_key(), fingerprint, VERSION_FINGERPRINT_TIMEOUT)
+        return is_duplicate
 
     def save(self, **kwargs):
         if self._is_version_duplicate():
             return super(ReversionMixin, self).save(**kwargs)
         with reversion.create_revision():
-            return super(ReversionMixin, self).save(**kwargs)
+            result = super(ReversionMixin, self).save(**kwargs)
+            self._store_version_fingerprint()
+            return result
+
+    @classmethod
+    def save_with_revision(cls, instances, **kwargs):
+        """ Save instances and store versions of changed ones in one revision.
+
+        .. code-block:: python
+            Quota.save_with_revision(quotas)  # one revision instead of revision per quota
+        """
+        with reversion.create_revision(manage_manually=True):
+            for instance in instances:
+                is_duplicate = instance._is_version_duplicate()
+                super(ReversionMixin, instance).save(**kwargs)
+                if not is_duplicate:
+                    reversion.add_to_revision(instance)
+                    instance._store_version_fingerprint()
 
 
 # XXX: consider renaming it to AffinityMixin
@@ -3,17 +3,23 @@ from __future__ import unicode_literals
 import json
 import hashlib
 import logging
+import random
+import time
+import warnings
 
-from celery import Task as CeleryTask
+from celery import Task as CeleryTask, states
 from celery.execute import send_task as send_celery_task
+from celery.utils import uuid
 from celery.worker.job import Request
+from django.conf import settings
 from django.core.cache import cache
 from django.db import IntegrityError, models as django_models
 from django.db.models import ObjectDoesNotExist
 from django.utils import six
+from django.utils.module_loading import import_string
 from django_fsm import TransitionNotAllowed
 
-from nodeconductor.core import models, utils
+from nodeconductor.core import metrics, models, utils
 
 
 logger = logging.getLogger(__name__)
@@ -68,8 +74,11 @@ class Task(CeleryTask):
 
     def run(self, serialized_instance, *args, **kwargs):
         """ Deserialize input data and start backend operation execution """
+        recorder = metrics.TimingRecorder(self.__class__.__name__)
+        recorder.add_queue_wait(self.request)
         try:
-            instance = utils.deserialize_instance(serialized_instance)
+            with recorder.step('deserialize'):
+                instance = utils.deserialize_instance(serialized_instance)
         except ObjectDoesNotExist:
             message = ('Cannot restore instance from serialized object %s. Probably it was deleted.' %
                        serialized_instance)
@@ -77,14 +86,22 @@ class Task(CeleryTask):
 
         self.args = args
         self.kwargs = kwargs
-
-        self.pre_execute(instance)
-        result = self.execute(instance, *self.args, **self.kwargs)
-        self.post_execute(instance)
+        recorder.context.update(self.get_timing_context(instance))
+
+        with recorder.step('pre_execute'):
+            self.pre_execute(instance)
+        with recorder.step('execute'):
+            result = self.execute(instance, *self.args, **self.kwargs)
+        with recorder.step('post_execute'):
+            self.post_execute(instance)
         if result and isinstance(result, django_models.Model):
             result = utils.serialize_instance(result)
         return result
 
+    def get_timing_context(self, instance):
+        """ Extra information that is added to timing records of the task """
+        return {'model': instance.__class__.__name__}
+
     def pre_execute(self, instance):
         pass
 
@@ -198,6 +215,12 @@ class BackendMethodTask(RuntimeStateChangeTask, StateTransitionTask):
     def get_backend(self, instance):
         return instance.get_backend()
 
+    def get_timing_context(self, instance):
+        context = super(BackendMethodTask, self).get_timing_context(instance)
+        if self.args:
+            context['backend_method'] = self.args[0]
+        return context
+
     def execute(self, instance, backend_method, *args, **kwargs):
         backend = self.get_backend(instance)
         return getattr(backend, backend_method)(instance, *args, **kwargs)
@@ -293,6 +316,48 @@ class ExecutorTask(Task):
         self.executor.execute(instance, async=False, **kwargs)
 
 
+class CacheTaskLockRegistry(object):
+    """ Keeps locks of published background tasks in Django cache.
+
+        Lock is acquired atomically using "add" operation of cache backend,
+        so only one task with the same key can be published at the same time.
+        Lock is released when task is completed or lock timeout is expired.
+    """
+    KEY_PREFIX = 'background_task_lock'
+    SUPPRESSED_KEY_PREFIX = 'background_task_suppressed'
+
+    def acquire(self, key, task_id, timeout):
+        """ Return True if lock has been acquired, False if it is already taken. """
+        return cache.add('%s:%s' % (self.KEY_PREFIX, key), task_id, timeout)
+
+    def release(self, key):
+        cache.delete('%s:%s' % (self.KEY_PREFIX, key))
+
+    def is_locked(self, key):
+        return cache.get('%s:%s' % (self.KEY_PREFIX, key)) is not None
+
+    def increment_suppressed(self, task_name):
+        """ Count publish of task that was skipped because its predecessor is not completed yet. """
+        key = '%s:%s' % (self.SUPPRESSED_KEY_PREFIX, task_name)
+        cache.add(key, 0, None)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # key has been deleted between "add" and "incr"
+            cache.set(key, 1, None)
+            return 1
+
+    def get_suppressed_count(self, task_name):
+        return cache.get('%s:%s' % (self.SUPPRESSED_KEY_PREFIX, task_name), 0)
+
+
+def get_task_lock_registry():
+    """ Return registry defined in NODECONDUCTOR['BACKGROUND_TASK_LOCK_REGISTRY'] setting. """
+    path = settings.NODECONDUCTOR.get(
+        'BACKGROUND_TASK_LOCK_REGISTRY', 'nodeconductor.core.tasks.CacheTaskLockRegistry')
+    return import_string(path)()
+
+
 class BackgroundTask(CeleryTask):
     """ Task that is run in background via celerybeat.
 
@@ -304,36 +369,180 @@ class BackgroundTask(CeleryTask):
            should log themselves explicitly and make sure that they will not
            spam error messages.
 
-        Implement "is_equal" method to define what tasks are equal and should
-        be executed simultaneously.
+        Implement "get_lock_identity" method to define what tasks are equal and
+        should not be executed simultaneously. By default tasks are equal if they
+        have the same name and input parameters.
+
+        Lock of the task is stored in registry on publish and is released when
+        task succeeds or fails. LOCK_TIMEOUT protects from stale locks if task
+        message is lost or expired.
     """
     is_background = True
+    LOCK_TIMEOUT = 60 * 60
+
+    def get_lock_identity(self, *args, **kwargs):
+        """ Return string that identifies operation of the task. """
+        if type(self).is_equal != BackgroundTask.is_equal:
+            warnings.warn(
+                'Background task %s implements deprecated "is_equal" method, it is not used for '
+                'deduplication anymore. Implement "get_lock_identity" instead.' % self.name,
+                DeprecationWarning)
+        return json.dumps({'args': args, 'kwargs': kwargs}, sort_keys=True)
 
     def is_equal(self, other_task, *args, **kwargs):
         """ Return True if task do the same operation as other_task.
 
             Note! Other task is represented as serialized celery task - dictionary.
+            Deprecated: tasks are compared by lock identity, implement "get_lock_identity" instead.
         """
-        raise NotImplementedError('BackgroundTask should implement "is_equal" method to avoid queue overload.')
+        other_identity = self.get_lock_identity(*other_task.get('args', ()), **other_task.get('kwargs', {}))
+        return other_identity == self.get_lock_identity(*args, **kwargs)
+
+    def get_lock_key(self, *args, **kwargs):
+        # event context is attached to kwargs on publish and detached before run
+        kwargs = {key: value for key, value in kwargs.items() if key != 'event_context'}
+        identity = self.get_lock_identity(*args, **kwargs)
+        # md5 is used for internal caching, not need to care about security
+        return '%s:%s' % (self.name, hashlib.md5(identity.encode('utf-8')).hexdigest())  # nosec
+
+    def get_lock_timeout(self, options):
+        expires = options.get('expires')
+        if isinstance(expires, six.integer_types + (float,)):
+            return int(expires) + (options.get('countdown') or 0)
+        return self.LOCK_TIMEOUT
 
     def is_previous_task_processing(self, *args, **kwargs):
         """ Return True if exist task that is equal to current and is uncompleted """
-        app = self._get_app()
-        inspect = app.control.inspect()
-        active = inspect.active() or {}
-        scheduled = inspect.scheduled() or {}
-        reserved = inspect.reserved() or {}
-        uncompleted = sum(active.values() + scheduled.values() + reserved.values(), [])
-        return any(self.is_equal(task, *args, **kwargs) for task in uncompleted)
+        return get_task_lock_registry().is_locked(self.get_lock_key(*args, **kwargs))
 
     def apply_async(self, args=None, kwargs=None, **options):
         """ Do not run background task if previous task is uncompleted """
-        if self.is_previous_task_processing(*args, **kwargs):
-            message = 'Background task %s was not scheduled, because its predecessor is not completed yet.' % self.name
+        args = args or ()
+        kwargs = kwargs or {}
+        registry = get_task_lock_registry()
+        key = self.get_lock_key(*args, **kwargs)
+        task_id = options.setdefault('task_id', uuid())
+
+        if not registry.acquire(key, task_id, self.get_lock_timeout(options)):
+            suppressed = registry.increment_suppressed(self.name)
+            message = ('Background task %s was not scheduled, because its predecessor is not completed yet. '
+                       'Suppressed publishes: %s.' % (self.name, suppressed))
             logger.info(message)
             # It is expected by Celery that apply_async return AsyncResult, otherwise celerybeat dies
-            return self.AsyncResult(options.get('task_id'))
-        return super(BackgroundTask, self).apply_async(args=args, kwargs=kwargs, **options)
+            return self.AsyncResult(task_id)
+
+        try:
+            return super(BackgroundTask, self).apply_async(args=args, kwargs=kwargs, **options)
+        except Exception:
+            registry.release(key)
+            raise
+
+    def apply_async_many(self, arguments, **options):
+        """ Publish task for each pair of (args, kwargs) """
+        return [self.apply_async(args=args, kwargs=kwargs, **options) for args, kwargs in arguments]
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        """ Release lock when task succeeds or fails """
+        if status in states.READY_STATES:
+            get_task_lock_registry().release(self.get_lock_key(*(args or ()), **(kwargs or {})))
+        return super(BackgroundTask, self).after_return(status, retval, task_id, args, kwargs, einfo)
+
+
+class CachePenaltyRegistry(object):
+    """ Keeps penalties of background tasks in Django cache.
+
+        Penalty is a dictionary with the following keys:
+         - task - name of the task;
+         - args, kwargs - input parameters of the task, they define penalized scope;
+         - failures - how many times in a row the task has failed;
+         - counter - how many runs the task will skip yet.
+
+        Index of penalized keys is stored separately, so operators could list penalized scopes.
+        Index is split into INDEX_SHARDS shards that map key to its expiration time. Key is added
+        to its shard only once per lifetime, which is checked with atomic cache.add,
+        and expired keys are pruned from the shard at the same time. Shard is updated under
+        cache lock, if lock is not acquired, key is added on next set of its penalty.
+    """
+    KEY_PREFIX = 'background_task_penalty'
+    INDEXED_KEY_PREFIX = 'background_task_penalty_indexed'
+    INDEX_KEY = 'background_task_penalty_index:%s'
+    INDEX_SHARDS = 16
+    INDEX_LOCK_ATTEMPTS = 10
+    INDEX_LOCK_DELAY = 0.01
+    INDEX_LOCK_TIMEOUT = 5
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+
+    def _get_cache_key(self, key):
+        return '%s:%s' % (self.KEY_PREFIX, key)
+
+    def _get_indexed_key(self, key):
+        return '%s:%s' % (self.INDEXED_KEY_PREFIX, key)
+
+    def _get_index_key(self, key):
+        # md5 is used for sharding, not need to care about security
+        shard = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % self.INDEX_SHARDS  # nosec
+        return self.INDEX_KEY % shard
+
+    def get(self, key):
+        return cache.get(self._get_cache_key(key))
+
+    def get_many(self, keys):
+        """ Get penalties of several keys with one cache request """
+        values = cache.get_many([self._get_cache_key(key) for key in keys])
+        return {key: values[self._get_cache_key(key)] for key in keys if self._get_cache_key(key) in values}
+
+    def set(self, key, penalty):
+        cache.set(self._get_cache_key(key), penalty, self.lifetime)
+        self._index(key)
+
+    def set_many(self, penalties):
+        cache.set_many({self._get_cache_key(key): penalty for key, penalty in penalties.items()}, self.lifetime)
+        for key in penalties:
+            self._index(key)
+
+    def _index(self, key):
+        """ Add key to its index shard unless it has been added during last lifetime.
+
+            Index entry is kept for two lifetimes, so it outlives penalty that is set
+            before the key has to be added again.
+        """
+        indexed_key = self._get_indexed_key(key)
+        if not cache.add(indexed_key, True, self.lifetime):
+            return
+        index_key = self._get_index_key(key)
+        lock_key = index_key + ':lock'
+        for _ in range(self.INDEX_LOCK_ATTEMPTS):
+            # Shard is read and written back, so concurrent updates are serialized with lock.
+            if cache.add(lock_key, True, self.INDEX_LOCK_TIMEOUT):
+                try:
+                    now = time.time()
+                    index = {item: expires for item, expires in (cache.get(index_key) or {}).items() if expires > now}
+                    index[key] = now + 2 * self.lifetime
+                    cache.set(index_key, index, 2 * self.lifetime)
+                finally:
+                    cache.delete(lock_key)
+                return
+            time.sleep(self.INDEX_LOCK_DELAY)
+        # Shard is not updated, so key should be added to it on next attempt.
+        cache.delete(indexed_key)
+        logger.warning('Penalized key %s is not added to index, because its shard is locked.', key)
+
+    def delete(self, key):
+        """ Delete penalty, its index entry is pruned when it expires. """
+        cache.delete_many([self._get_cache_key(key), self._get_indexed_key(key)])
+
+    def get_penalized(self, task_name=None):
+        """ Return list of current penalties, optionally filtered by task name """
+        shards = cache.get_many([self.INDEX_KEY % shard for shard in range(self.INDEX_SHARDS)])
+        keys = set()
+        for index in shards.values():
+            keys.update(index)
+        penalties = self.get_many(keys).values()
+        if task_name is not None:
+            penalties = [penalty for penalty in penalties if penalty['task'] == task_name]
+        return sorted(penalties, key=lambda penalty: (penalty['task'], -penalty['failures']))
 
 
 class PenalizedBackgroundTask(BackgroundTask):
@@ -342,62 +551,109 @@ class PenalizedBackgroundTask(BackgroundTask):
     It uses cache memory for tracking results of previous task executions.
     The following values are stored to the cache memory:
         - counter - the task will be skipped till the counter gets 0.
-        - penalty - shows how much runs the task will skip in case of failed execution.
+        - failures - shows how many times in a row the task has failed.
 
-    For example,
+    Penalty grows exponentially with number of failures:
+    penalty = min(PENALTY_BASE ** (failures - 1), MAX_PENALTY).
+    If PENALTY_JITTER is defined, random number of runs up to PENALTY_JITTER * penalty
+    is added to the penalty, so penalized tasks of the same fan-out are not retried simultaneously.
+
+    For example, with default settings:
     1 run: Cache state: Empty; Result: failed
-    2 run: Cache state: counter = 1, penalty = 1; Result: skipped
-    3 run: Cache state: counter = 0, penalty = 1; Result: failed
-    4 run: Cache state: counter = 2, penalty = 2; Result: skipped
-    5 run: Cache state: counter = 1, penalty = 2; Result: skipped
-    6 run: Cache state: counter = 0, penalty = 2; Result: success
+    2 run: Cache state: counter = 1, failures = 1; Result: skipped
+    3 run: Cache state: counter = 0, failures = 1; Result: failed
+    4 run: Cache state: counter = 2, failures = 2; Result: skipped
+    5 run: Cache state: counter = 1, failures = 2; Result: skipped
+    6 run: Cache state: counter = 0, failures = 2; Result: success
     7 run: Cache state: Empty; Result: success
 
+    Use "apply_async_many" to check penalties of many tasks with one cache request.
+
     NB! Ensure that CACHE_LIFETIME is longer than time between the task executions.
     """
 
     MAX_PENALTY = 3
+    PENALTY_BASE = 2
+    PENALTY_JITTER = 0
     CACHE_LIFETIME = 24 * 60 * 60
 
+    def get_penalty_registry(self):
+        return CachePenaltyRegistry(self.CACHE_LIFETIME)
+
+    def get_penalty(self, failures):
+        """ Returns how many runs should be skipped after given number of failures """
+        penalty = min(self.PENALTY_BASE ** (failures - 1), self.MAX_PENALTY)
+        if self.PENALTY_JITTER:
+            penalty += random.randint(0, int(penalty * self.PENALTY_JITTER))
+        return penalty
+
     def _get_cache_key(self, args, kwargs):
         """ Returns key to be used in cache """
-        hash_input = json.dumps({'name': self.name, 'args': args, 'kwargs': kwargs}, sort_keys=True)
+        kwargs = {key: value for key, value in (kwargs or {}).items() if key != 'event_context'}
+        hash_input = json.dumps({'name': self.name, 'args': args or [], 'kwargs': kwargs}, sort_keys=True)
         # md5 is used for internal caching, not need to care about security
-        return hashlib.md5(hash_input).hexdigest()  # nosec
+        return hashlib.md5(hash_input.encode('utf-8')).hexdigest()  # nosec
 
     def apply_async(self, args=None, kwargs=None, **options):
         """
         Checks whether task must be skipped and decreases the counter in that case.
         """
-        key = self._get_cache_key(args, kwargs)
-        counter, penalty = cache.get(key, (0, 0))
-        if not counter:
-            return super(PenalizedBackgroundTask, self).apply_async(args=args, kwargs=kwargs, **options)
+        return self.apply_async_many([(args, kwargs)], **options)[0]
+
+    def apply_async_many(self, arguments, **options):
+        """
+        Publishes task for each pair of (args, kwargs), skips penalized ones.
+        Penalties of all tasks are fetched with one cache request.
+        """
+        registry = self.get_penalty_registry()
+        keys = [self._get_cache_key(args, kwargs) for args, kwargs in arguments]
+        penalties = registry.get_many(keys)
+
+        results = []
+        skipped = {}
+        for key, (args, kwargs) in zip(keys, arguments):
+            penalty = penalties.get(key)
+            if not penalty or not penalty['counter']:
+                results.append(super(PenalizedBackgroundTask, self).apply_async(args=args, kwargs=kwargs, **options))
+                continue
+
+            skipped[key] = dict(penalty, counter=penalty['counter'] - 1)
+            # It is expected by Celery that apply_async return AsyncResult, otherwise celerybeat dies
+            results.append(self.AsyncResult(options.get('task_id')))
 
-        cache.set(key, (counter - 1, penalty), self.CACHE_LIFETIME)
-        logger.info('The task %s will not be executed due to the penalty.' % self.name)
-        return self.AsyncResult(options.get('task_id'))
+        if skipped:
+            registry.set_many(skipped)
+            logger.info('%s runs of the task %s will not be executed due to the penalty.' % (len(skipped), self.name))
+        return results
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         """
         Increases penalty for the task and resets the counter.
         """
+        registry = self.get_penalty_registry()
         key = self._get_cache_key(args, kwargs)
-        _, penalty = cache.get(key, (0, 0))
-        if penalty < self.MAX_PENALTY:
-            penalty += 1
-
-        logger.debug('The task %s is penalized and will be executed on %d run.' % (self.name, penalty))
-        cache.set(key, (penalty, penalty), self.CACHE_LIFETIME)
+        penalty = registry.get(key) or {'failures': 0}
+        failures = penalty['failures'] + 1
+        counter = self.get_penalty(failures)
+
+        logger.debug('The task %s is penalized and will be executed on %d run.' % (self.name, counter))
+        registry.set(key, {
+            'task': self.name,
+            'args': list(args or []),
+            'kwargs': {name: value for name, value in (kwargs or {}).items() if name != 'event_context'},
+            'failures': failures,
+            'counter': counter,
+        })
         return super(PenalizedBackgroundTask, self).on_failure(exc, task_id, args, kwargs, einfo)
 
     def on_success(self, retval, task_id, args, kwargs):
         """
         Clears cache for the task.
         """
+        registry = self.get_penalty_registry()
         key = self._get_cache_key(args, kwargs)
-        if cache.get(key) is not None:
-            cache.delete(key)
+        if registry.get(key) is not None:
+            registry.delete(key)
             logger.debug('Penalty for the task %s has been removed.' % self.name)
 
         return super(PenalizedBackgroundTask, self).on_success(retval, task_id, args, kwargs)
@@ -0,0 +1,10 @@
+from __future__ import unicode_literals
+
+from nodeconductor.core import executors, tasks
+
+
+class TestUpdateExecutor(executors.UpdateExecutor):
+
+    @classmethod
+    def get_task_signature(cls, instance, serialized_instance, **kwargs):
+        return tasks.StateTransitionTask().si(serialized_instance, state_transition='begin_updating')
@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+import mock
+from django.test import TransactionTestCase
+from django_fsm import signals as fsm_signals
+
+from nodeconductor.core import tasks
+from nodeconductor.core.tests.executors import TestUpdateExecutor
+from nodeconductor.structure.tests import factories as structure_factories
+from nodeconductor.structure.tests import models as structure_models
+
+States = structure_models.TestNewInstance.States
+
+
+class ExecuteManyTest(TransactionTestCase):
+
+    def setUp(self):
+        link = structure_factories.TestServiceProjectLinkFactory()
+        self.instances = structure_factories.TestNewInstanceFactory.create_batch(
+            size=3, service_project_link=link, state=States.OK)
+        self.creating_instance = structure_factories.TestNewInstanceFactory(
+            service_project_link=link, state=States.CREATING)
+
+    def test_state_of_instances_is_changed_in_bulk(self):
+        results = TestUpdateExecutor.pre_apply_many(self.instances)
+
+        self.assertEqual([error for _, error in results], [None] * 3)
+        for instance in self.instances:
+            instance.refresh_from_db()
+            self.assertEqual(instance.state, States.UPDATE_SCHEDULED)
+
+    def test_instance_changed_concurrently_is_reported(self):
+        structure_models.TestNewInstance.objects.filter(pk=self.instances[0].pk).update(state=States.DELETING)
+
+        results = dict(TestUpdateExecutor.pre_apply_many(self.instances))
+
+        self.assertIsInstance(results[self.instances[0]], tasks.StateChangeError)
+        self.assertEqual(self.instances[0].state, States.OK)
+        self.instances[0].refresh_from_db()
+        self.assertEqual(self.instances[0].state, States.DELETING)
+
+    def test_transition_signal_is_not_sent_for_instance_changed_concurrently(self):
+        structure_models.TestNewInstance.objects.filter(pk=self.instances[0].pk).update(state=States.DELETING)
+        handler = mock.Mock()
+        fsm_signals.post_transition.connect(handler)
+        try:
+            TestUpdateExecutor.pre_apply_many(self.instances)
+        finally:
+            fsm_signals.post_transition.disconnect(handler)
+
+        updated_instances = [call[1]['instance'] for call in handler.call_args_list]
+        self.assertEqual(updated_instances, self.instances[1:])
+
+    def test_modified_timestamp_is_updated(self):
+        modified = self.instances[0].modified
+
+        TestUpdateExecutor.pre_apply_many(self.instances)
+
+        self.instances[0].refresh_from_db()
+        self.assertGreater(self.instances[0].modified, modified)
+
+    def test_executor_is_applied_synchronously_to_all_instances(self):
+        instances = self.instances + [self.creating_instance]
+
+        results = TestUpdateExecutor.execute_many(instances, async=False, updated_fields=['name'])
+
+        self.assertEqual([instance for instance, _ in results], instances)
+        self.assertIsInstance(results[-1][1], tasks.StateChangeError)
+        for instance in self.instances:
+            instance.refresh_from_db()
+            self.assertEqual(instance.state, States.OK)
+
+    @mock.patch('nodeconductor.core.executors.current_app')
+    def test_executor_is_applied_asynchronously_using_one_producer(self, mocked_app):
+        producer = mocked_app.producer_or_acquire.return_value.__enter__.return_value
+        published = []
+
+        def apply_async(*args, **kwargs):
+            states = structure_models.TestNewInstance.objects.filter(
+                pk__in=[instance.pk for instance in self.instances]).values_list('state', flat=True)
+            published.append((kwargs.get('producer'), set(states)))
+
+        with mock.patch('celery.canvas.Signature.apply_async', side_effect=apply_async):
+            results = TestUpdateExecutor.execute_many(self.instances, updated_fields=['name'])
+
+        self.assertEqual([error for _, error in results], [None] * 3)
+        self.assertEqual(mocked_app.producer_or_acquire.call_count, 1)
+        self.assertEqual(published, [(producer, {States.UPDATE_SCHEDULED})] * 3)
@@ -0,0 +1,99 @@
+from __future__ import unicode_literals
+
+import mock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from rest_framework import status, test
+
+from nodeconductor.core import metrics
+from nodeconductor.core.tests.executors import TestUpdateExecutor
+from nodeconductor.structure.tests import factories as structure_factories
+
+
+class TimingStatsTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        nodeconductor_settings = settings.NODECONDUCTOR.copy()
+        nodeconductor_settings['TIMING_SINKS'] = ['nodeconductor.core.metrics.MemoryTimingSink']
+        self.settings_override = self.settings(NODECONDUCTOR=nodeconductor_settings)
+        self.settings_override.enable()
+        metrics.get_sinks.cache_clear()
+        metrics.MemoryTimingSink.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        metrics.get_sinks.cache_clear()
+
+    def test_executor_and_task_steps_are_measured(self):
+        instance = structure_factories.TestNewInstanceFactory()
+        instance.state = instance.States.OK
+        instance.save()
+
+        TestUpdateExecutor.execute(instance, async=False, updated_fields=['name'])
+
+        steps = {(item['name'], item['step']) for item in metrics.MemoryTimingSink().get_stats()}
+        self.assertIn(('TestUpdateExecutor', 'pre_apply'), steps)
+        self.assertIn(('TestUpdateExecutor', 'apply_signature'), steps)
+        self.assertIn(('StateTransitionTask', 'execute'), steps)
+
+    def test_queries_of_step_are_counted_without_debug_cursor(self):
+        recorder = metrics.TimingRecorder('Executor')
+
+        with recorder.step('pre_apply'):
+            structure_factories.UserFactory.create_batch(2)
+            with recorder.step('execute'):
+                self.assertFalse(connection.force_debug_cursor)
+                structure_factories.UserFactory()
+
+        queries = {item['step']: item['avg_queries'] for item in metrics.MemoryTimingSink().get_stats()}
+        self.assertGreater(queries['pre_apply'], queries['execute'])
+        self.assertGreater(queries['execute'], 0)
+        self.assertNotIn('make_cursor', connection.__dict__)
+
+    def test_percentiles_are_calculated_for_each_step(self):
+        for duration in range(1, 101):
+            metrics.add_record({'name': 'Executor', 'step': 'pre_apply', 'duration': duration, 'queries': 2})
+
+        stats = metrics.MemoryTimingSink().get_stats()
+
+        self.assertEqual(stats, [{
+            'name': 'Executor', 'step': 'pre_apply', 'count': 100,
+            'p50': 50, 'p95': 95, 'max': 100, 'avg_queries': 2.0,
+        }])
+
+    def test_stats_are_available_for_staff_only(self):
+        url = reverse('stats_timing')
+        self.client.force_authenticate(structure_factories.UserFactory())
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        metrics.add_record({'name': 'Executor', 'step': 'pre_apply', 'duration': 1, 'queries': 0})
+        self.client.force_authenticate(structure_factories.UserFactory(is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+
+class CacheTimingSinkTest(test.APITransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.CacheTimingSink.clear()
+        self.sink = metrics.CacheTimingSink()
+
+    def test_records_are_aggregated_to_histogram_counters(self):
+        with mock.patch.object(metrics.CacheTimingSink, 'FLUSH_INTERVAL', 0):
+            for duration in (0.2, 0.3, 0.4, 7):
+                self.sink.add({'name': 'Executor', 'step': 'pre_apply', 'duration': duration, 'queries': 2})
+
+        self.assertEqual(self.sink.get_stats(), [{
+            'name': 'Executor', 'step': 'pre_apply', 'count': 4,
+            'p50': 0.5, 'p95': 7, 'max': 7, 'avg_queries': 2.0,
+        }])
+
+    def test_records_are_flushed_to_cache_once_per_interval(self):
+        for _ in range(3):
+            self.sink.add({'name': 'Executor', 'step': 'pre_apply', 'duration': 1, 'queries': 0})
+
+        self.assertEqual(self.sink.get_stats()[0]['count'], 1)
@@ -0,0 +1,155 @@
+from __future__ import unicode_literals
+
+import StringIO
+import warnings
+
+from celery import states
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from mock import patch
+
+from nodeconductor.core import tasks
+
+
+class SampleBackgroundTask(tasks.BackgroundTask):
+    name = 'nodeconductor.core.tests.SampleBackgroundTask'
+
+    def run(self, value):
+        pass
+
+
+class LegacyBackgroundTask(SampleBackgroundTask):
+    name = 'nodeconductor.core.tests.LegacyBackgroundTask'
+
+    def is_equal(self, other_task, *args, **kwargs):
+        return True
+
+
+@patch('celery.Task.apply_async')
+class BackgroundTaskLockTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.task = SampleBackgroundTask()
+        self.registry = tasks.get_task_lock_registry()
+
+    def test_task_is_not_published_if_predecessor_is_not_completed(self, mocked_apply_async):
+        self.task.apply_async(args=('first',))
+        self.task.apply_async(args=('first',))
+
+        self.assertEqual(mocked_apply_async.call_count, 1)
+        self.assertEqual(self.registry.get_suppressed_count(self.task.name), 1)
+
+    def test_tasks_with_different_arguments_are_published(self, mocked_apply_async):
+        self.task.apply_async(args=('first',))
+        self.task.apply_async(args=('second',))
+
+        self.assertEqual(mocked_apply_async.call_count, 2)
+
+    def test_lock_is_released_when_task_is_completed(self, mocked_apply_async):
+        self.task.apply_async(args=('first',))
+        self.task.after_return(states.SUCCESS, None, 'task-id', ('first',), {}, None)
+        self.task.apply_async(args=('first',))
+
+        self.assertEqual(mocked_apply_async.call_count, 2)
+
+    def test_lock_is_kept_while_task_is_retried(self, mocked_apply_async):
+        self.task.apply_async(args=('first',))
+        self.task.after_return(states.RETRY, None, 'task-id', ('first',), {}, None)
+
+        self.assertTrue(self.task.is_previous_task_processing('first'))
+
+    def test_task_is_equal_to_serialized_task_with_the_same_arguments(self, mocked_apply_async):
+        self.assertTrue(self.task.is_equal({'args': ['first'], 'kwargs': {}}, 'first'))
+        self.assertFalse(self.task.is_equal({'args': ['second'], 'kwargs': {}}, 'first'))
+
+    def test_deprecation_warning_is_issued_if_task_implements_is_equal(self, mocked_apply_async):
+        task = LegacyBackgroundTask()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            task.apply_async(args=('first',))
+            task.apply_async(args=('second',))
+
+        self.assertTrue(any(issubclass(w.category, DeprecationWarning) for w in caught))
+        self.assertEqual(mocked_apply_async.call_count, 2)
+
+
+class SamplePenalizedTask(tasks.PenalizedBackgroundTask):
+    name = 'nodeconductor.core.tests.SamplePenalizedTask'
+
+    def run(self, value):
+        pass
+
+
+@patch('celery.Task.apply_async')
+class PenalizedBackgroundTaskTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.task = SamplePenalizedTask()
+
+    def mark_failed(self, value):
+        self.task.on_failure(Exception(), 'task-id', (value,), {}, None)
+
+    def test_penalty_grows_exponentially_up_to_the_limit(self, mocked_apply_async):
+        self.assertEqual([self.task.get_penalty(failures) for failures in range(1, 5)], [1, 2, 3, 3])
+
+    def test_penalized_runs_are_skipped(self, mocked_apply_async):
+        self.mark_failed('first')
+        self.mark_failed('first')
+
+        self.task.apply_async(args=('first',))
+        self.task.apply_async(args=('first',))
+        self.task.apply_async(args=('first',))
+
+        self.assertEqual(mocked_apply_async.call_count, 1)
+
+    def test_penalties_of_fan_out_are_fetched_with_one_request(self, mocked_apply_async):
+        self.mark_failed('first')
+
+        with patch('nodeconductor.core.tasks.cache.get_many', wraps=cache.get_many) as mocked_get_many:
+            self.task.apply_async_many([(('first',), {}), (('second',), {}), (('third',), {})])
+
+        self.assertEqual(mocked_get_many.call_count, 1)
+        self.assertEqual(mocked_apply_async.call_count, 2)
+
+    def test_penalized_scopes_are_listed_and_cleared_on_success(self, mocked_apply_async):
+        self.mark_failed('first')
+        registry = self.task.get_penalty_registry()
+
+        penalties = registry.get_penalized(self.task.name)
+        self.assertEqual([penalty['args'] for penalty in penalties], [['first']])
+
+        self.task.on_success(None, 'task-id', ('first',), {})
+        self.assertEqual(registry.get_penalized(self.task.name), [])
+
+    def test_penalties_of_many_scopes_are_listed(self, mocked_apply_async):
+        values = ['value-%s' % index for index in range(20)]
+        for value in values:
+            self.mark_failed(value)
+        self.task.on_success(None, 'task-id', (values[0],), {})
+
+        penalties = self.task.get_penalty_registry().get_penalized(self.task.name)
+        self.assertEqual(sorted(penalty['args'][0] for penalty in penalties), sorted(values[1:]))
+
+    def test_key_is_indexed_on_next_failure_if_shard_is_locked(self, mocked_apply_async):
+        registry = self.task.get_penalty_registry()
+        shard_key = registry._get_index_key(self.task._get_cache_key(('first',), {}))
+        cache.add(shard_key + ':lock', True)
+        with patch('nodeconductor.core.tasks.time.sleep'):
+            self.mark_failed('first')
+        self.assertEqual(registry.get_penalized(self.task.name), [])
+
+        cache.delete(shard_key + ':lock')
+        self.mark_failed('first')
+
+        self.assertEqual([penalty['args'] for penalty in registry.get_penalized(self.task.name)], [['first']])
+
+    def test_penalized_scopes_are_listed_by_command(self, mocked_apply_async):
+        self.mark_failed('first')
+        output = StringIO.StringIO()
+
+        call_command('penalizedtasks', task=self.task.name, stdout=output)
+
+        self.assertIn('first', output.getvalue())
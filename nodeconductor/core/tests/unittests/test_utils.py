@@ -2,7 +2,11 @@ from __future__ import unicode_literals
 
 import unittest
 
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
 from nodeconductor.core import utils
+from nodeconductor.structure.tests import factories as structure_factories
 
 
 class TestFormatTimeAndValueToSegmentList(unittest.TestCase):
@@ -37,3 +41,26 @@ class TestFormatTimeAndValueToSegmentList(unittest.TestCase):
         expected_second_segment_value = sum([value for _, value in second_segment_time_value_list])
         self.assertEqual(first_segment['value'], expected_first_segment_value)
         self.assertEqual(second_segment['value'], expected_second_segment_value)
+
+
+class TestDeserializeInstances(TestCase):
+
+    def setUp(self):
+        self.users = [get_user_model().objects.create(username='user%s' % i) for i in range(3)]
+        self.customer = structure_factories.CustomerFactory()
+
+    def test_instances_are_restored_in_the_same_order(self):
+        serialized = utils.serialize_instances([self.users[2], self.customer, self.users[0]])
+
+        with self.assertNumQueries(2):
+            instances = utils.deserialize_instances(serialized)
+
+        self.assertEqual(instances, [self.users[2], self.customer, self.users[0]])
+
+    def test_deleted_instances_are_skipped(self):
+        serialized = utils.serialize_instances(self.users)
+        self.users[1].delete()
+
+        instances = utils.deserialize_instances(serialized)
+
+        self.assertEqual(instances, [self.users[0], self.users[2]])
@@ -17,6 +17,7 @@ from django.urls import resolve
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.encoding import force_text
+from django.utils.lru_cache import lru_cache
 
 
 def sort_dict(unsorted_dict):
@@ -121,13 +122,53 @@ def serialize_instance(instance):
     return '{}:{}'.format(model_name, instance.pk)
 
 
+def serialize_instances(instances):
+    """ Serialize list of Django model instances """
+    return [serialize_instance(instance) for instance in instances]
+
+
+@lru_cache(maxsize=None)
+def get_model_by_label(model_name):
+    """ Get model by its label, for example "structure.Customer". Result is cached per process. """
+    return apps.get_model(model_name)
+
+
 def deserialize_instance(serialized_instance):
     """ Deserialize Django model instance """
     model_name, pk = serialized_instance.split(':')
-    model = apps.get_model(model_name)
+    model = get_model_by_label(model_name)
     return model._default_manager.get(pk=pk)
 
 
+def deserialize_instances(serialized_instances, select_related=None):
+    """ Deserialize list of Django model instances using one query per model.
+
+        select_related - dictionary that maps model class to the list of
+        related fields that should be fetched together with its instances.
+
+        Instances are returned in the same order as serialized ones.
+        Deleted instances are skipped.
+    """
+    select_related = select_related or {}
+    pks_by_model = OrderedDict()
+    keys = []
+    for serialized_instance in serialized_instances:
+        model_name, pk = serialized_instance.split(':')
+        model = get_model_by_label(model_name)
+        pks_by_model.setdefault(model, []).append(pk)
+        keys.append((model, force_text(pk)))
+
+    instances = {}
+    for model, pks in pks_by_model.items():
+        queryset = model._default_manager.filter(pk__in=pks)
+        if model in select_related:
+            queryset = queryset.select_related(*select_related[model])
+        for instance in queryset:
+            instances[(model, force_text(instance.pk))] = instance
+
+    return [instances[key] for key in keys if key in instances]
+
+
 def serialize_class(cls):
     """ Serialize Python class """
     return '{}:{}'.format(cls.__module__, cls.__name__)
@@ -15,7 +15,7 @@ from rest_framework.views import APIView
 from rest_framework.views import exception_handler as rf_exception_handler
 
 from nodeconductor import __version__
-from nodeconductor.core import permissions
+from nodeconductor.core import metrics, permissions
 from nodeconductor.core.exceptions import IncorrectStateException
 from nodeconductor.core.serializers import AuthTokenSerializer
 from nodeconductor.logging.loggers import event_logger
@@ -179,6 +179,31 @@ def version_detail(request):
     return Response({'version': __version__})
 
 
+@api_view(['GET'])
+@permission_classes((rf_permissions.IsAdminUser, ))
+def timing_stats(request):
+    """
+    Durations of executors and tasks steps aggregated by sinks defined in
+    NODECONDUCTOR['TIMING_SINKS'] setting. Available only for staff users.
+
+    Each item contains name of executor or task, step, count of samples,
+    p50, p95 and max duration in seconds and average number of database queries.
+
+    Filter by name of executor or task using ?name=<name> query parameter.
+    """
+    stats = []
+    for sink in metrics.get_sinks():
+        sink_stats = sink.get_stats()
+        if sink_stats is not None:
+            stats = sink_stats
+            break
+
+    names = request.query_params.getlist('name')
+    if names:
+        stats = [item for item in stats if item['name'] in names]
+    return Response(stats)
+
+
 # noinspection PyProtectedMember
 def exception_handler(exc, context):
     if isinstance(exc, ProtectedError):
@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
+from celery import signals as celery_signals
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.core import signals as core_signals
 from django.db.models import signals
 
 
@@ -9,7 +12,26 @@ class EventsConfig(AppConfig):
     verbose_name = 'Logging'
 
     def ready(self):
-        from nodeconductor.logging import handlers, utils
+        from nodeconductor.logging import handlers, log, models, utils
+
+        # Events of request or task are passed to hooks processing with one task
+        # and are stored in database when its transaction is finished.
+        core_signals.request_started.connect(
+            log.start_events_buffering,
+            dispatch_uid='nodeconductor.logging.log.start_events_buffering_on_request',
+        )
+        core_signals.request_finished.connect(
+            log.flush_events,
+            dispatch_uid='nodeconductor.logging.log.flush_events_on_request',
+        )
+        celery_signals.task_prerun.connect(
+            log.start_events_buffering,
+            dispatch_uid='nodeconductor.logging.log.start_events_buffering_on_task',
+        )
+        celery_signals.task_postrun.connect(
+            log.flush_events,
+            dispatch_uid='nodeconductor.logging.log.flush_events_on_task',
+        )
 
         for index, model in enumerate(utils.get_loggable_models()):
             signals.post_delete.connect(
@@ -17,3 +39,51 @@ class EventsConfig(AppConfig):
                 sender=model,
                 dispatch_uid='nodeconductor.logging.handlers.remove_{}_{}_related_alerts'.format(model.__name__, index),
             )
+
+            signals.post_save.connect(
+                handlers.invalidate_cached_log_context,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_{}_{}_log_context'.format(model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.invalidate_cached_log_context,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_{}_{}_log_context_on_delete'.format(
+                    model.__name__, index),
+            )
+
+            signals.post_save.connect(
+                handlers.invalidate_hooks_permissions,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_hooks_permissions_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.invalidate_hooks_permissions,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_hooks_permissions_on_delete_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+        signals.post_save.connect(
+            handlers.invalidate_user_hooks_permissions,
+            sender=get_user_model(),
+            dispatch_uid='nodeconductor.logging.handlers.invalidate_user_hooks_permissions',
+        )
+
+        for index, model in enumerate(models.BaseHook.get_all_models() + [models.SystemNotification]):
+            signals.post_save.connect(
+                handlers.invalidate_hooks_routing,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_hooks_routing_{}_{}'.format(
+                    model.__name__, index),
+            )
+
+            signals.post_delete.connect(
+                handlers.invalidate_hooks_routing,
+                sender=model,
+                dispatch_uid='nodeconductor.logging.handlers.invalidate_hooks_routing_on_delete_{}_{}'.format(
+                    model.__name__, index),
+            )
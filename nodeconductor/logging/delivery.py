@@ -0,0 +1,166 @@
+""" Delivery of hooks notifications over HTTP.
+
+    Requests to the same destination reuse keep-alive connections of one session,
+    hooks are processed concurrently in pool of threads, so slow destination does not
+    delay delivery to other hooks. Requests that failed to connect are retried with exponential
+    backoff. Requests that reached destination are not retried by default, because destination
+    could have processed them already, enable RETRY_SERVER_ERRORS to retry 429 and 5xx responses.
+
+    Delivery is configured with NODECONDUCTOR['WEBHOOK_DELIVERY'] setting, for example:
+
+    .. code-block:: python
+
+        NODECONDUCTOR['WEBHOOK_DELIVERY'] = {
+            'TIMEOUT': 10,  # seconds to wait for connection and for response
+            'RETRIES': 2,  # number of retries of failed request
+            'RETRY_SERVER_ERRORS': False,  # retry request if destination responded with 429 or 5xx status
+            'BACKOFF': 0.5,  # delay before first retry, it is doubled for each next retry
+            'WORKERS': 10,  # number of threads that process hooks concurrently
+            'POOL_SIZE': 10,  # number of keep-alive connections per destination
+            'BATCH': False,  # send events of the same web hook with one POST request
+        }
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'TIMEOUT': 10,
+    'RETRIES': 2,
+    'RETRY_SERVER_ERRORS': False,
+    'BACKOFF': 0.5,
+    'WORKERS': 10,
+    'POOL_SIZE': 10,
+    'BATCH': False,
+}
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class DeliveryError(Exception):
+    pass
+
+
+def get_option(name):
+    return settings.NODECONDUCTOR.get('WEBHOOK_DELIVERY', {}).get(name, DEFAULTS[name])
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """ Return session that keeps pool of connections to destination host. """
+    parsed = urlparse.urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            pool_size = get_option('POOL_SIZE')
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('%s://' % parsed.scheme, adapter)
+            _sessions[key] = session
+        return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def post(url, **kwargs):
+    """ Send POST request using pooled session, retry it on connection errors.
+
+        Server errors are retried only if RETRY_SERVER_ERRORS option is enabled.
+        Read timeout is not retried, because request could be delivered already.
+    """
+    kwargs.setdefault('timeout', get_option('TIMEOUT'))
+    retries = get_option('RETRIES')
+    retry_status_codes = RETRY_STATUS_CODES if get_option('RETRY_SERVER_ERRORS') else ()
+    backoff = get_option('BACKOFF')
+    session = get_session(url)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = session.post(url, **kwargs)
+        except requests.ConnectionError as e:
+            # connect timeout is connection error too
+            error = e
+        except requests.Timeout as e:
+            raise DeliveryError('Unable to POST request to %s. Error: %s' % (url, e))
+        else:
+            if response.status_code not in retry_status_codes:
+                return response
+            error = DeliveryError('Destination responded with status code %s.' % response.status_code)
+        logger.debug('Attempt %s of POST request to %s has failed. Error: %s', attempt + 1, url, error)
+    raise DeliveryError('Unable to POST request to %s. Error: %s' % (url, error))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(get_option('WORKERS'))
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool = None
+
+
+def _process(args):
+    hook, events = args
+    if len(events) > 1 and get_option('BATCH'):
+        _process_safely(hook, hook.process_batch, events)
+    else:
+        for event in events:
+            _process_safely(hook, hook.process, event)
+
+
+def _process_safely(hook, method, *args):
+    try:
+        method(*args)
+    except Exception as e:
+        # Failure of one hook should not affect delivery to other hooks.
+        logger.exception('Unable to process events with hook %s (PK=%s). Error: %s', hook.__class__.__name__, hook.pk, e)
+
+
+def _process_in_thread(args):
+    try:
+        _process(args)
+    finally:
+        # Hooks could use database, connections of pool threads should not be left open.
+        connection.close()
+
+
+def dispatch(hooks_events):
+    """ Process list of (hook, events) pairs concurrently. """
+    if len(hooks_events) == 1:
+        _process(hooks_events[0])
+    elif hooks_events:
+        get_pool().map(_process_in_thread, hooks_events)
@@ -1,11 +1,22 @@
 from __future__ import unicode_literals
 
+import base64
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 
 from django.conf import settings
-from elasticsearch import Elasticsearch
+from django.core.cache import cache
+from django.utils.translation import ugettext_lazy as _
+from elasticsearch import Elasticsearch, TransportError
+from rest_framework import status
+from rest_framework.exceptions import APIException
 
 from nodeconductor.core.utils import datetime_to_timestamp
+from nodeconductor.logging.event_store import EventStoreError
 
 
 logger = logging.getLogger(__name__)
@@ -19,10 +30,15 @@ class ElasticsearchClientError(ElasticsearchError):
     pass
 
 
-class ElasticsearchResultListError(ElasticsearchError):
+class ElasticsearchResultListError(ElasticsearchError, EventStoreError):
     pass
 
 
+class ElasticsearchUnavailableError(ElasticsearchError, APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Events storage is temporarily unavailable.')
+
+
 class EmptyQueryset(object):
     def __len__(self):
         return 0
@@ -33,6 +49,12 @@ class EmptyQueryset(object):
     def __getitem__(self, key):
         return []
 
+    def get_page_after(self, cursor, size):
+        return [], 0, None
+
+    def count_history(self, points):
+        return [{'end': datetime_to_timestamp(point), 'count': 0} for point in points]
+
 
 class ElasticsearchResultList(object):
     """ List of results acceptable by django pagination """
@@ -57,11 +79,16 @@ class ElasticsearchResultList(object):
         return self
 
     def count(self):
+        if getattr(self, 'total', None) is not None:
+            return self.total
         return self.client.get_count()
 
     def aggregated_count(self, ranges):
         return self.client.get_aggregated_by_timestamp_count(ranges)
 
+    def count_history(self, points):
+        return self.client.get_count_history(points)
+
     def _get_events(self, from_, size):
         return self.client.get_events(
             from_=from_,
@@ -71,7 +98,7 @@ class ElasticsearchResultList(object):
 
     def __len__(self):
         if not hasattr(self, 'total') or self.total is None:
-            self.total = self._get_events(0, 1)['total']
+            self.total = self.client.get_count()
         return self.total
 
     def __getitem__(self, key):
@@ -85,6 +112,33 @@ class ElasticsearchResultList(object):
         self.total = events_and_total['total']
         return events_and_total['events']
 
+    def get_page_after(self, cursor, size):
+        """ Return events that follow cursor, their total number and cursor of next page.
+
+            Page is fetched with search_after on (<sort field>, _uid), so deep pages are as cheap as first one.
+            Empty cursor points to the first page. Next cursor is None if there are no more events.
+        """
+        sort = getattr(self, 'sort', '-@timestamp')
+        search_after = self._decode_cursor(cursor, sort) if cursor else None
+        result = self.client.get_events_after(sort=sort, search_after=search_after, size=size)
+        self.total = result['total']
+        next_cursor = None
+        if len(result['events']) == size and result['last_sort_values'] is not None:
+            next_cursor = self._encode_cursor(sort, result['last_sort_values'])
+        return result['events'], result['total'], next_cursor
+
+    def _encode_cursor(self, sort, search_after):
+        return base64.urlsafe_b64encode(json.dumps([sort, search_after]))
+
+    def _decode_cursor(self, cursor, sort):
+        try:
+            cursor_sort, search_after = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ElasticsearchResultListError('Cursor is not valid.')
+        if cursor_sort != sort or not isinstance(search_after, list):
+            raise ElasticsearchResultListError('Cursor does not match ordering of events.')
+        return search_after
+
 
 def _execute_if_not_empty(func):
     """ Execute function only if one of input parameters is not empty """
@@ -111,7 +165,9 @@ class ElasticsearchClient(object):
 
         @_execute_if_not_empty
         def set_should_terms(self, terms):
-            self.should_terms_filter.update({key: map(str, value) for key, value in terms.items()})
+            # None value means that field may have any value
+            self.should_terms_filter.update({
+                key: map(str, value) if value is not None else None for key, value in terms.items()})
 
         @_execute_if_not_empty
         def set_must_terms(self, terms):
@@ -167,7 +223,8 @@ class ElasticsearchClient(object):
 
             if self.should_terms_filter:
                 self['query']['bool']['should'] = [
-                    {'terms': {key: value}} for key, value in self.should_terms_filter.items()
+                    {'terms': {key: value}} if value is not None else {'exists': {'field': key}}
+                    for key, value in self.should_terms_filter.items()
                 ]
 
             if self.must_terms_filter:
@@ -216,7 +273,7 @@ class ElasticsearchClient(object):
             return '%s:("%s")' % (field_name, '", "'.join(excaped_field_values))
 
     def __init__(self):
-        self.client = self._get_client()
+        self.client = get_client()
 
     def prepare_search_body(self, should_terms=None, must_terms=None, must_not_terms=None, search_text='', start=None, end=None):
         """
@@ -244,20 +301,57 @@ class ElasticsearchClient(object):
 
     def get_events(self, sort='-@timestamp', index='_all', from_=0, size=10, start=None, end=None):
         sort = sort[1:] + ':desc' if sort.startswith('-') else sort + ':asc'
-        search_results = self.client.search(index=index, body=self.body, from_=from_, size=size, sort=sort)
+        search_results = self._request('search', index=index, body=self.body, from_=from_, size=size, sort=sort)
+        total = search_results['hits']['total']
+        self._set_cached_total(index, total)
         return {
             'events': [r['_source'] for r in search_results['hits']['hits']],
-            'total': search_results['hits']['total'],
+            'total': total,
+        }
+
+    def get_events_after(self, sort='-@timestamp', search_after=None, index='_all', size=10):
+        """ Return events that follow search_after values of sort field and _uid.
+
+            Elasticsearch 5.x does not allow to sort by _id, so _uid is used as tiebreaker.
+        """
+        field, order = (sort[1:], 'desc') if sort.startswith('-') else (sort, 'asc')
+        body = dict(self.body, sort=[{field: {'order': order}}, {'_uid': {'order': order}}])
+        if search_after is not None:
+            body['search_after'] = search_after
+        search_results = self._request('search', index=index, body=body, size=size)
+        hits = search_results['hits']['hits']
+        total = search_results['hits']['total']
+        self._set_cached_total(index, total)
+        return {
+            'events': [hit['_source'] for hit in hits],
+            'total': total,
+            'last_sort_values': hits[-1].get('sort') if hits else None,
         }
 
     def get_count(self, index='_all'):
-        count_results = self.client.count(index=index, body=self.body)
-        return count_results['count']
+        total = cache.get(self._get_total_cache_key(index))
+        if total is None:
+            total = self._request('count', index=index, body=self.body)['count']
+            self._set_cached_total(index, total)
+        return total
+
+    def _get_query_digest(self, index):
+        """ Counts of events depend only on query, so search body without aggregations is hashed. """
+        query = {key: value for key, value in self.body.items() if key != 'aggs'}
+        return hashlib.md5(json.dumps([index, query], sort_keys=True)).hexdigest()
+
+    def _get_total_cache_key(self, index):
+        return 'elasticsearch:total:%s' % self._get_query_digest(index)
+
+    def _set_cached_total(self, index, total):
+        timeout = settings.NODECONDUCTOR.get('ELASTICSEARCH', {}).get('total_cache_timeout', 30)
+        if timeout:
+            cache.set(self._get_total_cache_key(index), total, timeout)
 
     def get_aggregated_by_timestamp_count(self, ranges, index='_all'):
         self.body.set_timestamp_ranges(ranges)
         self.body.prepare()
-        search_results = self.client.search(index=index, body=self.body, search_type='count')
+        search_results = self._request('search', index=index, body=self.body, search_type='count')
         formatted_results = []
         for result in search_results['aggregations']['timestamp_ranges']['buckets']:
             formatted = {'count': result['doc_count']}
@@ -270,55 +364,280 @@ class ElasticsearchClient(object):
             formatted_results.append(formatted)
         return formatted_results
 
-    def _get_elastisearch_settings(self):
+    def get_count_history(self, points, index='_all'):
+        """ Return number of events that were created before each of points.
+
+            Number of events before past point does not change, so it is cached by query and point timestamp.
+            Only points that are later than settle time ago (events could be delivered with delay) are queried.
+            If these points are evenly spaced, counts are calculated from date histogram.
+        """
+        elasticsearch_settings = settings.NODECONDUCTOR.get('ELASTICSEARCH', {})
+        settle_time = elasticsearch_settings.get('count_history_settle_time', 60)
+        cache_timeout = elasticsearch_settings.get('count_history_cache_timeout', 24 * 60 * 60)
+
+        timestamps = [datetime_to_timestamp(point) for point in points]
+        key_prefix = 'elasticsearch:count_history:%s:' % self._get_query_digest(index)
+        cached = cache.get_many([key_prefix + str(timestamp) for timestamp in set(timestamps)])
+        counts = {int(key[len(key_prefix):]): count for key, count in cached.items()}
+
+        missing = sorted(set(timestamps) - set(counts))
+        if missing:
+            if self._are_evenly_spaced(missing):
+                fetched = self._get_counts_before_from_histogram(missing, index)
+            else:
+                fetched = self._get_counts_before_from_ranges(missing, index)
+            counts.update(fetched)
+            settled_before = time.time() - settle_time
+            cache.set_many({key_prefix + str(timestamp): count for timestamp, count in fetched.items()
+                            if timestamp < settled_before}, cache_timeout)
+
+        return [{'end': timestamp, 'count': counts[timestamp]} for timestamp in timestamps]
+
+    def _are_evenly_spaced(self, timestamps):
+        steps = {second - first for first, second in zip(timestamps, timestamps[1:])}
+        return len(timestamps) > 2 and len(steps) == 1
+
+    def _get_counts_before_from_ranges(self, timestamps, index):
+        body = dict(self.body, aggs={
+            'timestamp_ranges': {
+                'date_range': {
+                    'field': '@timestamp',
+                    'ranges': [{'to': timestamp * 1000} for timestamp in timestamps],
+                },
+            },
+        })
+        search_results = self._request('search', index=index, body=body, size=0)
+        buckets = search_results['aggregations']['timestamp_ranges']['buckets']
+        # Divide by 1000 - because elasticsearch returns timestamp in milliseconds
+        return {int(bucket['to'] / 1000): bucket['doc_count'] for bucket in buckets}
+
+    def _get_counts_before_from_histogram(self, timestamps, index):
+        first, last = timestamps[0], timestamps[-1]
+        step = timestamps[1] - first
+        body = dict(self.body, aggs={
+            'before_first_point': {
+                'date_range': {'field': '@timestamp', 'ranges': [{'to': first * 1000}]},
+            },
+            'between_points': {
+                'filter': {'range': {'@timestamp': {'gte': first * 1000, 'lt': last * 1000}}},
+                'aggs': {
+                    'timestamp_histogram': {
+                        'date_histogram': {
+                            'field': '@timestamp',
+                            'interval': '%ss' % step,
+                            'offset': '+%ss' % (first % step),
+                            'min_doc_count': 1,
+                        },
+                    },
+                },
+            },
+        })
+        aggregations = self._request('search', index=index, body=body, size=0)['aggregations']
+        histogram = {
+            int(bucket['key'] / 1000): bucket['doc_count']
+            for bucket in aggregations['between_points']['timestamp_histogram']['buckets']
+        }
+        counts = {first: aggregations['before_first_point']['buckets'][0]['doc_count']}
+        for previous, timestamp in zip(timestamps, timestamps[1:]):
+            counts[timestamp] = counts[previous] + histogram.get(previous, 0)
+        return counts
+
+    def _request(self, method, **kwargs):
+        """ Call method of shared client unless Elasticsearch is known to be down, track latency and failures. """
+        if not circuit_breaker.allow_request():
+            stats.increment('rejected')
+            raise ElasticsearchUnavailableError()
+
+        started_at = time.time()
         try:
-            elasticsearch_settings = settings.NODECONDUCTOR['ELASTICSEARCH']
-        except (KeyError, AttributeError):
-            raise ElasticsearchClientError(
-                'Can not get elasticsearch settings. ELASTICSEARCH item in settings.NODECONDUCTOR has '
-                'to be defined.')
-
-        required_configuration_fields = {'port', 'host', 'protocol'}
-        if not required_configuration_fields.issubset(elasticsearch_settings):
-            missing_fields = ','.join(required_configuration_fields - set(elasticsearch_settings))
-            raise ElasticsearchClientError(
-                'Following configuration items are missing in the "ELASTICSEARCH" section: %s' % missing_fields)
-
-        empty_fields = [field for field in required_configuration_fields if not elasticsearch_settings[field]]
-        if empty_fields:
-            raise ElasticsearchClientError(
-                'Following configuration items are empty in the "ELASTICSEARCH" section: %s' % empty_fields)
-
-        return elasticsearch_settings
-
-    def _get_client(self):
-        elasticsearch_settings = self._get_elastisearch_settings()
-        if elasticsearch_settings.get('username') and elasticsearch_settings.get('password'):
-            path = '%(protocol)s://%(username)s:%(password)s@%(host)s:%(port)s' % elasticsearch_settings
-        else:
-            path = '%(protocol)s://%(host)s:%(port)s' % elasticsearch_settings
-        client = Elasticsearch(
-            [str(path)],
-            verify_certs=elasticsearch_settings.get('verify_certs', False),
-            ca_certs=elasticsearch_settings.get('ca_certs', ''),
-        )
-        # XXX Workaround for Python Elasticsearch client bugs
-        if not elasticsearch_settings.get('verify_certs'):
-            # Some parameters are handled incorrectly if verify_certs is false
-            # Client's connection pool is the closes place we can fix this
-            connection_pool = client.transport.get_connection().pool
-            # If ca_certs is not set to 'None' explicitly it will be set to /etc/ssl/certs/ca-certificates.crt
-            # which is missing on CentOS.
-            # This bug only appears in RPM version of python-urrlib3 (v1.10.2-2 from CentOS Base):
-            # http://mirror.centos.org/centos-7/7/os/x86_64/Packages/python-urllib3-1.10.2-2.el7_1.noarch.rpm
-            # Upstream handles this situation correctly:
-            # https://github.com/shazow/urllib3/blob/1.10.2/urllib3/connectionpool.py#L674L681
-            connection_pool.ca_certs = None
-            # If verify_certs is set to False no cert_reqs parameter is passed to urrlib3.HTTPSConnectionPool:
-            # https://github.com/elastic/elasticsearch-py/blob/1.x/elasticsearch/connection/http_urllib3.py#L46L54
-            # Somehow (I couldn't understand why) if cert_reqs is not set to ssl.CERT_NONE explicitly
-            # certificate validation still happens -- and fails.
-            # To work around the issue, cert_reqs is set to ssl.CERT_NONE explicitly.
-            connection_pool.cert_reqs = 0  # ssl.CERT_NONE
-        # XXX End of workaround
-        return client
+            result = getattr(self.client, method)(**kwargs)
+        except TransportError as e:
+            stats.add_request(time.time() - started_at, failed=True)
+            # Connection errors and timeouts have status code 'N/A'.
+            if not isinstance(e.status_code, int) or e.status_code >= 500:
+                circuit_breaker.record_failure()
+                logger.warning('Elasticsearch request has failed. Error: %s', e)
+                raise ElasticsearchUnavailableError()
+            # Elasticsearch has responded, so it is available even if request is not valid.
+            circuit_breaker.record_success()
+            raise
+        except Exception:
+            # Unexpected errors are counted as failures too, otherwise trial request would never end.
+            stats.add_request(time.time() - started_at, failed=True)
+            circuit_breaker.record_failure()
+            raise
+        stats.add_request(time.time() - started_at)
+        circuit_breaker.record_success()
+        return result
+
+
+def _get_elasticsearch_settings():
+    try:
+        elasticsearch_settings = settings.NODECONDUCTOR['ELASTICSEARCH']
+    except (KeyError, AttributeError):
+        raise ElasticsearchClientError(
+            'Can not get elasticsearch settings. ELASTICSEARCH item in settings.NODECONDUCTOR has '
+            'to be defined.')
+
+    required_configuration_fields = {'port', 'host', 'protocol'}
+    if not required_configuration_fields.issubset(elasticsearch_settings):
+        missing_fields = ','.join(required_configuration_fields - set(elasticsearch_settings))
+        raise ElasticsearchClientError(
+            'Following configuration items are missing in the "ELASTICSEARCH" section: %s' % missing_fields)
+
+    empty_fields = [field for field in required_configuration_fields if not elasticsearch_settings[field]]
+    if empty_fields:
+        raise ElasticsearchClientError(
+            'Following configuration items are empty in the "ELASTICSEARCH" section: %s' % empty_fields)
+
+    return elasticsearch_settings
+
+
+def _create_client(elasticsearch_settings):
+    if elasticsearch_settings.get('username') and elasticsearch_settings.get('password'):
+        path = '%(protocol)s://%(username)s:%(password)s@%(host)s:%(port)s' % elasticsearch_settings
+    else:
+        path = '%(protocol)s://%(host)s:%(port)s' % elasticsearch_settings
+    client = Elasticsearch(
+        [str(path)],
+        verify_certs=elasticsearch_settings.get('verify_certs', False),
+        ca_certs=elasticsearch_settings.get('ca_certs', ''),
+        timeout=elasticsearch_settings.get('timeout', 10),
+        maxsize=elasticsearch_settings.get('maxsize', 10),
+    )
+    # XXX Workaround for Python Elasticsearch client bugs
+    if not elasticsearch_settings.get('verify_certs'):
+        # Some parameters are handled incorrectly if verify_certs is false
+        # Client's connection pool is the closes place we can fix this
+        connection_pool = client.transport.get_connection().pool
+        # If ca_certs is not set to 'None' explicitly it will be set to /etc/ssl/certs/ca-certificates.crt
+        # which is missing on CentOS.
+        # This bug only appears in RPM version of python-urrlib3 (v1.10.2-2 from CentOS Base):
+        # http://mirror.centos.org/centos-7/7/os/x86_64/Packages/python-urllib3-1.10.2-2.el7_1.noarch.rpm
+        # Upstream handles this situation correctly:
+        # https://github.com/shazow/urllib3/blob/1.10.2/urllib3/connectionpool.py#L674L681
+        connection_pool.ca_certs = None
+        # If verify_certs is set to False no cert_reqs parameter is passed to urrlib3.HTTPSConnectionPool:
+        # https://github.com/elastic/elasticsearch-py/blob/1.x/elasticsearch/connection/http_urllib3.py#L46L54
+        # Somehow (I couldn't understand why) if cert_reqs is not set to ssl.CERT_NONE explicitly
+        # certificate validation still happens -- and fails.
+        # To work around the issue, cert_reqs is set to ssl.CERT_NONE explicitly.
+        connection_pool.cert_reqs = 0  # ssl.CERT_NONE
+    # XXX End of workaround
+    return client
+
+
+_client = None
+_client_key = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """ Return Elasticsearch client shared by all threads of current process.
+
+        Client keeps pool of keep-alive connections, so it is created once per process
+        and is re-created only if ELASTICSEARCH settings are changed.
+    """
+    global _client, _client_key
+    elasticsearch_settings = _get_elasticsearch_settings()
+    key = (os.getpid(), sorted(elasticsearch_settings.items()))
+    with _client_lock:
+        if _client is None or _client_key != key:
+            _client = _create_client(elasticsearch_settings)
+            _client_key = key
+            circuit_breaker.reset()
+        return _client
+
+
+def reset_client():
+    global _client, _client_key
+    with _client_lock:
+        _client = _client_key = None
+        circuit_breaker.reset()
+
+
+class CircuitBreaker(object):
+    """ Reject requests for recovery_timeout seconds after failure_threshold consecutive failures.
+
+        When timeout is expired, one trial request is let through: breaker is closed
+        if it succeeds and opened again if it fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def _get_option(self, name, default):
+        return settings.NODECONDUCTOR.get('ELASTICSEARCH', {}).get(name, default)
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_in_progress:
+                return False
+            if time.time() - self.opened_at >= self._get_option('recovery_timeout', 30):
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self._get_option('failure_threshold', 5):
+                if self.opened_at is None:
+                    logger.error('Elasticsearch is unavailable, requests are rejected for %s seconds.',
+                                 self._get_option('recovery_timeout', 30))
+                self.opened_at = time.time()
+
+
+class RequestStats(object):
+    """ Counters of Elasticsearch requests of current process. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {'requests': 0, 'failures': 0, 'rejected': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+    def increment(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def add_request(self, duration, failed=False):
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['total_time'] += duration
+            self.counters['max_time'] = max(self.counters['max_time'], duration)
+            if failed:
+                self.counters['failures'] += 1
+
+    def get(self):
+        with self._lock:
+            result = dict(self.counters)
+        result['average_time'] = result['total_time'] / result['requests'] if result['requests'] else 0
+        result['circuit_open'] = circuit_breaker.is_open
+        return result
+
+
+circuit_breaker = CircuitBreaker()
+stats = RequestStats()
@@ -0,0 +1,228 @@
+""" Stores of events that are browsed via /api/events/.
+
+    Store is configured with NODECONDUCTOR['EVENTS_STORE'] setting that contains
+    import path of result list class. By default events are stored in Elasticsearch:
+
+    .. code-block:: python
+
+        NODECONDUCTOR['EVENTS_STORE'] = 'nodeconductor.logging.elasticsearch_client.ElasticsearchResultList'
+
+    Small deployments could store events in local database instead, events are written there
+    by nodeconductor.logging.log.DatabaseEventHandler outside of transaction of the caller:
+
+    .. code-block:: python
+
+        NODECONDUCTOR['EVENTS_STORE'] = 'nodeconductor.logging.event_store.DatabaseResultList'
+
+    Result list is acceptable by django pagination and supports following methods:
+     - filter(should_terms, must_terms, must_not_terms, search_text, start, end) -
+       terms are dictionaries <field>: [<value 1>, <value 2> ...], None instead of values means any value;
+     - order_by(sort);
+     - count(), __len__() and __getitem__() with slice;
+     - get_page_after(cursor, size) - returns events, total number of events and cursor of next page;
+     - count_history(points) - returns number of events created before each of points.
+
+    Database store differs from Elasticsearch in the following:
+     - search_text is matched as case insensitive substring of message and other full text
+       search fields (search_text__icontains), it is not parsed as Elasticsearch query_string,
+       so query syntax, such as AND, OR, wildcards and field names, is not supported;
+     - should_terms are enforced: event has to match at least one of them. Elasticsearch query
+       contains "must" clause, so its "should" terms are optional and only affect scoring.
+"""
+from __future__ import unicode_literals
+
+import base64
+import datetime
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Case, When, Q
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from nodeconductor.core.utils import datetime_to_timestamp
+from nodeconductor.logging import models
+
+
+class EventStoreError(Exception):
+    pass
+
+
+DEFAULT_EVENTS_STORE = 'nodeconductor.logging.elasticsearch_client.ElasticsearchResultList'
+
+
+def get_result_list():
+    """ Return empty result list of configured events store. """
+    return import_string(settings.NODECONDUCTOR.get('EVENTS_STORE', DEFAULT_EVENTS_STORE))()
+
+
+# Values of these context fields are stored as terms in addition to *_uuid fields.
+TERM_FIELDS = ('user_username', 'resource_type')
+
+
+def _is_term_field(field):
+    return field.endswith('_uuid') or field in TERM_FIELDS
+
+
+def store_event(document, timestamp):
+    """ Store event document formatted by EventFormatter, timestamp is UNIX timestamp of event creation. """
+    from nodeconductor.logging.elasticsearch_client import ElasticsearchClient
+
+    search_fields = ElasticsearchClient.SearchBody.FTS_FIELDS
+    search_text = '\n'.join(
+        '%s' % document[field] for field in search_fields if document.get(field) is not None)
+    with transaction.atomic():
+        event = models.Event.objects.create(
+            created=datetime.datetime.fromtimestamp(timestamp, timezone.utc),
+            event_type=document.get('event_type', ''),
+            search_text=search_text,
+            document=document,
+        )
+        models.EventTerm.objects.bulk_create([
+            models.EventTerm(event=event, field=field, value=value)
+            for field, value in document.items()
+            if _is_term_field(field) and isinstance(value, six.string_types) and value and len(value) <= 255
+        ])
+    return event
+
+
+class DatabaseResultList(object):
+    """ List of events stored in local database, it has the same interface as ElasticsearchResultList. """
+
+    SORT_FIELDS = {'@timestamp': 'created', 'event_type': 'event_type'}
+
+    def __init__(self):
+        self.queryset = models.Event.objects.all()
+        self.sort = '-@timestamp'
+        self.total = None
+
+    def filter(self, should_terms=None, must_terms=None, must_not_terms=None, search_text='', start=None, end=None):
+        """ Filter events, see module docstring for differences from Elasticsearch query. """
+        queryset = models.Event.objects.all()
+        if should_terms:
+            should = Q()
+            for field, values in should_terms.items():
+                should |= self._get_term_query(field, values)
+            queryset = queryset.filter(should)
+        for field, values in (must_terms or {}).items():
+            queryset = queryset.filter(self._get_term_query(field, values))
+        for field, values in (must_not_terms or {}).items():
+            queryset = queryset.exclude(self._get_term_query(field, values))
+        if search_text:
+            queryset = queryset.filter(search_text__icontains=search_text)
+        if start is not None:
+            queryset = queryset.filter(created__gte=start)
+        if end is not None:
+            queryset = queryset.filter(created__lt=end)
+        self.queryset = queryset
+        self.total = None
+        return self
+
+    def _get_term_query(self, field, values):
+        # Filters could refer to not analyzed subfield of Elasticsearch, for example, customer_uuid.keyword
+        field = field.split('.')[0]
+        if field == 'event_type':
+            return Q(event_type__in=values) if values is not None else Q()
+        terms = models.EventTerm.objects.filter(field=field)
+        if values is not None:
+            terms = terms.filter(value__in=[six.text_type(value) for value in values])
+        return Q(id__in=terms.values('event_id'))
+
+    def order_by(self, sort):
+        self.sort = sort
+        return self
+
+    def _get_ordering(self):
+        """ Return model field and whether order is descending. Unsupported fields are sorted by timestamp. """
+        descending = self.sort.startswith('-')
+        field = self.SORT_FIELDS.get(self.sort.lstrip('-'), 'created')
+        return field, descending
+
+    def _get_ordered_queryset(self):
+        field, descending = self._get_ordering()
+        prefix = '-' if descending else ''
+        return self.queryset.order_by(prefix + field, prefix + 'id')
+
+    def count(self):
+        if self.total is None:
+            self.total = self.queryset.count()
+        return self.total
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None and key.step != 1:
+                raise EventStoreError('DatabaseResultList can be iterated only with step 1')
+            events = self._get_ordered_queryset()[key]
+        else:
+            events = self._get_ordered_queryset()[key:key + 1]
+        return [event.document for event in events]
+
+    def get_page_after(self, cursor, size):
+        field, descending = self._get_ordering()
+        queryset = self._get_ordered_queryset()
+        if cursor:
+            value, pk = self._decode_cursor(cursor, field)
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{field + '__' + lookup: value}) | Q(**{field: value, 'id__' + lookup: pk}))
+
+        events = list(queryset[:size])
+        next_cursor = None
+        if len(events) == size:
+            last = events[-1]
+            next_cursor = self._encode_cursor(getattr(last, field), last.pk)
+        return [event.document for event in events], self.count(), next_cursor
+
+    def _encode_cursor(self, value, pk):
+        # DjangoJSONEncoder cuts microseconds, events of the same millisecond would be skipped or repeated.
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([self.sort, value, pk]))
+
+    def _decode_cursor(self, cursor, field):
+        try:
+            sort, value, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise EventStoreError('Cursor is not valid.')
+        if sort != self.sort:
+            raise EventStoreError('Cursor does not match ordering of events.')
+        if field == 'created':
+            value = parse_datetime(value or '')
+            if value is None:
+                raise EventStoreError('Cursor is not valid.')
+        return value, pk
+
+    def count_history(self, points):
+        aggregates = {
+            'before_%s' % index: Count(Case(When(created__lt=point, then='id')))
+            for index, point in enumerate(points)
+        }
+        counts = self.queryset.aggregate(**aggregates) if aggregates else {}
+        return [{'end': datetime_to_timestamp(point), 'count': counts['before_%s' % index]}
+                for index, point in enumerate(points)]
+
+    def aggregated_count(self, ranges):
+        aggregates = {}
+        for index, timestamp_range in enumerate(ranges):
+            conditions = {}
+            if 'start' in timestamp_range:
+                conditions['created__gte'] = timestamp_range['start']
+            if 'end' in timestamp_range:
+                conditions['created__lt'] = timestamp_range['end']
+            aggregates['range_%s' % index] = Count(Case(When(then='id', **conditions))) if conditions else Count('id')
+        counts = self.queryset.aggregate(**aggregates) if aggregates else {}
+
+        results = []
+        for index, timestamp_range in enumerate(ranges):
+            result = {'count': counts['range_%s' % index]}
+            if 'start' in timestamp_range:
+                result['start'] = datetime_to_timestamp(timestamp_range['start'])
+            if 'end' in timestamp_range:
+                result['end'] = datetime_to_timestamp(timestamp_range['end'])
+            results.append(result)
+        return results
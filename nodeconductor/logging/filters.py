@@ -130,7 +130,7 @@ class EventFilterBackend(filters.BaseFilterBackend):
             must_terms[format_raw_field('resource_uuid')] = [request.query_params['resource_uuid']]
 
         else:
-            should_terms.update(event_logger.get_permitted_objects_uuids(request.user))
+            should_terms.update(event_logger.get_permitted_scope(request.user))
 
         mapped = {
             'start': request.query_params.get('from'),
@@ -1,6 +1,9 @@
 from django.contrib.contenttypes import models as ct_models
+from django.db.models import signals
 
 from nodeconductor.logging import models
+from nodeconductor.logging import routing
+from nodeconductor.logging.loggers import invalidate_log_context
 
 
 def remove_related_alerts(sender, instance, **kwargs):
@@ -8,3 +11,21 @@ def remove_related_alerts(sender, instance, **kwargs):
     for alert in models.Alert.objects.filter(
             object_id=instance.id, content_type=content_type, closed__isnull=True).iterator():
         alert.close()
+
+
+def invalidate_cached_log_context(sender, instance, **kwargs):
+    invalidate_log_context(instance)
+
+
+def invalidate_hooks_routing(sender, instance, **kwargs):
+    routing.invalidate_routing()
+
+
+def invalidate_hooks_permissions(sender, instance, created=False, **kwargs):
+    """ Loggable object is created or deleted, so sets of objects of its model permitted to users are changed. """
+    if created or kwargs['signal'] == signals.post_delete:
+        routing.invalidate_permissions(model=sender)
+
+
+def invalidate_user_hooks_permissions(sender, instance, **kwargs):
+    routing.invalidate_permissions(user=instance)
@@ -3,10 +3,19 @@
 import json
 import datetime
 import logging
+import logging.handlers
+import os
+import Queue
+import socket
+import threading
+import time
 
 from celery import current_app
 
 
+logger = logging.getLogger(__name__)
+
+
 class EventFormatter(logging.Formatter):
 
     def format_timestamp(self, time):
@@ -25,6 +34,9 @@ class EventFormatter(logging.Formatter):
             return 'critical'
 
     def format(self, record):
+        return json.dumps(self.get_document(record))
+
+    def get_document(self, record):
         message = {
             # basic
             '@timestamp': self.format_timestamp(record.created),
@@ -44,7 +56,7 @@ class EventFormatter(logging.Formatter):
         if hasattr(record, 'event_context'):
             message.update(record.event_context)
 
-        return json.dumps(message)
+        return message
 
 
 class EventLoggerAdapter(logging.LoggerAdapter, object):
@@ -98,7 +110,283 @@ class TCPEventHandler(logging.handlers.SocketHandler, object):
         return self.formatter.format(record) + b'\n'
 
 
+class BufferedTCPEventHandler(logging.Handler, object):
+    """ Ship events to log server from background thread so that logging never blocks on network.
+
+        Formatted events are put to bounded in-memory queue, background thread sends them
+        as newline-delimited batches of at most flush_size events, at least every flush_interval seconds.
+        If log server is unavailable, batch is retried with exponential backoff.
+        If queue is full, new events are dropped or, with overflow='spill', appended to spill_filename.
+    """
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_SPILL = 'spill'
+
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, host='localhost', port=5959, queue_size=10000, flush_interval=1.0, flush_size=500,
+                 overflow=OVERFLOW_DROP, spill_filename=None, timeout=5):
+        super(BufferedTCPEventHandler, self).__init__()
+        if overflow not in (self.OVERFLOW_DROP, self.OVERFLOW_SPILL):
+            raise ValueError('Overflow policy should be "%s" or "%s".' % (self.OVERFLOW_DROP, self.OVERFLOW_SPILL))
+        if overflow == self.OVERFLOW_SPILL and not spill_filename:
+            raise ValueError('Spill filename is required for "%s" overflow policy.' % self.OVERFLOW_SPILL)
+
+        self.address = (host, int(port))
+        self.queue_size = int(queue_size)
+        self.flush_interval = float(flush_interval)
+        self.flush_size = int(flush_size)
+        self.overflow = overflow
+        self.spill_filename = spill_filename
+        self.timeout = timeout
+        self.formatter = EventFormatter()
+
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._sock = None
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._closed = threading.Event()
+
+    @property
+    def stats(self):
+        """ Counters of queued, sent, dropped and spilled events. """
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+        }
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + b'\n'
+        except Exception:
+            self.handleError(record)
+            return
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(line)
+        except Queue.Full:
+            self._overflow([line])
+
+    def _ensure_worker(self):
+        # Worker thread does not survive fork, so it is started lazily in each process.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.queue_size)
+            self._sock = None
+            self._thread = threading.Thread(target=self._run, name='BufferedTCPEventHandler')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _overflow(self, lines):
+        if self.overflow == self.OVERFLOW_SPILL:
+            try:
+                with self._spill_lock, open(self.spill_filename, 'ab') as spill_file:
+                    spill_file.writelines(lines)
+                self._count('spilled', len(lines))
+                return
+            except IOError:
+                pass
+        self._count('dropped', len(lines))
+
+    def _count(self, counter, number):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + number)
+
+    def _collect_batch(self):
+        """ Wait for first event at most flush_interval seconds, then take what is already queued. """
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        batch = []
+        retry_delay = self.flush_interval
+        while True:
+            closing = self._closed.is_set()
+            if not batch:
+                batch = self._collect_batch()
+            if not batch:
+                if closing:
+                    return
+                continue
+            try:
+                self._send(b''.join(batch))
+            except (socket.error, socket.timeout):
+                self._close_socket()
+                if closing:
+                    # Log server is unavailable, so there is no point to wait for it on shutdown.
+                    while batch:
+                        self._discard(batch)
+                        batch = self._collect_batch()
+                    return
+                self._closed.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
+            else:
+                self._count('sent', len(batch))
+                self._mark_done(batch)
+                batch = []
+                retry_delay = self.flush_interval
+
+    def _discard(self, batch):
+        self._overflow(batch)
+        self._mark_done(batch)
+
+    def _mark_done(self, batch):
+        for _ in batch:
+            self._queue.task_done()
+
+    def _send(self, data):
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address, self.timeout)
+        self._sock.sendall(data)
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def flush(self, timeout=None):
+        """ Wait until queued events are sent or timeout is expired. """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        deadline = time.time() + (timeout if timeout is not None else self.timeout)
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._closed.set()
+            self._thread.join(self.timeout + self.flush_interval)
+            self._close_socket()
+        super(BufferedTCPEventHandler, self).close()
+
+
+class DatabaseEventHandler(logging.Handler, object):
+    """ Store events in local database, so that they could be browsed without Elasticsearch.
+
+        Events are not written within transaction of the caller, so that events of HTTP request
+        or Celery task are not lost if its transaction is rolled back: they are stored when request
+        or task is finished. Other events are stored immediately or on commit of current transaction.
+    """
+
+    def __init__(self):
+        super(DatabaseEventHandler, self).__init__()
+        self.formatter = EventFormatter()
+
+    def emit(self, record):
+        if not hasattr(record, 'event_type'):
+            return
+        try:
+            # XXX: Logging is configured before applications are loaded.
+            from django.db import transaction
+
+            event = (self.formatter.get_document(record), record.created)
+            if _database_events.events is not None:
+                _database_events.events.append(event)
+            else:
+                transaction.on_commit(lambda: _store_events([event]))
+        except Exception:
+            self.handleError(record)
+
+
+class _EventsBuffer(threading.local):
+    """ Events of current HTTP request or Celery task that are not processed yet. """
+    events = None
+    depth = 0
+
+    def start(self):
+        if not self.depth:
+            self.events = []
+        self.depth += 1
+
+    def finish(self):
+        """ Return collected events if outermost request or task is finished """
+        if not self.depth:
+            return []
+        self.depth -= 1
+        if self.depth:
+            return []
+        events, self.events = self.events, None
+        return events
+
+
+_hook_events = _EventsBuffer()
+_database_events = _EventsBuffer()
+
+
+def start_events_buffering(**kwargs):
+    """ Collect events of hook and database handlers until flush_events is called.
+
+        It is called when HTTP request or Celery task is started, nested calls
+        (for example, eager task within request) are merged into outermost one.
+    """
+    _hook_events.start()
+    _database_events.start()
+
+
+def flush_events(**kwargs):
+    """ Send collected events to hooks with one task and store them in database
+        when outermost request or task is finished.
+    """
+    hook_events = _hook_events.finish()
+    if hook_events:
+        _send_hook_events(hook_events)
+    database_events = _database_events.finish()
+    if database_events:
+        _store_events(database_events)
+
+
+def _store_events(events):
+    from django.db import transaction
+    from nodeconductor.logging.event_store import store_event
+
+    try:
+        with transaction.atomic():
+            for document, timestamp in events:
+                store_event(document, timestamp)
+    except Exception:
+        logger.exception('Unable to store %s events in database.', len(events))
+
+
+def _send_hook_events(events):
+    # XXX: This import provides circular dependencies between core and
+    #      logging applications.
+    from nodeconductor.core.tasks import send_task
+    # Perform hook processing in background thread
+    send_task('logging', 'process_events')(events)
+
+
 class HookHandler(logging.Handler):
+    """ Pass events to hooks processing task.
+
+        Events of HTTP request or Celery task are sent with one task when it is finished,
+        other events are sent immediately.
+    """
+
     def emit(self, record):
         # Check that record contains event
         if hasattr(record, 'event_type') and hasattr(record, 'event_context'):
@@ -111,8 +399,7 @@ class HookHandler(logging.Handler):
                 'type': record.event_type,
                 'context': record.event_context
             }
-            # XXX: This import provides circular dependencies between core and
-            #      logging applications.
-            from nodeconductor.core.tasks import send_task
-            # Perform hook processing in background thread
-            send_task('logging', 'process_event')(event)
+            if _hook_events.events is not None:
+                _hook_events.events.append(event)
+            else:
+                _send_hook_events([event])
@@ -4,13 +4,18 @@ import uuid
 import types
 import decimal
 import datetime
+import hashlib
 import importlib
 import logging
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
 
 from django.apps import apps
 from django.contrib.contenttypes import models as ct_models
-from django.db import transaction, IntegrityError
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models as django_models, transaction, IntegrityError
 from django.utils import six
 
 from nodeconductor.logging import models
@@ -20,6 +25,9 @@ from nodeconductor.logging.middleware import get_event_context
 
 logger = logging.getLogger(__name__)
 
+LOG_CONTEXT_TIMEOUT = 60 * 60
+PERMITTED_SCOPE_TIMEOUT = 60 * 60
+
 
 class LoggerError(AttributeError):
     pass
@@ -114,7 +122,7 @@ class BaseLogger(object):
                 continue
 
             if isinstance(entity, LoggableMixin):
-                context.update(entity._get_log_context(entity_name))
+                context.update(entity.get_log_context(entity_name))
             elif isinstance(entity, (int, float, basestring, dict, tuple, list, bool)):
                 context[entity_name] = entity
             elif entity is None:
@@ -334,11 +342,50 @@ class LoggableMixin(object):
             self.__class__.__name__ + '_uuid': self.uuid.hex
         }
 
+    def get_log_context(self, entity_name):
+        """ Return serialized object for event context.
+
+            Context of saved model instance is cached. Cache key depends on instance own fields values,
+            cached context is valid until any of logged related objects is saved or deleted.
+        """
+        if not isinstance(self, django_models.Model) or self.pk is None:
+            return self._get_log_context(entity_name)
+
+        key = self._get_log_context_cache_key(entity_name)
+        cached = cache.get(key)
+        if cached is not None:
+            dependencies, versions, context = cached
+            if get_log_context_versions(dependencies) == versions:
+                _log_context_dependencies.add(dependencies)
+                return context
+
+        with _log_context_dependencies.collect() as dependencies:
+            dependencies.add(_get_log_context_object_key(self))
+            context = self._get_log_context(entity_name)
+        dependencies = tuple(sorted(dependencies))
+        _log_context_dependencies.add(dependencies)
+        cache.set(key, (dependencies, get_log_context_versions(dependencies), context), LOG_CONTEXT_TIMEOUT)
+        return context
+
+    def _get_log_context_cache_key(self, entity_name):
+        values = [getattr(self, attname) for attname in self._get_log_fields_plan().attnames]
+        fingerprint = hashlib.md5(repr(values)).hexdigest()
+        return 'log_context:%s:%s:%s' % (_get_log_context_object_key(self), entity_name, fingerprint)
+
+    def _get_log_fields_plan(self):
+        """ Precompile log fields of class once, so model fields are not introspected for each event. """
+        cls = self.__class__
+        plan = cls.__dict__.get('_log_fields_plan')
+        if plan is None:
+            plan = _LogFieldsPlan(cls, self.get_log_fields())
+            cls._log_fields_plan = plan
+        return plan
+
     def _get_log_context(self, entity_name):
 
         context = {}
-        for field in self.get_log_fields():
-            if not hasattr(self, field):
+        for field, is_model_field in self._get_log_fields_plan().fields:
+            if not is_model_field and not hasattr(self, field):
                 continue
 
             value = getattr(self, field)
@@ -347,7 +394,7 @@ class LoggableMixin(object):
             if isinstance(value, uuid.UUID):
                 context[name] = value.hex
             elif isinstance(value, LoggableMixin):
-                context.update(value._get_log_context(field))
+                context.update(value.get_log_context(field))
             elif isinstance(value, datetime.date):
                 context[name] = value.isoformat()
             elif isinstance(value, decimal.Decimal):
@@ -364,6 +411,66 @@ class LoggableMixin(object):
         return {}
 
 
+class _LogFieldsPlan(object):
+    """ Log fields of class with flags whether field is concrete model field that always exists
+        and names of model attributes that define own fields values of instance.
+    """
+
+    def __init__(self, cls, log_fields):
+        model_fields = {}
+        if issubclass(cls, django_models.Model):
+            model_fields = {f.name: f for f in cls._meta.concrete_fields}
+        self.fields = [(field, field in model_fields) for field in log_fields]
+        self.attnames = [model_fields[field].attname for field in log_fields if field in model_fields]
+        if 'modified' in model_fields and 'modified' not in log_fields:
+            self.attnames.append('modified')
+
+
+class _LogContextDependencies(threading.local):
+    """ Stack of sets of objects keys that are collected while log context is serialized. """
+
+    def __init__(self):
+        self.stack = []
+
+    @contextmanager
+    def collect(self):
+        dependencies = set()
+        self.stack.append(dependencies)
+        try:
+            yield dependencies
+        finally:
+            self.stack.pop()
+
+    def add(self, dependencies):
+        if self.stack:
+            self.stack[-1].update(dependencies)
+
+
+_log_context_dependencies = _LogContextDependencies()
+
+
+def _get_log_context_object_key(instance):
+    return '%s:%s' % (instance._meta.label, instance.pk)
+
+
+def _get_log_context_version_key(object_key):
+    return 'log_context_version:%s' % object_key
+
+
+def get_log_context_versions(dependencies):
+    keys = [_get_log_context_version_key(object_key) for object_key in dependencies]
+    versions = cache.get_many(keys)
+    return tuple(versions.get(key) for key in keys)
+
+
+def invalidate_log_context(instance):
+    """ Invalidate cached log contexts of instance and of all objects that include it in their contexts. """
+    key = _get_log_context_version_key(_get_log_context_object_key(instance))
+    cache.set(key, uuid.uuid4().hex, None)
+    # Concurrent processes could cache stale context before transaction is committed.
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+
 class BaseLoggerRegistry(object):
 
     def get_loggers(self):
@@ -411,6 +518,144 @@ class EventLoggerRegistry(BaseLoggerRegistry):
                 permitted_objects_uuids[field] = [uuid.hex for uuid in uuids]
         return permitted_objects_uuids
 
+    def get_permitted_scope(self, user):
+        """ Return permitted objects UUIDs reduced to the smallest set that matches the same events.
+
+            Object is left out if its events contain UUID of permitted logged ancestor,
+            for example, projects of customer owned by user are covered by customer UUID.
+            If staff user is permitted to see all objects of model, field is mapped to None
+            which means that any value of the field is permitted.
+
+            Scope is cached per user and model until objects of the model or of its logged
+            ancestors permitted to user could be changed.
+        """
+        from nodeconductor.logging import routing
+        from nodeconductor.logging.utils import get_loggable_models
+
+        models = get_loggable_models()
+        versions = routing.get_permissions_versions(user, models)
+        models_versions = dict(zip(models, versions[2:]))
+        key = 'events_permitted_scope:%s' % user.pk
+        cached = cache.get(key)
+        scopes = cached[1] if cached is not None and cached[0] == versions[:2] else {}
+
+        def get_dependencies_versions(model):
+            return tuple(models_versions.get(dependency) for dependency in _get_scope_dependencies(model))
+
+        stale_models = [model for model in models
+                        if scopes.get(model._meta.label_lower, (None,))[0] != get_dependencies_versions(model)]
+        if stale_models:
+            for model, model_scope in self._get_permitted_scope(user, stale_models).items():
+                scopes[model._meta.label_lower] = (get_dependencies_versions(model), model_scope)
+            cache.set(key, (versions[:2], scopes), PERMITTED_SCOPE_TIMEOUT)
+
+        scope = {}
+        for model in models:
+            scope.update(scopes[model._meta.label_lower][1])
+        return scope
+
+    def _get_permitted_scope(self, user, models):
+        """ Return dictionary that maps each of given models to its part of permitted scope. """
+        from nodeconductor.logging.utils import get_loggable_models
+
+        dependencies = set()
+        for model in models:
+            dependencies.update(_get_scope_dependencies(model))
+        permitted = {}
+        models_fields = defaultdict(list)
+        for model in get_loggable_models():
+            if model not in dependencies:
+                continue
+            for field, uuids in model.get_permitted_objects_uuids(user).items():
+                permitted[field] = (model, {uuid.hex for uuid in uuids})
+                models_fields[model].append(field)
+
+        # Staff user could see events of any object of model, so field could have any value
+        unrestricted_fields = set()
+        if user.is_staff:
+            unrestricted_fields = {field for field, (model, uuids) in permitted.items()
+                                   if uuids and len(uuids) == model.objects.count()}
+
+        scopes = {}
+        for model in models:
+            scope = scopes[model] = {}
+            for field in models_fields[model]:
+                if permitted[field][0] is not model:
+                    continue
+                uuids = permitted[field][1]
+                for ancestor_field, paths in _get_logged_ancestors_paths(model).items():
+                    if not uuids:
+                        break
+                    if ancestor_field == field or ancestor_field not in permitted:
+                        continue
+                    ancestors_uuids = None if ancestor_field in unrestricted_fields else permitted[ancestor_field][1]
+                    uuids = uuids - _get_covered_objects_uuids(model, paths, ancestors_uuids)
+                if uuids:
+                    scope[field] = None if field in unrestricted_fields else sorted(uuids)
+        return scopes
+
+
+# Number of ancestors UUIDs in one query, it is kept below SQLite limit of query parameters.
+PERMITTED_SCOPE_CHUNK_SIZE = 500
+
+
+def _get_logged_ancestors_paths(model):
+    """ Map context fields of UUIDs of logged related objects to ORM paths of these UUIDs.
+
+        Field could be serialized from several related objects, for example,
+        customer of service and customer of its settings, so each field is mapped to list of paths.
+    """
+    paths = defaultdict(list)
+    for field, path, _ in _iterate_logged_ancestors_paths(model):
+        paths[field].append(path)
+    return dict(paths)
+
+
+def _get_scope_dependencies(model):
+    """ Return model and its logged ancestors models, their permitted objects define scope of model. """
+    return [model] + sorted({related_model for _, _, related_model in _iterate_logged_ancestors_paths(model)},
+                            key=lambda related_model: related_model._meta.label_lower)
+
+
+def _iterate_logged_ancestors_paths(model, prefix='', depth=3):
+    """ Yield context field, ORM path and model of logged related objects. """
+    if depth == 0 or not issubclass(model, django_models.Model):
+        return
+    for name in model().get_log_fields():
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        related_model = field.related_model
+        if not field.many_to_one or related_model is None or not issubclass(related_model, LoggableMixin):
+            continue
+        if 'uuid' in related_model().get_log_fields():
+            yield name + '_uuid', prefix + name + '__uuid', related_model
+        for ancestor_path in _iterate_logged_ancestors_paths(related_model, prefix + name + '__', depth - 1):
+            yield ancestor_path
+
+
+def _get_covered_objects_uuids(model, paths, ancestors_uuids):
+    """ Return UUIDs of objects whose related objects on all paths are in ancestors UUIDs.
+        If ancestors UUIDs are None, any related object is accepted.
+    """
+    first_path, other_paths = paths[0], paths[1:]
+    if ancestors_uuids is None:
+        querysets = [model.objects.filter(**{first_path + '__isnull': False})]
+    else:
+        ancestors_list = list(ancestors_uuids)
+        chunks = [ancestors_list[index:index + PERMITTED_SCOPE_CHUNK_SIZE]
+                  for index in range(0, len(ancestors_list), PERMITTED_SCOPE_CHUNK_SIZE)]
+        querysets = [model.objects.filter(**{first_path + '__in': chunk}) for chunk in chunks]
+
+    covered = set()
+    for queryset in querysets:
+        for row in queryset.values_list('uuid', *other_paths):
+            if all(value is not None and (ancestors_uuids is None or value.hex in ancestors_uuids)
+                   for value in row[1:]):
+                covered.add(row[0].hex)
+    return covered
+
 
 class AlertLoggerRegistry(BaseLoggerRegistry):
 
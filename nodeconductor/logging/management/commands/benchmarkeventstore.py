@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from elasticsearch import helpers
+
+from nodeconductor.logging import elasticsearch_client
+from nodeconductor.logging.event_store import DatabaseResultList, store_event
+
+
+class Command(BaseCommand):
+    help = """ Measure ingest rate and page latency of local database events store.
+
+    With --elasticsearch option the same events are indexed to temporary index of configured
+    Elasticsearch and its page latency is measured too. Events are removed from both stores afterwards.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=1000, help='Number of events to ingest.')
+        parser.add_argument('--customers', type=int, default=10, help='Number of customers events belong to.')
+        parser.add_argument('--pages', type=int, default=20, help='Number of pages to fetch.')
+        parser.add_argument('--page-size', type=int, default=10, help='Number of events per page.')
+        parser.add_argument('--elasticsearch', action='store_true', help='Benchmark Elasticsearch as well.')
+
+    def handle(self, *args, **options):
+        customers = [uuid.uuid4().hex for _ in range(options['customers'])]
+        started_at = time.time() - options['events']
+        documents = [{
+            '@timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started_at + index)),
+            '@version': 1,
+            'message': 'Benchmark event #%s' % index,
+            'event_type': 'benchmark_event',
+            'levelname': 'INFO',
+            'customer_uuid': customers[index % len(customers)],
+        } for index in range(options['events'])]
+        should_terms = {'customer_uuid': customers[:max(1, len(customers) // 2)]}
+
+        self.benchmark_database(documents, started_at, should_terms, options)
+        if options['elasticsearch']:
+            self.benchmark_elasticsearch(documents, should_terms, options)
+
+    def benchmark_database(self, documents, started_at, should_terms, options):
+        with transaction.atomic():
+            duration = self.measure(lambda: [store_event(document, started_at + index)
+                                             for index, document in enumerate(documents)])
+            self.report_ingest('Database', len(documents), duration)
+
+            result_list = DatabaseResultList().filter(should_terms=should_terms)
+            self.report_pages('Database', options, lambda start, size: result_list[start:start + size])
+            transaction.set_rollback(True)
+
+    def benchmark_elasticsearch(self, documents, should_terms, options):
+        client = elasticsearch_client.ElasticsearchClient()
+        index = 'nodeconductor-benchmark-%s' % uuid.uuid4().hex
+        try:
+            actions = [{'_index': index, '_type': 'event', '_source': document} for document in documents]
+            duration = self.measure(lambda: helpers.bulk(client.client, actions, refresh=True))
+            self.report_ingest('Elasticsearch', len(documents), duration)
+
+            client.prepare_search_body(should_terms=should_terms)
+            self.report_pages('Elasticsearch', options,
+                              lambda start, size: client.get_events(index=index, from_=start, size=size))
+        finally:
+            client.client.indices.delete(index=index, ignore=[404])
+
+    def report_ingest(self, store, count, duration):
+        self.stdout.write('%s ingest: %s events in %.2f s, %.1f events/s' % (store, count, duration, count / duration))
+
+    def report_pages(self, store, options, get_page):
+        size = options['page_size']
+        durations = [self.measure(lambda: get_page(page * size, size)) for page in range(options['pages'])]
+        self.stdout.write('%s page latency: average %.1f ms, max %.1f ms' % (
+            store, 1000 * sum(durations) / len(durations), 1000 * max(durations)))
+
+    def measure(self, func):
+        started_at = time.time()
+        func()
+        return time.time() - started_at
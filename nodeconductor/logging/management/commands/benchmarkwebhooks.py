@@ -0,0 +1,59 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from nodeconductor.logging import delivery
+from nodeconductor.logging.models import WebHook
+from nodeconductor.logging.webhook_server import WebHookServer
+
+
+class Command(BaseCommand):
+    help = """ Measure throughput of web hooks delivery using local HTTP server as destinations.
+
+    Events are delivered sequentially, concurrently and concurrently in batches.
+    Nothing is stored in database.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destinations', type=int, default=10, help='Number of web hooks destinations.')
+        parser.add_argument('--events', type=int, default=20, help='Number of events per web hook.')
+        parser.add_argument('--delay', type=float, default=0.01, help='Response delay of destination in seconds.')
+        parser.add_argument('--workers', type=int, default=10, help='Number of delivery threads.')
+
+    def handle(self, *args, **options):
+        servers = [WebHookServer(delay=options['delay']).start() for _ in range(options['destinations'])]
+        try:
+            hooks = [WebHook(destination_url=server.url, content_type=WebHook.ContentTypeChoices.JSON)
+                     for server in servers]
+            events = [{'message': 'Event #%s' % index, 'type': 'benchmark', 'context': {}}
+                      for index in range(options['events'])]
+            total = len(hooks) * len(events)
+
+            for title, workers, batch in (('Sequential', 1, False),
+                                          ('Concurrent', options['workers'], False),
+                                          ('Concurrent batched', options['workers'], True)):
+                duration = self.measure(hooks, events, workers, batch)
+                self.stdout.write('%s delivery: %s events in %.2f s, %.1f events/s' % (
+                    title, total, duration, total / duration))
+        finally:
+            for server in servers:
+                server.stop()
+            delivery.close_sessions()
+
+    def measure(self, hooks, events, workers, batch):
+        options = {'WORKERS': workers, 'BATCH': batch, 'RETRIES': 0}
+        with override_settings(NODECONDUCTOR=dict(settings.NODECONDUCTOR, WEBHOOK_DELIVERY=options)):
+            delivery.close_pool()
+            started_at = time.time()
+            if workers == 1:
+                for hook in hooks:
+                    delivery.dispatch([(hook, events)])
+            else:
+                delivery.dispatch([(hook, events) for hook in hooks])
+            duration = time.time() - started_at
+            delivery.close_pool()
+        return duration
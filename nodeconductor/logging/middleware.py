@@ -23,7 +23,7 @@ def reset_event_context():
 
 def set_current_user(user):
     context = get_event_context() or {}
-    context.update(user._get_log_context('user'))
+    context.update(user.get_log_context('user'))
     set_event_context(context)
 
 
@@ -43,7 +43,7 @@ class CaptureEventContextMiddleware(MiddlewareMixin):
 
         user = getattr(request, 'user', None)
         if user and not user.is_anonymous:
-            context.update(user._get_log_context('user'))
+            context.update(user.get_log_context('user'))
 
         set_event_context(context)
 
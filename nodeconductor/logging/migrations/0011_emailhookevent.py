@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import nodeconductor.core.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logging', '0010_add_event_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailHookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', nodeconductor.core.fields.JSONField()),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('hook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_events', to='logging.EmailHook')),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import nodeconductor.core.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logging', '0011_emailhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True)),
+                ('event_type', models.CharField(db_index=True, max_length=100)),
+                ('search_text', models.TextField(blank=True)),
+                ('document', nodeconductor.core.fields.JSONField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=100)),
+                ('value', models.CharField(max_length=255)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='logging.Event')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='event',
+            index_together=set([('created', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='eventterm',
+            index_together=set([('field', 'value')]),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import collections
 import uuid
 import logging
 
@@ -8,17 +9,17 @@ from django.conf import settings
 from django.contrib.contenttypes import fields as ct_fields
 from django.contrib.contenttypes import models as ct_models
 from django.core import validators
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.db import models
 from django.template.loader import render_to_string
 from django.utils.lru_cache import lru_cache
 from django.utils import timezone
 from model_utils.models import TimeStampedModel
-import requests
 
 from nodeconductor.core.fields import JSONField, UUIDField
 from nodeconductor.core.utils import timestamp_to_datetime
-from nodeconductor.logging import managers
+from nodeconductor.logging import delivery, managers
 
 
 logger = logging.getLogger(__name__)
@@ -142,6 +143,11 @@ class BaseHook(EventTypesMixin, UuidMixin, TimeStampedModel):
         else:
             return self_types | set(base_types.event_types)
 
+    def process_batch(self, events):
+        """ Process several events at once. Hooks could override it to send events together. """
+        for event in events:
+            self.process(event)
+
     @classmethod
     def get_active_hooks(cls):
         return [obj for hook in cls.__subclasses__() for obj in hook.objects.filter(is_active=True)]
@@ -175,11 +181,19 @@ class WebHook(BaseHook):
 
         # encode event as JSON
         if self.content_type == WebHook.ContentTypeChoices.JSON:
-            requests.post(self.destination_url, json=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+            delivery.post(self.destination_url, json=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
 
         # encode event as form
         elif self.content_type == WebHook.ContentTypeChoices.FORM:
-            requests.post(self.destination_url, data=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+            delivery.post(self.destination_url, data=event, verify=settings.VERIFY_WEBHOOK_REQUESTS)
+
+    def process_batch(self, events):
+        """ Send JSON encoded events with one request as {"events": [<event>, ...]} """
+        if self.content_type != WebHook.ContentTypeChoices.JSON:
+            return super(WebHook, self).process_batch(events)
+
+        logger.debug('Submitting web hook to URL %s, %s events', self.destination_url, len(events))
+        delivery.post(self.destination_url, json={'events': events}, verify=settings.VERIFY_WEBHOOK_REQUESTS)
 
 
 class PushHook(BaseHook):
@@ -239,25 +253,125 @@ class PushHook(BaseHook):
         if self.type == self.Type.IOS:
             payload['content-available'] = '1'
         logger.debug('Submitting GCM push notification with headers %s, payload: %s' % (headers, payload))
-        requests.post(endpoint, json=payload, headers=headers)
+        delivery.post(endpoint, json=payload, headers=headers)
+
+
+DIGESTS_LOCK_KEY = 'logging:email_hook_digests_lock'
+DIGESTS_LOCK_TIMEOUT = 10 * 60
 
 
 class EmailHook(BaseHook):
+    """ Send events by email.
+
+        If NODECONDUCTOR['EMAIL_HOOK_DIGEST_PERIOD'] is defined, events are accumulated
+        and sent as one digest message when the oldest of them is older than period.
+    """
     email = models.EmailField(max_length=75)
 
     def process(self, event):
         if not self.email:
             logger.debug('Skipping processing of email hook (PK=%s) because email is not defined' % self.pk)
             return
-        # Prevent mutations of event because otherwise subsequent hook processors would fail
-        context = event.copy()
+        if self.is_digest_enabled():
+            EmailHookEvent.objects.create(hook=self, event=event)
+            return
+        logger.debug('Submitting email hook to %s, payload: %s', self.email, event)
+        self.get_message([event]).send()
+
+    def process_batch(self, events):
+        if not self.email:
+            logger.debug('Skipping processing of email hook (PK=%s) because email is not defined' % self.pk)
+            return
+        if self.is_digest_enabled():
+            EmailHookEvent.objects.bulk_create([EmailHookEvent(hook=self, event=event) for event in events])
+            return
+        logger.debug('Submitting email hook to %s, %s events', self.email, len(events))
+        self.get_message(events).send()
+
+    def is_digest_enabled(self):
+        return bool(settings.NODECONDUCTOR.get('EMAIL_HOOK_DIGEST_PERIOD')) and self.pk is not None
+
+    def get_message(self, events):
+        """ Render events in one email message. """
+        contexts = []
+        for event in events:
+            # Prevent mutations of event because otherwise subsequent hook processors would fail
+            context = event.copy()
+            context['timestamp'] = timestamp_to_datetime(event['timestamp'])
+            contexts.append(context)
         subject = 'Notifications from Waldur'
-        context['timestamp'] = timestamp_to_datetime(event['timestamp'])
-        text_message = context['message']
-        html_message = render_to_string('logging/email.html', {'events': [context]})
-        logger.debug('Submitting email hook to %s, payload: %s', self.email, context)
-        send_mail(subject, text_message, settings.DEFAULT_FROM_EMAIL, [self.email], html_message=html_message)
+        text_message = '\n'.join(context['message'] for context in contexts)
+        html_message = render_to_string('logging/email.html', {'events': contexts})
+        message = EmailMultiAlternatives(subject, text_message, settings.DEFAULT_FROM_EMAIL, [self.email])
+        message.attach_alternative(html_message, 'text/html')
+        return message
+
+    @classmethod
+    def send_digests(cls):
+        """ Send accumulated events of hooks that have events older than digest period.
+
+            All messages are sent using one connection to email server.
+            Digests are sent by one process at a time, so that events are not sent twice.
+        """
+        if not cache.add(DIGESTS_LOCK_KEY, True, DIGESTS_LOCK_TIMEOUT):
+            logger.debug('Email hooks digests are being sent by another process.')
+            return
+        try:
+            cls._send_digests()
+        finally:
+            cache.delete(DIGESTS_LOCK_KEY)
+
+    @classmethod
+    def _send_digests(cls):
+        period = settings.NODECONDUCTOR.get('EMAIL_HOOK_DIGEST_PERIOD')
+        pending = EmailHookEvent.objects.all()
+        if period:
+            hooks_ids = pending.filter(created__lte=timezone.now() - period).values('hook')
+            pending = pending.filter(hook__in=hooks_ids)
+
+        hooks_events = collections.OrderedDict()
+        sent_ids = []
+        for pending_event in pending.select_related('hook').order_by('hook', 'created', 'pk'):
+            hooks_events.setdefault(pending_event.hook, []).append(pending_event.event)
+            sent_ids.append(pending_event.pk)
+        if not sent_ids:
+            return
+
+        messages = [hook.get_message(events) for hook, events in hooks_events.items() if hook.email]
+        logger.debug('Submitting %s email hooks digests', len(messages))
+        get_connection().send_messages(messages)
+        EmailHookEvent.objects.filter(pk__in=sent_ids).delete()
+
+
+class EmailHookEvent(models.Model):
+    """ Event that is waiting for digest of email hook. """
+    hook = models.ForeignKey(EmailHook, related_name='pending_events')
+    event = JSONField()
+    created = models.DateTimeField(default=timezone.now, db_index=True)
 
 
 class SystemNotification(EventTypesMixin, models.Model):
     hook_content_type = models.OneToOneField(ct_models.ContentType, related_name='+')
+
+
+class Event(models.Model):
+    """ Event that is stored in local database instead of Elasticsearch. """
+
+    class Meta:
+        index_together = ('created', 'id')
+
+    created = models.DateTimeField(db_index=True)
+    event_type = models.CharField(max_length=100, db_index=True)
+    search_text = models.TextField(blank=True)
+    document = JSONField()
+
+
+class EventTerm(models.Model):
+    """ Value of event context field that events are filtered by, for example, customer_uuid. """
+
+    class Meta:
+        index_together = ('field', 'value')
+
+    event = models.ForeignKey(Event, related_name='terms', on_delete=models.CASCADE)
+    field = models.CharField(max_length=100)
+    value = models.CharField(max_length=255)
@@ -0,0 +1,219 @@
+""" Match events with hooks without database queries.
+
+    Active hooks are kept in memory of current process in index that maps event type to hooks.
+    Objects that are permitted to hooks users are kept in memory too, as sets of UUIDs.
+
+    Both structures are built lazily and are rebuilt when their version stored in Django cache
+    is changed. Versions are changed by signal handlers:
+     - routing index version - when hook or system notification is saved or deleted;
+     - model permissions version - when loggable object of the model is created or deleted,
+       only objects of this model are fetched again;
+     - user permissions version - when user is saved or role is granted to or revoked from user.
+    Permissions version invalidates objects of all models, it is not changed by handlers.
+"""
+from __future__ import unicode_literals
+
+import collections
+import threading
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes import models as ct_models
+from django.core.cache import cache
+
+
+ROUTING_VERSION_KEY = 'hooks_routing:version'
+PERMISSIONS_VERSION_KEY = 'hooks_routing:permissions_version'
+USER_PERMISSIONS_VERSION_KEY = 'hooks_routing:permissions_version:%s'
+MODEL_PERMISSIONS_VERSION_KEY = 'hooks_routing:model_permissions_version:%s'
+
+# Permitted objects of least recently used users are dropped from memory
+# if total number of kept UUIDs exceeds MAX_UUIDS.
+MAX_UUIDS = 100000
+
+
+def _get_versions(*keys):
+    """ Return versions stored in cache, initialize missing ones. """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def _change_version(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def _get_model_key(model):
+    return MODEL_PERMISSIONS_VERSION_KEY % model._meta.label_lower
+
+
+def get_permissions_versions(user, models=()):
+    """ Return versions that are changed when objects permitted to user could be changed.
+
+        The first two versions are common for all models, they are followed by versions of given models.
+    """
+    return get_users_permissions_versions([user], models)[user.pk]
+
+
+def get_users_permissions_versions(users, models=()):
+    """ Return dictionary that maps user PK to its permissions versions, they are fetched with one cache request. """
+    models_keys = [_get_model_key(model) for model in models]
+    users_keys = [USER_PERMISSIONS_VERSION_KEY % user.pk for user in users]
+    keys = [PERMISSIONS_VERSION_KEY] + models_keys + users_keys
+    versions = dict(zip(keys, _get_versions(*keys)))
+    models_versions = tuple(versions[key] for key in models_keys)
+    return {
+        user.pk: (versions[PERMISSIONS_VERSION_KEY], versions[key]) + models_versions
+        for user, key in zip(users, users_keys)
+    }
+
+
+def invalidate_routing():
+    _change_version(ROUTING_VERSION_KEY)
+
+
+def invalidate_permissions(user=None, model=None):
+    if user is not None:
+        _change_version(USER_PERMISSIONS_VERSION_KEY % user.pk)
+    elif model is not None:
+        _change_version(_get_model_key(model))
+    else:
+        _change_version(PERMISSIONS_VERSION_KEY)
+
+
+class _PermittedObjects(object):
+    """ UUIDs of objects permitted to user, grouped by model so that they are refreshed per model. """
+
+    def __init__(self, user, versions):
+        self.user = user
+        self.versions = versions
+        self.models = {}
+        self.uuids = {}
+        self.size = 0
+
+    def is_actual(self, models, versions):
+        if versions[:2] != self.versions:
+            return False
+        return all(self.models.get(model, (None,))[0] == version for model, version in zip(models, versions[2:]))
+
+    def update(self, model, version):
+        permitted = {field: frozenset(uuid.hex for uuid in uuids)
+                     for field, uuids in model.get_permitted_objects_uuids(self.user).items()}
+        self.models[model] = (version, permitted)
+        self.uuids = {}
+        for _, model_permitted in self.models.values():
+            self.uuids.update(model_permitted)
+        self.size = sum(len(uuids) for uuids in self.uuids.values())
+
+
+class HooksRouter(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._index = {}
+        self._permissions = collections.OrderedDict()
+        self._permissions_size = 0
+
+    def get_hooks(self, event_type):
+        """ Return active hooks that are subscribed to event type directly or via system notification. """
+        version, = _get_versions(ROUTING_VERSION_KEY)
+        return self._get_index(version).get(event_type, [])
+
+    def _get_index(self, version):
+        with self._lock:
+            if version != self._version:
+                self._index = self._build_index()
+                self._version = version
+            return self._index
+
+    def _build_index(self):
+        from nodeconductor.logging.models import BaseHook, SystemNotification
+
+        system_event_types = {
+            notification.hook_content_type_id: set(notification.event_types)
+            for notification in SystemNotification.objects.all()
+        }
+        index = collections.defaultdict(list)
+        for model in BaseHook.get_all_models():
+            content_type = ct_models.ContentType.objects.get_for_model(model)
+            for hook in model.objects.filter(is_active=True).select_related('user'):
+                event_types = set(hook.event_types) | system_event_types.get(content_type.id, set())
+                for event_type in event_types:
+                    index[event_type].append(hook)
+        return dict(index)
+
+    def get_permitted_objects_uuids(self, user, versions=None):
+        """ Return dictionary that maps event context field to set of UUIDs of objects permitted to user.
+
+            Versions of user permissions could be given if they are fetched for several users at once.
+        """
+        from nodeconductor.logging.utils import get_loggable_models
+
+        models = get_loggable_models()
+        if versions is None:
+            versions = get_permissions_versions(user, models)
+        with self._lock:
+            permitted = self._pop_permitted_objects(user.pk)
+            if permitted is not None and permitted.is_actual(models, versions):
+                # Objects are kept in order of usage, so user is moved to the end.
+                self._permissions[user.pk] = permitted
+                self._permissions_size += permitted.size
+                return permitted.uuids
+
+        if permitted is None or permitted.versions != versions[:2]:
+            # User of hook is fetched when routing index is built, it could be changed since then.
+            fresh_user = get_user_model().objects.filter(pk=user.pk).first()
+            if fresh_user is None:
+                return {}
+            permitted = _PermittedObjects(fresh_user, versions[:2])
+        for model, version in zip(models, versions[2:]):
+            if permitted.models.get(model, (None,))[0] != version:
+                permitted.update(model, version)
+
+        with self._lock:
+            self._pop_permitted_objects(user.pk)
+            self._permissions[user.pk] = permitted
+            self._permissions_size += permitted.size
+            while self._permissions_size > MAX_UUIDS and len(self._permissions) > 1:
+                self._pop_permitted_objects(next(iter(self._permissions)))
+        return permitted.uuids
+
+    def _pop_permitted_objects(self, user_pk):
+        permitted = self._permissions.pop(user_pk, None)
+        if permitted is not None:
+            self._permissions_size -= permitted.size
+        return permitted
+
+    def is_permitted(self, event, user, versions=None):
+        context = event['context']
+        for key, uuids in self.get_permitted_objects_uuids(user, versions).items():
+            if context.get(key) in uuids:
+                return True
+        return False
+
+    def get_matching_hooks(self, event):
+        return self.get_matching_hooks_many([event])[0]
+
+    def get_matching_hooks_many(self, events):
+        """ Return list of matching hooks for each of events.
+
+            Versions of routing index and permissions of all hooks users are fetched with two cache requests.
+        """
+        from nodeconductor.logging.utils import get_loggable_models
+
+        version, = _get_versions(ROUTING_VERSION_KEY)
+        index = self._get_index(version)
+        events_hooks = [index.get(event['type'], []) for event in events]
+        users = {hook.user for hooks in events_hooks for hook in hooks}
+        versions = get_users_permissions_versions(users, get_loggable_models())
+        return [
+            [hook for hook in hooks if self.is_permitted(event, hook.user, versions[hook.user.pk])]
+            for event, hooks in zip(events, events_hooks)
+        ]
+
+
+router = HooksRouter()
@@ -1,11 +1,14 @@
+import collections
 import logging
 
 from celery import shared_task
 from django.conf import settings
 from django.utils import timezone
 
-from nodeconductor.logging.loggers import alert_logger, event_logger
-from nodeconductor.logging.models import BaseHook, Alert, AlertThresholdMixin
+from nodeconductor.logging import delivery
+from nodeconductor.logging.loggers import alert_logger
+from nodeconductor.logging.models import Alert, AlertThresholdMixin, EmailHook
+from nodeconductor.logging.routing import router
 
 
 logger = logging.getLogger(__name__)
@@ -13,19 +16,29 @@ logger = logging.getLogger(__name__)
 
 @shared_task(name='nodeconductor.logging.process_event')
 def process_event(event):
-    for hook in BaseHook.get_active_hooks():
-        if check_event(event, hook):
-            hook.process(event)
+    process_events([event])
+
+
+@shared_task(name='nodeconductor.logging.process_events')
+def process_events(events):
+    """ Deliver events to matching hooks. Hooks are processed concurrently. """
+    hooks_events = collections.OrderedDict()
+    for event, hooks in zip(events, router.get_matching_hooks_many(events)):
+        for hook in hooks:
+            hooks_events.setdefault(hook, []).append(event)
+    delivery.dispatch(hooks_events.items())
 
 
 def check_event(event, hook):
     # Check that event matches with hook
     if event['type'] not in hook.all_event_types:
         return False
-    for key, uuids in event_logger.get_permitted_objects_uuids(hook.user).items():
-        if key in event['context'] and event['context'][key] in uuids:
-            return True
-    return False
+    return router.is_permitted(event, hook.user)
+
+
+@shared_task(name='nodeconductor.logging.send_email_hook_digests')
+def send_email_hook_digests():
+    EmailHook.send_digests()
 
 
 @shared_task(name='nodeconductor.logging.close_alerts_without_scope')
@@ -0,0 +1,85 @@
+import mock
+import requests
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from nodeconductor.logging import delivery
+from nodeconductor.logging.models import WebHook
+from nodeconductor.logging.webhook_server import WebHookServer
+
+
+def override_delivery_settings(**options):
+    options.setdefault('BACKOFF', 0)
+    return override_settings(NODECONDUCTOR=dict(settings.NODECONDUCTOR, WEBHOOK_DELIVERY=options))
+
+
+class DeliveryTest(TestCase):
+
+    def tearDown(self):
+        delivery.close_sessions()
+
+    @override_delivery_settings(RETRIES=2, RETRY_SERVER_ERRORS=True)
+    def test_request_is_retried_if_destination_fails_and_server_errors_retry_is_enabled(self):
+        with WebHookServer(failures=[503, 500]) as server:
+            delivery.post(server.url, json={'message': 'test'})
+
+        self.assertEqual(server.requests_count, 3)
+        self.assertEqual(server.payloads, [{'message': 'test'}])
+
+    @override_delivery_settings(RETRIES=2)
+    def test_request_is_not_retried_on_server_error_by_default(self):
+        with WebHookServer(failures=[503]) as server:
+            response = delivery.post(server.url, json={'message': 'test'})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(server.requests_count, 1)
+
+    @override_delivery_settings(RETRIES=1)
+    def test_request_is_retried_if_connection_fails(self):
+        with mock.patch('requests.Session.post', side_effect=requests.ConnectionError()) as post:
+            with self.assertRaises(delivery.DeliveryError):
+                delivery.post('http://example.com/', json={'message': 'test'})
+        self.assertEqual(post.call_count, 2)
+
+    @override_delivery_settings(RETRIES=1, RETRY_SERVER_ERRORS=True)
+    def test_error_is_raised_if_all_attempts_fail(self):
+        with WebHookServer(failures=[503, 503]) as server:
+            with self.assertRaises(delivery.DeliveryError):
+                delivery.post(server.url, json={'message': 'test'})
+
+    @override_delivery_settings(RETRIES=0, TIMEOUT=0.1)
+    def test_error_is_raised_if_destination_does_not_respond_in_time(self):
+        with WebHookServer(delay=0.5) as server:
+            with self.assertRaises(delivery.DeliveryError):
+                delivery.post(server.url, json={'message': 'test'})
+
+    def test_connection_is_reused_for_the_same_destination(self):
+        with WebHookServer() as server:
+            self.assertIs(delivery.get_session(server.url + 'a/'), delivery.get_session(server.url + 'b/'))
+
+
+class DispatchTest(TestCase):
+
+    def setUp(self):
+        self.events = [{'message': 'Event #%s' % index} for index in range(3)]
+
+    def tearDown(self):
+        delivery.close_pool()
+        delivery.close_sessions()
+
+    def test_events_are_delivered_to_all_hooks(self):
+        with WebHookServer() as first, WebHookServer(failures=[400]) as second, WebHookServer() as third:
+            hooks = [WebHook(destination_url=server.url) for server in (first, second, third)]
+            delivery.dispatch([(hook, self.events) for hook in hooks])
+
+        self.assertEqual(first.payloads, self.events)
+        self.assertEqual(second.payloads, self.events[1:])
+        self.assertEqual(third.payloads, self.events)
+
+    @override_delivery_settings(BATCH=True)
+    def test_events_are_sent_with_one_request_if_batching_is_enabled(self):
+        with WebHookServer() as server:
+            delivery.dispatch([(WebHook(destination_url=server.url), self.events)])
+
+        self.assertEqual(server.requests_count, 1)
+        self.assertEqual(server.payloads, [{'events': self.events}])
@@ -0,0 +1,137 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from rest_framework import status, test
+
+from nodeconductor.logging import log, models
+from nodeconductor.logging.event_store import DatabaseResultList, EventStoreError
+from nodeconductor.logging.log import DatabaseEventHandler
+from nodeconductor.logging.tests import factories
+from nodeconductor.structure.tests import factories as structure_factories
+
+
+def emit_event(handler, message, event_type='customer_update_succeeded', created=None, **context):
+    record = logging.LogRecord('test', logging.INFO, __file__, 0, message, None, None)
+    record.event_type = event_type
+    record.event_context = context
+    if created is not None:
+        record.created = created
+    handler.emit(record)
+
+
+class DatabaseResultListTest(TransactionTestCase):
+    def setUp(self):
+        self.handler = DatabaseEventHandler()
+        now = time.time()
+        emit_event(self.handler, 'Customer A updated', created=now - 30, customer_uuid='a')
+        emit_event(self.handler, 'Customer B updated', created=now - 20, customer_uuid='b')
+        emit_event(self.handler, 'Project of A created', event_type='project_creation_succeeded',
+                   created=now - 10, customer_uuid='a', project_uuid='p')
+
+    def get_messages(self, result_list):
+        return [event['message'] for event in result_list[0:10]]
+
+    def test_events_are_filtered_by_terms(self):
+        events = DatabaseResultList().filter(should_terms={'customer_uuid': ['a'], 'user_uuid': ['u']},
+                                             must_not_terms={'event_type': ['project_creation_succeeded']})
+        self.assertEqual(self.get_messages(events), ['Customer A updated'])
+
+    def test_raw_subfield_of_term_is_ignored(self):
+        events = DatabaseResultList().filter(must_terms={'project_uuid.keyword': ['p']})
+        self.assertEqual(self.get_messages(events), ['Project of A created'])
+
+    def test_none_term_matches_any_value(self):
+        events = DatabaseResultList().filter(should_terms={'project_uuid': None})
+        self.assertEqual(len(events), 1)
+
+    def test_events_are_searched_by_text(self):
+        events = DatabaseResultList().filter(search_text='customer b')
+        self.assertEqual(self.get_messages(events), ['Customer B updated'])
+
+    def test_events_are_paginated_with_cursor(self):
+        result_list = DatabaseResultList().filter()
+        events, total, cursor = result_list.get_page_after('', 2)
+        self.assertEqual([e['message'] for e in events], ['Project of A created', 'Customer B updated'])
+        self.assertEqual(total, 3)
+
+        events, total, cursor = result_list.get_page_after(cursor, 2)
+        self.assertEqual([e['message'] for e in events], ['Customer A updated'])
+        self.assertIsNone(cursor)
+
+    def test_events_of_the_same_millisecond_are_paginated_with_cursor(self):
+        models.Event.objects.all().delete()
+        created = time.time() - 60
+        for index in range(4):
+            emit_event(self.handler, 'Event #%s' % index, created=created + index * 0.0001)
+
+        for sort in ('-@timestamp', '@timestamp'):
+            result_list = DatabaseResultList().filter().order_by(sort)
+            messages, cursor = [], ''
+            for _ in range(2):
+                events, _, cursor = result_list.get_page_after(cursor, 2)
+                messages.extend(event['message'] for event in events)
+
+            self.assertEqual(sorted(messages), ['Event #%s' % index for index in range(4)])
+
+    def test_cursor_of_other_ordering_is_rejected(self):
+        _, _, cursor = DatabaseResultList().filter().get_page_after('', 1)
+        with self.assertRaises(EventStoreError):
+            DatabaseResultList().filter().order_by('@timestamp').get_page_after(cursor, 1)
+
+    def test_count_history_returns_number_of_events_before_points(self):
+        events = DatabaseResultList().filter(should_terms={'customer_uuid': ['a']})
+        first, second = models.Event.objects.order_by('created').values_list('created', flat=True)[1:]
+
+        history = events.count_history([first, second])
+
+        self.assertEqual([point['count'] for point in history], [1, 1])
+
+    def test_only_context_keys_are_stored_as_terms(self):
+        self.assertEqual(set(models.EventTerm.objects.values_list('field', flat=True)),
+                         {'customer_uuid', 'project_uuid'})
+
+
+class DatabaseEventHandlerTest(TransactionTestCase):
+    def setUp(self):
+        self.handler = DatabaseEventHandler()
+
+    def test_event_is_stored_on_commit(self):
+        with transaction.atomic():
+            emit_event(self.handler, 'Customer updated')
+            self.assertFalse(models.Event.objects.exists())
+
+        self.assertTrue(models.Event.objects.exists())
+
+    def test_events_of_task_are_stored_even_if_its_transaction_is_rolled_back(self):
+        log.start_events_buffering()
+        try:
+            with transaction.atomic():
+                emit_event(self.handler, 'Customer update failed')
+                raise ValueError()
+        except ValueError:
+            pass
+        log.flush_events()
+
+        self.assertEqual([event.document['message'] for event in models.Event.objects.all()],
+                         ['Customer update failed'])
+
+
+class DatabaseEventsStoreApiTest(test.APITransactionTestCase):
+    def test_events_are_listed_from_database_store(self):
+        customer = structure_factories.CustomerFactory()
+        owner = structure_factories.UserFactory()
+        customer.add_user(owner, 'owner')
+        emit_event(DatabaseEventHandler(), 'Visible event', customer_uuid=customer.uuid.hex)
+        emit_event(DatabaseEventHandler(), 'Invisible event', customer_uuid='other')
+
+        self.client.force_authenticate(owner)
+        nodeconductor_settings = dict(settings.NODECONDUCTOR,
+                                      EVENTS_STORE='nodeconductor.logging.event_store.DatabaseResultList')
+        with override_settings(NODECONDUCTOR=nodeconductor_settings):
+            response = self.client.get(factories.EventFactory.get_list_url())
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([event['message'] for event in response.data], ['Visible event'])
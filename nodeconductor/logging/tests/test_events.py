@@ -1,9 +1,12 @@
+import time
 import unittest
 
 import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
+from django.urls import reverse
 from rest_framework import test
 from rest_framework import status
 
@@ -11,7 +14,7 @@ from nodeconductor.structure import models as structure_models
 from nodeconductor.structure.tests import factories as structure_factories
 
 from . import factories
-from .. import utils
+from .. import elasticsearch_client, utils
 from ..loggers import EventLogger, event_logger
 
 
@@ -32,10 +35,13 @@ class BaseEventsApiTest(test.APITransactionTestCase):
     def setUp(self):
         self.es_patcher = mock.patch('nodeconductor.logging.elasticsearch_client.Elasticsearch')
         self.mocked_es = self.es_patcher.start()
+        elasticsearch_client.reset_client()
         self.mocked_es().search.return_value = {'hits': {'total': 0, 'hits': []}}
+        self.mocked_es().count.return_value = {'count': 0}
 
     def tearDown(self):
         self.es_patcher.stop()
+        elasticsearch_client.reset_client()
 
     def get_term(self, name):
         call_args = self.mocked_es().search.call_args[-1]
@@ -148,6 +154,18 @@ class EventGetTest(BaseEventsApiTest):
         return self.client.get(factories.EventFactory.get_list_url(), params)
 
 
+class PermittedScopeSearchTest(BaseEventsApiTest):
+    def test_staff_events_are_scoped_by_existence_of_customer_instead_of_all_uuids(self):
+        structure_factories.ProjectFactory()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+
+        self.client.get(factories.EventFactory.get_list_url())
+
+        should = self.mocked_es().search.call_args[1]['body']['query']['bool']['should']
+        self.assertIn({'exists': {'field': 'customer_uuid'}}, should)
+        self.assertNotIn('project_uuid', [term.get('terms', {}).keys()[0] for term in should if 'terms' in term])
+
+
 class ScopeTypeTest(BaseEventsApiTest):
     def _get_events_by_scope_type(self, model):
         url = factories.EventFactory.get_list_url()
@@ -225,3 +243,164 @@ class ScopeTest(BaseEventsApiTest):
         self.client.force_authenticate(user=owner)
         self._get_events_by_scope(structure_factories.CustomerFactory.get_url(customer))
         self.assertEqual(self.must_terms, {'customer_uuid.keyword': [customer.uuid.hex]})
+
+
+class EventCursorPaginationTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventCursorPaginationTest, self).setUp()
+        cache.clear()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = factories.EventFactory.get_list_url()
+        self.mocked_es().search.return_value = {'hits': {'total': 5, 'hits': [
+            {'_source': {'message': 'Event #1'}, 'sort': [1500000000001, 'id1']},
+            {'_source': {'message': 'Event #2'}, 'sort': [1500000000000, 'id2']},
+        ]}}
+
+    def test_first_page_is_fetched_with_single_search_without_offset(self):
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'message': 'Event #1'}, {'message': 'Event #2'}])
+        self.assertEqual(response['X-Result-Count'], '5')
+        self.assertEqual(self.mocked_es().search.call_count, 1)
+        self.assertFalse(self.mocked_es().count.called)
+        call_kwargs = self.mocked_es().search.call_args[1]
+        self.assertNotIn('from_', call_kwargs)
+        self.assertEqual(call_kwargs['body']['sort'], [{'@timestamp': {'order': 'desc'}}, {'_uid': {'order': 'desc'}}])
+        self.assertNotIn('search_after', call_kwargs['body'])
+
+    def test_next_page_is_fetched_with_search_after_values_of_last_event(self):
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 2})
+        next_url = response['Link'][1:response['Link'].index('>')]
+
+        self.client.get(next_url)
+
+        body = self.mocked_es().search.call_args[1]['body']
+        self.assertEqual(body['search_after'], [1500000000000, 'id2'])
+
+    def test_next_link_is_not_returned_for_last_page(self):
+        response = self.client.get(self.url, {'cursor': '', 'page_size': 10})
+        self.assertNotIn('Link', response)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_total_is_cached_between_pages(self):
+        self.client.get(self.url)
+        self.client.get(self.url, {'page': 2})
+
+        self.assertEqual(self.mocked_es().count.call_count, 1)
+
+
+@override_elasticsearch_settings()
+class ElasticsearchClientTest(BaseEventsApiTest):
+    def setUp(self):
+        super(ElasticsearchClientTest, self).setUp()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = factories.EventFactory.get_list_url()
+        elasticsearch_client.stats.reset()
+        elasticsearch_client.circuit_breaker.reset()
+        self.addCleanup(elasticsearch_client.circuit_breaker.reset)
+        cache.clear()
+
+    def test_client_is_shared_between_requests(self):
+        self.mocked_es.reset_mock()
+
+        self.client.get(self.url)
+        self.client.get(self.url)
+
+        self.assertEqual(self.mocked_es.call_count, 1)
+        # count of events is cached after first search
+        self.assertEqual(elasticsearch_client.stats.get()['requests'], 3)
+
+    def test_requests_are_rejected_while_elasticsearch_is_unavailable(self):
+        self.mocked_es().count.side_effect = elasticsearch_client.TransportError('N/A', 'Connection refused')
+        nodeconductor_settings = settings.NODECONDUCTOR.copy()
+        nodeconductor_settings['ELASTICSEARCH'] = dict(
+            settings.NODECONDUCTOR['ELASTICSEARCH'], failure_threshold=2, recovery_timeout=60)
+
+        with override_settings(NODECONDUCTOR=nodeconductor_settings):
+            responses = [self.client.get(self.url) for _ in range(4)]
+
+        self.assertEqual([r.status_code for r in responses], [status.HTTP_503_SERVICE_UNAVAILABLE] * 4)
+        self.assertEqual(self.mocked_es().count.call_count, 2)
+        counters = elasticsearch_client.stats.get()
+        self.assertEqual((counters['failures'], counters['rejected']), (2, 2))
+        self.assertTrue(counters['circuit_open'])
+
+    def test_trial_request_closes_circuit_after_recovery_timeout(self):
+        breaker = elasticsearch_client.circuit_breaker
+        with mock.patch.object(breaker, '_get_option', lambda name, default: 1 if name == 'failure_threshold' else 0):
+            breaker.record_failure()
+            self.assertTrue(breaker.is_open)
+
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(breaker.is_open)
+
+    def test_trial_request_is_finished_if_unexpected_error_is_raised(self):
+        breaker = elasticsearch_client.circuit_breaker
+        self.mocked_es().count.side_effect = ValueError()
+        with mock.patch.object(breaker, '_get_option', lambda name, default: 1 if name == 'failure_threshold' else 0):
+            breaker.record_failure()
+            with self.assertRaises(ValueError):
+                self.client.get(self.url)
+
+            self.assertTrue(breaker.is_open)
+            self.assertFalse(breaker.trial_in_progress)
+
+
+class EventCountHistoryTest(BaseEventsApiTest):
+    def setUp(self):
+        super(EventCountHistoryTest, self).setUp()
+        cache.clear()
+        self.client.force_authenticate(user=structure_factories.UserFactory(is_staff=True))
+        self.url = reverse('event-count-history')
+
+    def test_counts_of_evenly_spaced_points_are_calculated_from_histogram(self):
+        self.mocked_es().search.return_value = {'aggregations': {
+            'before_first_point': {'buckets': [{'doc_count': 10}]},
+            'between_points': {'timestamp_histogram': {'buckets': [
+                {'key': 1000 * 1000, 'doc_count': 3},
+                {'key': 3000 * 1000, 'doc_count': 2},
+            ]}},
+        }}
+
+        response = self.client.get(self.url, {'start': 1000, 'end': 4000, 'points_count': 4})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['object']['count'] for item in response.data], [10, 13, 13, 15])
+        histogram = self.mocked_es().search.call_args[1]['body']['aggs']['between_points']['aggs']
+        self.assertEqual(histogram['timestamp_histogram']['date_histogram']['interval'], '1000s')
+
+    def test_counts_of_past_points_are_cached(self):
+        self.mocked_es().search.return_value = {'aggregations': {'timestamp_ranges': {'buckets': [
+            {'to': 1000 * 1000, 'doc_count': 1},
+            {'to': 5000 * 1000, 'doc_count': 7},
+        ]}}}
+        self.client.get(self.url, {'point': [1000, 5000]})
+        self.mocked_es().search.reset_mock()
+
+        response = self.client.get(self.url, {'point': [1000, 5000]})
+
+        self.assertEqual([item['object']['count'] for item in response.data], [1, 7])
+        self.assertFalse(self.mocked_es().search.called)
+
+    def test_recent_points_are_not_cached(self):
+        now = int(time.time())
+        self.mocked_es().search.return_value = {'aggregations': {'timestamp_ranges': {'buckets': [
+            {'to': 1000 * 1000, 'doc_count': 1},
+            {'to': now * 1000, 'doc_count': 7},
+        ]}}}
+        self.client.get(self.url, {'point': [1000, now]})
+        self.mocked_es().search.return_value = {'aggregations': {'timestamp_ranges': {'buckets': [
+            {'to': now * 1000, 'doc_count': 8},
+        ]}}}
+
+        response = self.client.get(self.url, {'point': [1000, now]})
+
+        self.assertEqual([item['object']['count'] for item in response.data], [1, 8])
+        ranges = self.mocked_es().search.call_args[1]['body']['aggs']['timestamp_ranges']['date_range']['ranges']
+        self.assertEqual(ranges, [{'to': now * 1000}])
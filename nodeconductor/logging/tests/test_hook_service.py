@@ -1,13 +1,18 @@
 import logging
 import mock
 import time
+from datetime import timedelta
 
 from django.conf import settings
 from django.core import mail
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
 from rest_framework import test
 
-from nodeconductor.logging import models as logging_models
+from nodeconductor.logging import log, models as logging_models
 from nodeconductor.logging.log import HookHandler
+from nodeconductor.logging.routing import router
 from nodeconductor.logging.tasks import process_event
 from nodeconductor.structure import models as structure_models
 from nodeconductor.structure.log import event_logger
@@ -50,7 +55,7 @@ class TestHookService(test.APITransactionTestCase):
                                       event_type=self.event_type,
                                       event_context={'customer': self.customer})
 
-        mocked_task.assert_called_once_with('nodeconductor.logging.process_event', mock.ANY, {}, countdown=2)
+        mocked_task.assert_called_once_with('nodeconductor.logging.process_events', mock.ANY, {}, countdown=2)
         mocked_task.reset_mock()
 
         # Remove hook handler so that other tests won't depend on it
@@ -64,6 +69,28 @@ class TestHookService(test.APITransactionTestCase):
         # If hook handler is not attached hook is not processed
         self.assertFalse(mocked_task.called)
 
+    @mock.patch('celery.app.base.Celery.send_task')
+    def test_events_of_request_are_sent_with_one_task(self, mocked_task):
+        logger = logging.getLogger('nodeconductor')
+        logger.setLevel(logging.DEBUG)
+        handler = HookHandler()
+        logger.addHandler(handler)
+
+        try:
+            log.start_events_buffering()
+            for _ in range(2):
+                event_logger.customer.warning(self.message,
+                                              event_type=self.event_type,
+                                              event_context={'customer': self.customer})
+            self.assertFalse(mocked_task.called)
+            log.flush_events()
+        finally:
+            logger.removeHandler(handler)
+
+        mocked_task.assert_called_once_with('nodeconductor.logging.process_events', mock.ANY, {}, countdown=2)
+        events = mocked_task.call_args[0][1][0]
+        self.assertEqual(len(events), 2)
+
     def test_email_hook_filters_events_by_user_and_event_type(self):
         # Create email hook for customer owner
         email_hook = logging_models.EmailHook.objects.create(user=self.owner,
@@ -79,7 +106,7 @@ class TestHookService(test.APITransactionTestCase):
         # Verify that destination address of message is correct
         self.assertEqual(mail.outbox[0].to, [email_hook.email])
 
-    @mock.patch('requests.post')
+    @mock.patch('nodeconductor.logging.delivery.post')
     def test_webhook_makes_post_request_against_destination_url(self, requests_post):
 
         # Create web hook for customer owner
@@ -103,3 +130,131 @@ class TestHookService(test.APITransactionTestCase):
         # If event is not mutated, exception is not raised, see also SENTRY-1396
         email_hook.process(self.event)
         email_hook.process(self.event)
+
+
+class HooksRouterTest(test.APITransactionTestCase):
+    def setUp(self):
+        # Versions could be culled from full local memory cache, then permitted objects are recalculated.
+        cache.clear()
+        self.owner = structure_factories.UserFactory()
+        self.customer = structure_factories.CustomerFactory()
+        self.event_type = 'customer_update_succeeded'
+        self.event = {
+            'message': 'Customer has been updated.',
+            'type': self.event_type,
+            'context': event_logger.customer.compile_context(customer=self.customer),
+            'timestamp': time.time()
+        }
+        self.hook = logging_models.EmailHook.objects.create(user=self.owner,
+                                                            email=self.owner.email,
+                                                            event_types=[self.event_type])
+
+    def test_matching_hooks_are_found_without_queries(self):
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        router.get_matching_hooks(self.event)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(router.get_matching_hooks(self.event), [self.hook])
+
+    def test_permissions_versions_of_all_hooks_users_are_fetched_with_one_request(self):
+        other_owner = structure_factories.UserFactory()
+        other_hook = logging_models.EmailHook.objects.create(user=other_owner,
+                                                             email=other_owner.email,
+                                                             event_types=[self.event_type])
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        self.customer.add_user(other_owner, structure_models.CustomerRole.OWNER)
+        router.get_matching_hooks_many([self.event, self.event])
+
+        with mock.patch('nodeconductor.logging.routing.cache.get_many', wraps=cache.get_many) as get_many:
+            matching_hooks = router.get_matching_hooks_many([self.event, self.event])
+
+        self.assertEqual([set(hooks) for hooks in matching_hooks], [{self.hook, other_hook}] * 2)
+        self.assertEqual(get_many.call_count, 2)
+
+    def test_routing_is_rebuilt_if_hook_is_changed(self):
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        router.get_matching_hooks(self.event)
+
+        self.hook.event_types = ['customer_deletion_succeeded']
+        self.hook.save()
+
+        self.assertEqual(router.get_matching_hooks(self.event), [])
+
+    def test_permissions_are_recalculated_if_role_is_granted_or_revoked(self):
+        self.assertEqual(router.get_matching_hooks(self.event), [])
+
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        self.assertEqual(router.get_matching_hooks(self.event), [self.hook])
+
+        self.customer.remove_user(self.owner)
+        self.assertEqual(router.get_matching_hooks(self.event), [])
+
+    def test_permitted_objects_of_other_models_are_not_fetched_if_object_is_created(self):
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        router.get_matching_hooks(self.event)
+
+        structure_factories.ProjectFactory(customer=self.customer)
+
+        with mock.patch.object(structure_models.Customer, 'get_permitted_objects_uuids') as get_uuids:
+            self.assertEqual(router.get_matching_hooks(self.event), [self.hook])
+            self.assertFalse(get_uuids.called)
+
+    def test_permitted_objects_of_least_recently_used_users_are_dropped(self):
+        other_owner = structure_factories.UserFactory()
+        self.customer.add_user(self.owner, structure_models.CustomerRole.OWNER)
+        self.customer.add_user(other_owner, structure_models.CustomerRole.OWNER)
+
+        with mock.patch('nodeconductor.logging.routing.MAX_UUIDS', 1):
+            router.get_permitted_objects_uuids(self.owner)
+            router.get_permitted_objects_uuids(other_owner)
+
+        self.assertEqual(list(router._permissions), [other_owner.pk])
+
+
+class EmailHookDigestTest(test.APITransactionTestCase):
+    def setUp(self):
+        self.owner = structure_factories.UserFactory()
+        self.hook = logging_models.EmailHook.objects.create(user=self.owner,
+                                                            email=self.owner.email,
+                                                            event_types=['customer_update_succeeded'])
+        self.events = [{'message': 'Event #%s' % index, 'timestamp': time.time()} for index in range(3)]
+
+    def test_events_are_sent_in_one_message_if_digest_period_has_passed(self):
+        with override_settings(NODECONDUCTOR=dict(settings.NODECONDUCTOR,
+                                                  EMAIL_HOOK_DIGEST_PERIOD=timedelta(minutes=5))):
+            for event in self.events:
+                self.hook.process(event)
+
+            logging_models.EmailHook.send_digests()
+            self.assertEqual(len(mail.outbox), 0)
+
+            self.hook.pending_events.update(created=timezone.now() - timedelta(minutes=10))
+            logging_models.EmailHook.send_digests()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].body, 'Event #0\nEvent #1\nEvent #2')
+        self.assertFalse(self.hook.pending_events.exists())
+
+    def test_batch_of_events_is_accumulated_for_digest(self):
+        with override_settings(NODECONDUCTOR=dict(settings.NODECONDUCTOR,
+                                                  EMAIL_HOOK_DIGEST_PERIOD=timedelta(minutes=5))):
+            self.hook.process_batch(self.events)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.hook.pending_events.count(), 3)
+
+    def test_digests_are_not_sent_if_they_are_being_sent_by_another_process(self):
+        logging_models.EmailHookEvent.objects.create(hook=self.hook, event=self.events[0])
+        cache.add(logging_models.DIGESTS_LOCK_KEY, True)
+        self.addCleanup(cache.delete, logging_models.DIGESTS_LOCK_KEY)
+
+        logging_models.EmailHook.send_digests()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(self.hook.pending_events.exists())
+
+    def test_batch_of_events_is_sent_in_one_message(self):
+        self.hook.process_batch(self.events)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.hook.email])
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.test import TestCase
+
+from nodeconductor.logging.log import BufferedTCPEventHandler
+
+
+class LogServer(object):
+    """ Accept TCP connections and collect received lines. """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.lines = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except socket.error:
+                return
+            data = b''
+            while True:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            connection.close()
+            self.lines.extend(data.splitlines())
+
+    def wait_for_lines(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.lines) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def stop(self):
+        self.sock.close()
+
+
+class BufferedTCPEventHandlerTest(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('buffered_tcp_event_handler_test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def get_handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 0.05)
+        handler = BufferedTCPEventHandler(**kwargs)
+        self.logger.addHandler(handler)
+        self.handlers.append(handler)
+        return handler
+
+    def test_events_are_sent_as_newline_delimited_json(self):
+        server = LogServer()
+        handler = self.get_handler(port=server.port)
+
+        for index in range(5):
+            self.logger.info('Event #%s', index, extra={'event_type': 'test_event'})
+        handler.flush(timeout=5)
+        handler.close()  # server reads lines until connection is closed
+        server.wait_for_lines(5)
+        server.stop()
+
+        messages = [json.loads(line)['message'] for line in server.lines]
+        self.assertEqual(messages, ['Event #%s' % index for index in range(5)])
+        self.assertEqual(handler.stats, {'queued': 0, 'sent': 5, 'dropped': 0, 'spilled': 0})
+
+    def test_logging_does_not_block_if_log_server_is_unavailable(self):
+        server = LogServer()
+        server.stop()  # port is not listened anymore
+        handler = self.get_handler(port=server.port, queue_size=3, flush_size=1, timeout=0.1)
+        handler._closed.wait = lambda timeout: None  # do not wait between retries in test
+
+        for index in range(10):
+            self.logger.info('Event #%s', index)
+
+        stats = handler.stats
+        self.assertEqual(stats['sent'], 0)
+        self.assertGreaterEqual(stats['dropped'], 6)
+
+    def test_overflowed_events_are_spilled_to_file(self):
+        server = LogServer()
+        server.stop()
+        spill_file = tempfile.NamedTemporaryFile(delete=False)
+        spill_file.close()
+        self.addCleanup(os.remove, spill_file.name)
+        handler = self.get_handler(port=server.port, queue_size=1, timeout=0.1,
+                                   overflow=BufferedTCPEventHandler.OVERFLOW_SPILL, spill_filename=spill_file.name)
+
+        for index in range(5):
+            self.logger.info('Event #%s', index)
+        handler.close()
+
+        with open(spill_file.name) as spill:
+            messages = [json.loads(line)['message'] for line in spill]
+        self.assertEqual(sorted(messages), ['Event #%s' % index for index in range(5)])
+        self.assertEqual(handler.stats['spilled'], 5)
+        self.assertEqual(handler.stats['dropped'], 0)
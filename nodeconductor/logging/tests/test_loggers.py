@@ -0,0 +1,98 @@
+import mock
+from django.core.cache import cache
+from django.test import TransactionTestCase
+
+from nodeconductor.core.models import User
+from nodeconductor.logging.loggers import event_logger
+from nodeconductor.structure.models import CustomerRole, Project, ProjectRole
+from nodeconductor.structure.tests import factories as structure_factories
+
+
+class LogContextCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        self.project = structure_factories.ProjectFactory()
+
+    def get_project(self):
+        # fresh instance does not have cached customer
+        return Project.objects.get(pk=self.project.pk)
+
+    def test_cached_context_is_returned_without_queries(self):
+        context = self.get_project().get_log_context('project')
+        project = self.get_project()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(project.get_log_context('project'), context)
+
+    def test_context_is_invalidated_if_ancestor_is_saved(self):
+        self.get_project().get_log_context('project')
+        customer = self.project.customer
+        customer.name = 'New customer name'
+        customer.save()
+
+        context = self.get_project().get_log_context('project')
+
+        self.assertEqual(context['customer_name'], 'New customer name')
+
+    def test_context_is_not_taken_from_cache_if_own_field_is_changed(self):
+        self.get_project().get_log_context('project')
+        project = self.get_project()
+        project.name = 'New project name'
+
+        self.assertEqual(project.get_log_context('project')['project_name'], 'New project name')
+
+
+class PermittedScopeTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.project = structure_factories.ProjectFactory()
+        self.customer = self.project.customer
+        self.user = structure_factories.UserFactory()
+
+    def test_projects_of_owned_customer_are_covered_by_customer(self):
+        structure_factories.ProjectFactory(customer=self.customer)
+        self.customer.add_user(self.user, CustomerRole.OWNER)
+
+        scope = event_logger.get_permitted_scope(self.user)
+
+        self.assertEqual(scope['customer_uuid'], [self.customer.uuid.hex])
+        self.assertNotIn('project_uuid', scope)
+        self.assertEqual(scope['user_uuid'], [self.user.uuid.hex])
+
+    def test_project_role_is_scoped_by_project(self):
+        self.project.add_user(self.user, ProjectRole.ADMINISTRATOR)
+
+        scope = event_logger.get_permitted_scope(self.user)
+
+        self.assertEqual(scope['project_uuid'], [self.project.uuid.hex])
+        self.assertNotIn('customer_uuid', scope)
+
+    def test_staff_is_permitted_to_see_any_customer(self):
+        staff = structure_factories.UserFactory(is_staff=True)
+
+        scope = event_logger.get_permitted_scope(staff)
+
+        self.assertIsNone(scope['customer_uuid'])
+        self.assertIsNone(scope['user_uuid'])
+        self.assertNotIn('project_uuid', scope)
+
+    def test_scope_is_cached_until_role_is_granted(self):
+        event_logger.get_permitted_scope(self.user)
+        with self.assertNumQueries(0):
+            event_logger.get_permitted_scope(self.user)
+
+        self.project.add_user(self.user, ProjectRole.ADMINISTRATOR)
+
+        self.assertEqual(event_logger.get_permitted_scope(self.user)['project_uuid'], [self.project.uuid.hex])
+
+    def test_scope_of_other_models_is_not_recalculated_if_object_is_created(self):
+        self.customer.add_user(self.user, CustomerRole.OWNER)
+        event_logger.get_permitted_scope(self.user)
+
+        structure_factories.ProjectFactory(customer=self.customer)
+
+        with mock.patch.object(User, 'get_permitted_objects_uuids') as get_uuids:
+            scope = event_logger.get_permitted_scope(self.user)
+            self.assertFalse(get_uuids.called)
+        self.assertEqual(scope['customer_uuid'], [self.customer.uuid.hex])
@@ -2,13 +2,15 @@ from __future__ import unicode_literals
 
 from django.core.exceptions import PermissionDenied
 from django.db.models import Count
+from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import response, viewsets, permissions, status, decorators, mixins
+from rest_framework import response, viewsets, permissions, status, decorators, mixins, exceptions
+from rest_framework.utils.urls import replace_query_param
 
 from nodeconductor.core import serializers as core_serializers, filters as core_filters, permissions as core_permissions
 from nodeconductor.core.managers import SummaryQuerySet
-from nodeconductor.logging import elasticsearch_client, models, serializers, filters, utils
+from nodeconductor.logging import event_store, models, serializers, filters, utils
 from nodeconductor.logging.loggers import get_event_groups, get_alert_groups, event_logger
 
 
@@ -18,7 +20,7 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     serializer_class = serializers.EventSerializer
 
     def get_queryset(self):
-        return elasticsearch_client.ElasticsearchResultList()
+        return event_store.get_result_list()
 
     def list(self, request, *args, **kwargs):
         """
@@ -28,6 +30,10 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         Sorting is supported in ascending and descending order by specifying a field to an **?o=** parameter. By default
         events are sorted by @timestamp in descending order.
 
+        Deep pages are expensive with page numbers, so events could be paginated with cursor instead.
+        Pass empty **?cursor=** parameter to get the first page, link to the next page is returned
+        in Link header with rel="next". Total number of events is returned in X-Result-Count header.
+
         Run POST against */api/events/* to create an event. Only users with staff privileges can create events.
         New event will be emitted with `custom_notification` event type.
         Request should contain following fields:
@@ -54,11 +60,28 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         """
         self.queryset = self.filter_queryset(self.get_queryset())
 
+        if 'cursor' in request.query_params and self.paginator is not None:
+            return self.get_cursor_paginated_response(self.queryset)
+
         page = self.paginate_queryset(self.queryset)
         if page is not None:
             return self.get_paginated_response(page)
         return response.Response(self.queryset)
 
+    def get_cursor_paginated_response(self, queryset):
+        cursor = self.request.query_params['cursor']
+        size = self.paginator.get_page_size(self.request)
+        try:
+            events, total, next_cursor = queryset.get_page_after(cursor, size)
+        except event_store.EventStoreError as e:
+            raise exceptions.ValidationError({'cursor': six.text_type(e)})
+
+        headers = {'X-Result-Count': total}
+        if next_cursor:
+            url = replace_query_param(self.request.build_absolute_uri(), 'cursor', next_cursor)
+            headers['Link'] = '<%s>; rel="next"' % url
+        return response.Response(events, headers=headers)
+
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
@@ -121,11 +144,10 @@ class EventViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         serializer = core_serializers.HistorySerializer(data={k: v for k, v in mapped.items() if v})
         serializer.is_valid(raise_exception=True)
 
-        timestamp_ranges = [{'end': point_date} for point_date in serializer.get_filter_data()]
-        aggregated_count = queryset.aggregated_count(timestamp_ranges)
+        count_history = queryset.count_history(serializer.get_filter_data())
 
         return response.Response(
-            [{'point': int(ac['end']), 'object': {'count': ac['count']}} for ac in aggregated_count],
+            [{'point': int(ch['end']), 'object': {'count': ch['count']}} for ch in count_history],
             status=status.HTTP_200_OK)
 
     @decorators.list_route()
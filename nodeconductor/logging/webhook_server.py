@@ -0,0 +1,86 @@
+""" Local HTTP server that stands in for web hooks destinations in benchmarks and tests. """
+from __future__ import unicode_literals
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        with server.lock:
+            server.requests_count += 1
+            status = server.failures.pop(0) if server.failures else 200
+            if status == 200:
+                try:
+                    server.payloads.append(json.loads(body))
+                except ValueError:
+                    server.payloads.append(body)
+        if server.delay:
+            time.sleep(server.delay)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Client could close connection before response, for example on timeout.
+        pass
+
+
+class WebHookServer(object):
+    """ Record payloads of POST requests.
+
+        delay - seconds to wait before response;
+        failures - list of status codes that are returned for first requests.
+
+    .. code-block:: python
+        with WebHookServer(failures=[503]) as server:
+            delivery.post(server.url, json={'message': 'test'})
+            assert server.payloads == [{'message': 'test'}]
+    """
+
+    def __init__(self, delay=0, failures=None):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.delay = delay
+        self.server.failures = list(failures or [])
+        self.server.payloads = []
+        self.server.requests_count = 0
+        self.server.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+    @property
+    def payloads(self):
+        return self.server.payloads
+
+    @property
+    def requests_count(self):
+        return self.server.requests_count
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
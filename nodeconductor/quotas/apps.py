@@ -54,12 +54,20 @@ class QuotasConfig(AppConfig):
                 self.register_counter_field_signals(model, counter_field)
 
         # Aggregator quotas signals
+        utils.build_aggregators_index()
+
         signals.post_save.connect(
             handlers.handle_aggregated_quotas,
             sender=Quota,
             dispatch_uid='nodeconductor.quotas.handle_aggregated_quotas_post_save',
         )
 
+        signals.post_save.connect(
+            handlers.create_quota_sample,
+            sender=Quota,
+            dispatch_uid='nodeconductor.quotas.create_quota_sample',
+        )
+
         signals.pre_delete.connect(
             handlers.handle_aggregated_quotas,
             sender=Quota,
@@ -38,10 +38,10 @@ class QuotaLimitField(models.IntegerField):
         def func(instance, quota_field=self._quota_field):
             if instance is None:
                 raise AttributeError("Can only be accessed via instance")
-            try:
-                return instance.quotas.get(name=quota_field).limit
-            except instance.quotas.model.DoesNotExist:
+            quota = instance.get_quotas_map().get(quota_field.name)
+            if quota is None:
                 return quota_field.default_limit
+            return quota.limit
         return func
 
     def _set_func(self):
@@ -59,7 +59,12 @@ class FieldsContainerMeta(type):
         Quotas fields should be located in class with FieldsContainerMeta metaclass.
         Example:
             example_quota = QuotaField()  # this quota field will have name 'example_quota'
+
+        Version is increased whenever quota field is added to container in runtime,
+        so models could invalidate their cached quota fields.
     """
+    version = 0
+
     def __new__(self, name, bases, attrs):
         for key in attrs:
             if isinstance(attrs[key], QuotaField):
@@ -179,6 +184,44 @@ class CounterQuotaField(QuotaField):
         current_usage = self.get_current_usage(self.target_models, scope)
         scope.set_quota_usage(self.name, current_usage)
 
+    def get_current_usages(self, scope_model):
+        """ Return dictionary that maps scope ID to current usage for all scopes of given model.
+
+            Usages are counted with one GROUP BY query per target model.
+            Scopes without target instances are not present in result.
+        """
+        if self._raw_get_current_usage is not None:
+            return {scope.pk: self._raw_get_current_usage(self.target_models, scope)
+                    for scope in scope_model.objects.all()}
+
+        usages = {}
+        for model in self.target_models:
+            lookup = self._get_scope_lookup(model)
+            rows = (model.objects
+                    .filter(**{lookup + '__isnull': False})
+                    .values(lookup)
+                    .annotate(count=models.Count('pk'))
+                    .order_by())
+            for row in rows:
+                usages[row[lookup]] = usages.get(row[lookup], 0) + row['count']
+        return usages
+
+    def _get_scope_lookup(self, model):
+        """ Convert path to scope to lookup that could be used in values() query.
+
+            Structure querysets allow to filter by "customer" and "project" even if model does not
+            have such fields, path to them is defined in Permissions class of model.
+        """
+        lookup = self.path_to_scope.replace('.', '__')
+        name, _, rest = lookup.partition('__')
+        if name in [f.name for f in model._meta.get_fields()]:
+            return lookup
+        permissions_path = getattr(getattr(model, 'Permissions', None), '%s_path' % name, None)
+        if permissions_path is None:
+            return lookup
+        lookup = 'pk' if permissions_path == 'self' else permissions_path
+        return lookup + '__' + rest if rest else lookup
+
     def add_usage(self, target_instance, delta, fail_silently=False):
         scope = self._get_scope(target_instance)
         if self.is_connected_to_scope(scope):
@@ -218,22 +261,24 @@ class AggregatorQuotaField(QuotaField):
         scope.set_quota_usage(self.name, current_usage)
 
     def post_child_quota_save(self, scope, child_quota, created=False):
-        quota = scope.quotas.get(name=self.name)
         current_value = getattr(child_quota, self.aggregation_field)
         if created:
             diff = current_value
         else:
             diff = current_value - child_quota.tracker.previous(self.aggregation_field)
         if diff:
-            quota.usage += diff
-            quota.save()
+            self._add_usage_on_commit(scope, diff)
 
     def pre_child_quota_delete(self, scope, child_quota):
-        quota = scope.quotas.get(name=self.name)
         diff = getattr(child_quota, self.aggregation_field)
         if diff:
-            quota.usage -= diff
-            quota.save()
+            self._add_usage_on_commit(scope, -diff)
+
+    def _add_usage_on_commit(self, scope, delta):
+        # Deltas of all children are summed and applied to aggregator quota once per transaction.
+        from nodeconductor.quotas.models import add_usage_on_commit
+        if self.is_connected_to_scope(scope):
+            add_usage_on_commit(scope, self.name, delta)
 
 
 class UsageAggregatorQuotaField(AggregatorQuotaField):
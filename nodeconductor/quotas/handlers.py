@@ -1,3 +1,4 @@
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 from django.db.models import signals
 
@@ -65,19 +66,45 @@ def count_quota_handler_factory(count_quota_field):
 
 
 def handle_aggregated_quotas(sender, instance, **kwargs):
-    """ Call aggregated quotas fields update methods """
+    """ Call aggregated quotas fields update methods.
+
+        Aggregator quotas are looked up in precompiled index, so scope of quota
+        is fetched only if quota is aggregated by any model.
+        Aggregator quotas usages are updated on transaction commit.
+    """
     quota = instance
+    # usage of aggregator quotas was already updated by QuotaModelMixin.validate_and_reserve
+    if getattr(quota, '_skip_aggregation', False):
+        return
+    aggregators = utils.get_aggregators(quota.name)
     # aggregation is not supported for global quotas.
-    if quota.scope is None:
+    if not aggregators or quota.content_type_id is None:
+        return
+    scope_model = ContentType.objects.get_for_id(quota.content_type_id).model_class()
+    if scope_model is None or not issubclass(scope_model, models.QuotaModelMixin):
         return
-    quota_field = quota.get_field()
+    quota_field = next((f for f in scope_model.get_quotas_fields() if f.name == quota.name), None)
     # usage aggregation should not count another usage aggregator field to avoid calls duplication.
     if isinstance(quota_field, fields.UsageAggregatorQuotaField) or quota_field is None:
         return
+    scope = quota.scope
+    if scope is None:
+        return
     signal = kwargs['signal']
-    for aggregator_quota in quota_field.get_aggregator_quotas(quota):
-        field = aggregator_quota.get_field()
-        if signal == signals.post_save:
-            field.post_child_quota_save(aggregator_quota.scope, child_quota=quota, created=kwargs.get('created'))
-        elif signal == signals.pre_delete:
-            field.pre_child_quota_delete(aggregator_quota.scope, child_quota=quota)
+    for ancestor in scope.get_quota_ancestors():
+        for model, field in aggregators:
+            if not isinstance(ancestor, model):
+                continue
+            if signal == signals.post_save:
+                field.post_child_quota_save(ancestor, child_quota=quota, created=kwargs.get('created'))
+            elif signal == signals.pre_delete:
+                field.pre_child_quota_delete(ancestor, child_quota=quota)
+
+
+def create_quota_sample(sender, instance, created=False, raw=False, **kwargs):
+    """ Store quota sample if quota is created or its limit or usage is changed """
+    if raw:
+        return
+    quota = instance
+    if created or quota.tracker.has_changed('usage') or quota.tracker.has_changed('limit'):
+        models.QuotaSample.objects.create(quota=quota, limit=quota.limit, usage=quota.usage)
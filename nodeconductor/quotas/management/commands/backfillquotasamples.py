@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+from reversion.models import Version
+
+from nodeconductor.quotas import models
+
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = """ Convert quotas versions to quotas samples.
+
+    Only versions that are older than the earliest sample of quota are converted,
+    so command could be executed several times. Consecutive versions with equal
+    limit and usage are stored as one sample.
+    """
+
+    def handle(self, *args, **options):
+        self.stdout.write('Collecting earliest quotas samples...')
+        earliest_samples = dict(models.QuotaSample.objects.values('quota').annotate(
+            timestamp=Min('timestamp')).values_list('quota', 'timestamp'))
+        quotas_ids = set(models.Quota.objects.values_list('id', flat=True))
+        self.stdout.write('...done')
+
+        self.stdout.write('Converting quotas versions...')
+        versions = (Version.objects.get_for_model(models.Quota)
+                    .order_by('object_id', 'revision__date_created', 'pk')
+                    .values_list('object_id', 'revision__date_created', 'format', 'serialized_data'))
+
+        samples, count, previous = [], 0, None
+        for object_id, timestamp, format, serialized_data in versions.iterator():
+            quota_id = int(object_id)
+            if quota_id not in quotas_ids or format != 'json':
+                continue
+            if quota_id in earliest_samples and timestamp >= earliest_samples[quota_id]:
+                continue
+            fields = json.loads(serialized_data)[0]['fields']
+            value = (quota_id, fields['limit'], fields['usage'])
+            if value == previous:
+                continue
+            previous = value
+            samples.append(models.QuotaSample(
+                quota_id=quota_id, timestamp=timestamp, limit=fields['limit'], usage=fields['usage']))
+            if len(samples) >= BATCH_SIZE:
+                models.QuotaSample.objects.bulk_create(samples)
+                count += len(samples)
+                samples = []
+
+        models.QuotaSample.objects.bulk_create(samples)
+        count += len(samples)
+        self.stdout.write('...done. %s quotas samples were created.' % count)
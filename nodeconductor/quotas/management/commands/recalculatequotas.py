@@ -1,42 +1,219 @@
 from __future__ import unicode_literals
 
+import collections
+import multiprocessing
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connections, transaction
 
 from nodeconductor.quotas import models, fields, exceptions
 from nodeconductor.quotas.utils import get_models_with_quotas
 
 
+# Change of quota usage that is detected by recalculation.
+Change = collections.namedtuple('Change', ('quota_id', 'model', 'object_id', 'name', 'old_usage', 'new_usage'))
+
+UPDATE_CHUNK_SIZE = 500
+
+
+def get_changes(model, quota_name, usages, default_usage=0, is_connected_to_scope=None):
+    """ Compare current usages of model quotas with given {scope ID: usage} dictionary. """
+    content_type = ContentType.objects.get_for_model(model)
+    quotas = models.Quota.objects.filter(content_type=content_type, name=quota_name)
+    changes = []
+    for quota_id, object_id, usage in quotas.values_list('id', 'object_id', 'usage').iterator():
+        if is_connected_to_scope is not None and object_id not in is_connected_to_scope:
+            continue
+        new_usage = usages.get(object_id, default_usage)
+        if usage != new_usage:
+            changes.append(Change(quota_id, model._meta.label, object_id, quota_name, usage, new_usage))
+    return changes
+
+
+def apply_changes(changes):
+    """ Update changed quotas only, with one UPDATE per distinct usage value.
+
+        Quotas are updated without post_save signals, so aggregator quotas have to be
+        recalculated after their children and quotas samples are stored explicitly.
+    """
+    quotas_ids = collections.defaultdict(list)
+    for change in changes:
+        quotas_ids[change.new_usage].append(change.quota_id)
+    with transaction.atomic():
+        for usage, ids in quotas_ids.items():
+            for index in range(0, len(ids), UPDATE_CHUNK_SIZE):
+                chunk = ids[index:index + UPDATE_CHUNK_SIZE]
+                models.Quota.objects.filter(id__in=chunk).update(usage=usage)
+                models.QuotaSample.create_samples(chunk)
+
+
+def get_connected_scopes_ids(model, field):
+    if field.creation_condition is None:
+        return None
+    return {scope.pk for scope in model.objects.all() if field.is_connected_to_scope(scope)}
+
+
+def recalculate_counter_quotas(model_label, dry_run=False):
+    """ Recalculate all counter quotas of model. Return list of changes. """
+    model = apps.get_model(model_label)
+    changes = []
+    for field in model.get_quotas_fields(field_class=fields.CounterQuotaField):
+        usages = field.get_current_usages(model)
+        changes += get_changes(model, field.name, usages, is_connected_to_scope=get_connected_scopes_ids(model, field))
+    if not dry_run:
+        apply_changes(changes)
+    return changes
+
+
+def _recalculate_counter_quotas_worker(args):
+    return recalculate_counter_quotas(*args)
+
+
+def get_child_model(model, field):
+    """ Detect model of aggregated children using first scope of model. Return None if it is unknown. """
+    for scope in model.objects.all()[:1]:
+        children = field.get_children(scope)
+        if hasattr(children, 'model'):
+            return children.model
+        for child in children:
+            return child._meta.model
+
+
+def get_aggregators_in_order():
+    """ Return list of (model, aggregator field) pairs sorted topologically: children go before parents. """
+    nodes = collections.OrderedDict()
+    for model in get_models_with_quotas():
+        for field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
+            nodes[(model, field.name)] = field
+
+    dependencies = {}
+    for (model, name), field in nodes.items():
+        child_node = (get_child_model(model, field), field.get_child_quota_name())
+        dependencies[(model, name)] = {child_node} if child_node in nodes else set()
+
+    ordered = []
+    while dependencies:
+        ready = [node for node, node_dependencies in dependencies.items() if not node_dependencies]
+        if not ready:
+            # Cyclic aggregation, recalculate remaining quotas in order of declaration.
+            ready = [node for node in nodes if node in dependencies]
+        for node in ready:
+            del dependencies[node]
+            ordered.append((node[0], nodes[node]))
+        for node_dependencies in dependencies.values():
+            node_dependencies.difference_update(ready)
+    return ordered
+
+
+def recalculate_aggregator_quotas(model, field, overrides, dry_run=False):
+    """ Recalculate aggregator quotas of model.
+
+        Usages that were changed by recalculation but are not stored yet (on dry run)
+        are taken from `overrides` dictionary {(model label, object ID, quota name): usage}.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    quotas = models.Quota.objects.filter(content_type=content_type, name=field.name)
+    child_quota_name = field.get_child_quota_name()
+
+    usages = {}
+    for scope in model.objects.filter(pk__in=quotas.values('object_id')).iterator():
+        if not field.is_connected_to_scope(scope):
+            continue
+        children = field.get_children(scope)
+        if hasattr(children, 'values'):
+            children_ids, child_model = children.values('pk'), children.model
+        else:
+            children = list(children)
+            if not children:
+                usages[scope.pk] = 0
+                continue
+            children_ids, child_model = [child.pk for child in children], children[0]._meta.model
+        child_quotas = models.Quota.objects.filter(
+            content_type=ContentType.objects.get_for_model(child_model),
+            object_id__in=children_ids,
+            name=child_quota_name,
+        ).values_list('object_id', field.aggregation_field)
+
+        usage = 0
+        for object_id, value in child_quotas:
+            if field.aggregation_field == 'usage':
+                value = overrides.get((child_model._meta.label, object_id, child_quota_name), value)
+            usage += value
+        usages[scope.pk] = usage
+
+    changes = get_changes(model, field.name, usages, is_connected_to_scope=set(usages.keys()))
+    if not dry_run:
+        apply_changes(changes)
+    return changes
+
+
 class Command(BaseCommand):
-    """ Recalculate all quotas """
+    help = """ Recalculate all quotas.
+
+    Quotas are updated with queryset updates, so post_save signals are not sent
+    and new quotas versions are not created. Quotas samples are stored for updated quotas.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Print quotas that differ from recalculated values without modifying them.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=1,
+            help='Number of processes that recalculate counter quotas of different models in parallel.',
+        )
 
     def handle(self, *args, **options):
         # TODO: implement other quotas recalculation
         # TODO: implement global stale quotas deletion
+        self.dry_run = options['dry_run']
+        self.workers = options['workers']
+        self.changes = []
+
         self.delete_stale_quotas()
         self.init_missing_quotas()
         self.recalculate_global_quotas()
         self.recalculate_counter_quotas()
         self.recalculate_aggregator_quotas()
-        self.stdout.write('XXX: Second time to make sure that aggregators of aggregators where calculated properly.')
-        self.recalculate_aggregator_quotas()
         self.recalculate_customers_user_count()
+        self.print_changes()
 
     def delete_stale_quotas(self):
         self.stdout.write('Deleting stale quotas')
         for model in get_models_with_quotas():
-            for obj in model.objects.all():
-                quotas_names = model.QUOTAS_NAMES + [f.name for f in model.get_quotas_fields()]
-                obj.quotas.exclude(name__in=quotas_names).delete()
+            stale_quotas = models.Quota.objects.filter(
+                content_type=ContentType.objects.get_for_model(model)).exclude(name__in=model.get_quotas_names())
+            if self.dry_run:
+                for quota in stale_quotas:
+                    self.stdout.write('  Stale quota %s of %s #%s' % (quota.name, model._meta.label, quota.object_id))
+            else:
+                stale_quotas.delete()
         self.stdout.write('...done')
 
     def init_missing_quotas(self):
         self.stdout.write('Initializing missing quotas')
         for model in get_models_with_quotas():
-            for obj in model.objects.all():
-                for field in obj.get_quotas_fields():
+            content_type = ContentType.objects.get_for_model(model)
+            for field in model.get_quotas_fields():
+                existing_quotas = models.Quota.objects.filter(content_type=content_type, name=field.name)
+                scopes = model.objects.exclude(pk__in=existing_quotas.values('object_id'))
+                for scope in scopes.iterator():
+                    if not field.is_connected_to_scope(scope):
+                        continue
+                    if self.dry_run:
+                        self.stdout.write('  Missing quota %s of %s #%s' % (field.name, model._meta.label, scope.pk))
+                        continue
                     try:
-                        field.get_or_create_quota(scope=obj)
+                        field.get_or_create_quota(scope=scope)
                     except exceptions.CreationConditionFailedQuotaError:
                         pass
         self.stdout.write('...done')
@@ -47,32 +224,61 @@ class Command(BaseCommand):
             if hasattr(model, 'GLOBAL_COUNT_QUOTA_NAME'):
                 with transaction.atomic():
                     quota, _ = models.Quota.objects.get_or_create(name=model.GLOBAL_COUNT_QUOTA_NAME)
-                    quota.usage = model.objects.count()
-                    quota.save()
+                    usage = model.objects.count()
+                    if quota.usage != usage:
+                        self.changes.append(Change(quota.id, None, None, quota.name, quota.usage, usage))
+                        if not self.dry_run:
+                            quota.usage = usage
+                            quota.save()
         self.stdout.write('...done')
 
     def recalculate_counter_quotas(self):
         self.stdout.write('Recalculating counter quotas')
-        for model in get_models_with_quotas():
-            for counter_field in model.get_quotas_fields(field_class=fields.CounterQuotaField):
-                for instance in model.objects.all():
-                    counter_field.recalculate(scope=instance)
+        arguments = [(model._meta.label, self.dry_run) for model in get_models_with_quotas()
+                     if model.get_quotas_fields(field_class=fields.CounterQuotaField)]
+        if self.workers > 1:
+            # Forked processes should not share database connections with parent.
+            connections.close_all()
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                results = pool.map(_recalculate_counter_quotas_worker, arguments)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [recalculate_counter_quotas(*args) for args in arguments]
+        for changes in results:
+            self.changes += changes
         self.stdout.write('...done')
 
     def recalculate_aggregator_quotas(self):
-        # TODO: recalculate child quotas first
         self.stdout.write('Recalculating aggregator quotas')
-        for model in get_models_with_quotas():
-            for aggregator_field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
-                for instance in model.objects.all():
-                    aggregator_field.recalculate(scope=instance)
+        for model, field in get_aggregators_in_order():
+            overrides = {(c.model, c.object_id, c.name): c.new_usage for c in self.changes}
+            self.changes += recalculate_aggregator_quotas(model, field, overrides, dry_run=self.dry_run)
         self.stdout.write('...done')
 
     # XXX: With current permissions structure it easier to handle customer quota separately.
     def recalculate_customers_user_count(self):
         self.stdout.write('Recalculating customers user count')
         from nodeconductor.structure.models import Customer
-        for customer in Customer.objects.all():
-            usage = len(set(customer.get_users()))
-            customer.set_quota_usage(Customer.Quotas.nc_user_count, usage)
+        usages = {customer.pk: len(set(customer.get_users())) for customer in Customer.objects.all()}
+        changes = get_changes(Customer, Customer.Quotas.nc_user_count.name, usages)
+        if not self.dry_run:
+            apply_changes(changes)
+        self.changes += changes
         self.stdout.write('...done')
+
+    def print_changes(self):
+        if not self.dry_run:
+            self.stdout.write('%s quotas were updated.' % len(self.changes))
+            return
+
+        if not self.changes:
+            self.stdout.write('All quotas are up to date.')
+            return
+
+        self.stdout.write('%s quotas differ from recalculated values:' % len(self.changes))
+        for change in self.changes:
+            scope = '%s #%s' % (change.model, change.object_id) if change.model else 'global'
+            self.stdout.write('  %s %s: %s -> %s' % (scope, change.name, change.old_usage, change.new_usage))
@@ -1,10 +1,50 @@
 from django.contrib.contenttypes import models as ct_models
 from django.db import models
-from django.db.models import Q
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
 
 from nodeconductor.core.managers import GenericKeyMixin
 
 
+def get_sum_annotations(prefix=''):
+    """ Conditional aggregations that sum usages and limits of quotas.
+
+        Unlimited quotas are not added to sum of limits, they are counted separately.
+        Prefix allows to aggregate quotas of related scopes, for example "quotas__".
+    """
+    limit = prefix + 'limit'
+    return {
+        'usage_sum': Sum(prefix + 'usage'),
+        'limit_sum': Sum(Case(When(**{limit: -1, 'then': Value(0)}), default=F(limit),
+                              output_field=models.FloatField())),
+        'unlimited_count': Sum(Case(When(**{limit: -1, 'then': Value(1)}), default=Value(0),
+                                    output_field=models.IntegerField())),
+    }
+
+
+def sum_quotas(queryset, fields=('usage', 'limit')):
+    """ Sum usages and limits of quotas from queryset grouped by quota name with one query.
+
+        Sum of limits is -1 (unlimited) if any of summed quotas is unlimited.
+        Queryset model should have "name", "usage" and "limit" fields.
+
+        Result format:
+        {
+            'quota_name1': 'sum of limits for quotas with such quota_name1',
+            'quota_name1_usage': 'sum of usages for quotas with such quota_name1',
+            ...
+        }
+    """
+    rows = queryset.values('name').annotate(**get_sum_annotations()).order_by()
+
+    result = {}
+    for row in rows:
+        if 'usage' in fields:
+            result[row['name'] + '_usage'] = row['usage_sum']
+        if 'limit' in fields:
+            result[row['name']] = -1 if row['unlimited_count'] else row['limit_sum']
+    return result
+
+
 class QuotaManager(GenericKeyMixin, models.Manager):
 
     def filtered_for_user(self, user, queryset=None):
@@ -27,3 +67,73 @@ class QuotaManager(GenericKeyMixin, models.Manager):
             query |= Q(object_id__in=user_object_ids, content_type_id=content_type_id)
 
         return queryset.filter(query)
+
+    def get_sum_of_quotas(self, scopes_querysets, quota_names=None, fields=('usage', 'limit')):
+        """ Sum quotas of all scopes from given querysets with one query.
+
+            Querysets could be of different models. If quota_names are not defined,
+            all quotas of each model are summed.
+        """
+        query = Q()
+        for scopes in scopes_querysets:
+            names = quota_names if quota_names is not None else scopes.model.get_quotas_names()
+            query |= Q(content_type=ct_models.ContentType.objects.get_for_model(scopes.model),
+                       object_id__in=scopes.values('pk'),
+                       name__in=names)
+        if not query:
+            return {}
+        return sum_quotas(self.filter(query), fields)
+
+
+class QuotaRollupManager(models.Manager):
+
+    def get_sum_of_quotas(self, scopes, quota_names=None, fields=('usage', 'limit')):
+        """ Sum rollups of scopes from queryset with one indexed query. """
+        queryset = self.filter(content_type=ct_models.ContentType.objects.get_for_model(scopes.model),
+                               object_id__in=scopes.values('pk'))
+        if quota_names is not None:
+            queryset = queryset.filter(name__in=quota_names)
+        return sum_quotas(queryset, fields)
+
+
+class QuotaSampleManager(models.Manager):
+
+    def get_timeline(self, quotas_ids, points):
+        """ Return dictionary that maps quota ID to list of (limit, usage) values at each of given points.
+
+            Value is None if there are no samples of quota before the point.
+            Samples of all quotas are fetched with one range query: samples between first and last
+            points plus the latest sample before the first point of each quota.
+        """
+        quotas_ids = list(quotas_ids)
+        if not quotas_ids or not points:
+            return {}
+        first_point, last_point = min(points), max(points)
+
+        latest_samples = (self.filter(quota=OuterRef('pk'), timestamp__lte=first_point)
+                          .order_by('-timestamp', '-pk').values('pk')[:1])
+        initial_samples = (self.model._meta.get_field('quota').related_model.objects
+                           .filter(pk__in=quotas_ids)
+                           .annotate(sample=Subquery(latest_samples))
+                           .values('sample'))
+        samples = (self.filter(quota__in=quotas_ids)
+                   .filter(Q(pk__in=initial_samples) | Q(timestamp__gt=first_point, timestamp__lte=last_point))
+                   .order_by('quota', 'timestamp', 'pk')
+                   .values_list('quota', 'timestamp', 'limit', 'usage'))
+
+        quota_samples = {quota_id: [] for quota_id in quotas_ids}
+        for quota_id, timestamp, limit, usage in samples:
+            quota_samples[quota_id].append((timestamp, (limit, usage)))
+
+        ordered_points = sorted(enumerate(points), key=lambda item: item[1])
+        timeline = {}
+        for quota_id, values in quota_samples.items():
+            result = [None] * len(points)
+            current, position = None, 0
+            for index, point in ordered_points:
+                while position < len(values) and values[position][0] <= point:
+                    current = values[position][1]
+                    position += 1
+                result[index] = current
+            timeline[quota_id] = result
+        return timeline
@@ -1,14 +1,17 @@
 from __future__ import unicode_literals
 
+import collections
 import functools
 import inspect
-from collections import defaultdict
+import logging
+import threading
+from contextlib import contextmanager
 
 from django.contrib.contenttypes import fields as ct_fields
 from django.contrib.contenttypes import models as ct_models
-from django.db import models
-from django.db.models import Sum
-from django.utils import six
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import six, timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from model_utils import FieldTracker
@@ -20,6 +23,9 @@ from nodeconductor.quotas import exceptions, managers, fields
 from nodeconductor.core.models import UuidMixin, ReversionMixin, DescendantMixin
 
 
+logger = logging.getLogger(__name__)
+
+
 @python_2_unicode_compatible
 @reversion.register(fields=['usage', 'limit'])
 class Quota(UuidMixin, AlertThresholdMixin, LoggableMixin, ReversionMixin, models.Model):
@@ -80,6 +86,230 @@ class Quota(UuidMixin, AlertThresholdMixin, LoggableMixin, ReversionMixin, model
     def is_over_threshold(self):
         return self.usage >= self.threshold
 
+    def send_usage_update_signal(self, delta, aggregate=True):
+        """ Notify post_save handlers about usage that was changed by queryset update.
+
+            Aggregator quotas, versions and other handlers rely on post_save signal,
+            so it is sent explicitly with previous usage available via tracker.
+            If aggregate is False aggregator quotas are not updated, caller has updated them already.
+        """
+        self.tracker.saved_data['usage'] = self.usage - delta
+        self._skip_aggregation = not aggregate
+        try:
+            with reversion.create_revision():
+                models.signals.post_save.send(
+                    sender=Quota, instance=self, created=False, update_fields=['usage'], raw=False,
+                    using=self._state.db)
+                self._store_version_fingerprint()
+        finally:
+            self._skip_aggregation = False
+        self.tracker.set_saved_fields()
+
+
+class _UsageBuffer(threading.local):
+    """ Usage deltas of current thread: {(content_type_id, object_id, name): [delta, fail_silently]} """
+    deltas = None
+
+    # Pending deltas of current transaction of each connection: {connection alias: _TransactionDeltas}
+    transactions = None
+
+
+_usage_buffer = _UsageBuffer()
+
+
+@contextmanager
+def coalesce_usage():
+    """ Merge usage deltas of the same quota and apply them with one update when transaction is committed.
+
+    If there is no active transaction deltas are applied on exit from the block.
+    Deltas are discarded if block raises an exception or transaction is rolled back.
+    Nested blocks are merged into outermost one.
+
+    .. code-block:: python
+        with transaction.atomic(), coalesce_usage():
+            for resource in resources:
+                resource.delete()  # counter quota of project will be updated only once
+    """
+    if _usage_buffer.deltas is not None:
+        yield
+        return
+
+    deltas = _usage_buffer.deltas = collections.OrderedDict()
+    try:
+        yield
+    finally:
+        _usage_buffer.deltas = None
+    transaction.on_commit(lambda: _apply_usage_deltas(deltas))
+
+
+class _TransactionDeltas(object):
+    """ Usage deltas that were added within one transaction of connection.
+
+        Savepoints are tracked explicitly: each delta remembers savepoints that were open
+        when it was added, and savepoint_rollback, rollback and close methods of connection
+        are wrapped until transaction ends, so deltas of rolled back savepoint or transaction
+        are discarded. On commit remaining deltas are summed and applied with one update per quota.
+    """
+    WRAPPED_METHODS = ('savepoint_rollback', 'rollback', 'close')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.deltas = []
+        self.finished = False
+        self.original_methods = {}
+        for name in self.WRAPPED_METHODS:
+            self.original_methods[name] = connection.__dict__.get(name)
+        self._wrap('savepoint_rollback', self._discard_savepoint)
+        self._wrap('rollback', lambda: self._finish())
+        self._wrap('close', lambda: self._finish())
+
+    def is_active(self):
+        return not self.finished
+
+    def add(self, key, delta):
+        sids = set(sid for sid in self.connection.savepoint_ids if sid)
+        self.deltas.append((sids, key, delta))
+        # Callback is registered for each delta, because Django drops callbacks
+        # of rolled back savepoint and deltas added later still have to be applied.
+        transaction.on_commit(self.apply, using=self.connection.alias)
+
+    def apply(self):
+        if self.finished:
+            return
+        deltas = collections.OrderedDict()
+        for _, key, delta in self._finish():
+            deltas[key] = [deltas.get(key, [0])[0] + delta, False]
+        _apply_usage_deltas(deltas)
+
+    def _wrap(self, name, callback):
+        method = getattr(self.connection, name)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                callback(*args, **kwargs)
+
+        setattr(self.connection, name, wrapper)
+
+    def _discard_savepoint(self, sid):
+        self.deltas = [(sids, key, delta) for sids, key, delta in self.deltas if sid not in sids]
+
+    def _finish(self):
+        """ Restore connection methods and return pending deltas """
+        self.finished = True
+        for name, method in self.original_methods.items():
+            if method is None:
+                self.connection.__dict__.pop(name, None)
+            else:
+                setattr(self.connection, name, method)
+        deltas, self.deltas = self.deltas, []
+        return deltas
+
+
+def add_usage_on_commit(scope, quota_name, delta):
+    """ Add delta to quota usage when current transaction is committed.
+
+        Deltas of the same quota are summed and applied with one atomic update.
+        Deltas are discarded if transaction or savepoint where they were added is rolled back.
+        Delta is applied immediately if there is no active transaction.
+    """
+    content_type = ct_models.ContentType.objects.get_for_model(scope)
+    key = (content_type.id, scope.pk, six.text_type(quota_name))
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return _apply_usage_deltas({key: [delta, False]})
+
+    if _usage_buffer.transactions is None:
+        _usage_buffer.transactions = {}
+    transaction_deltas = _usage_buffer.transactions.get(connection.alias)
+    if transaction_deltas is None or not transaction_deltas.is_active():
+        transaction_deltas = _usage_buffer.transactions[connection.alias] = _TransactionDeltas(connection)
+    transaction_deltas.add(key, delta)
+
+
+def _apply_usage_deltas(deltas):
+    # versions of all updated quotas are stored in one revision
+    with reversion.create_revision():
+        for (content_type_id, object_id, name), (delta, fail_silently) in deltas.items():
+            quotas = Quota.objects.filter(content_type_id=content_type_id, object_id=object_id, name=name)
+            try:
+                _add_usage(quotas, delta)
+            except Quota.DoesNotExist:
+                if not fail_silently:
+                    logger.warning('Cannot apply usage delta %s to quota %s of object %s with content type %s. '
+                                   'Quota does not exist.', delta, name, object_id, content_type_id)
+
+
+def _add_usage(quotas, delta, validate=False, aggregate=True):
+    """ Atomically increase usage of quota from queryset by delta.
+
+        Return None if usage was updated and quota itself if update
+        was rejected because quota will be exceeded.
+    """
+    if not delta:
+        quotas.get()
+        return
+    queryset = quotas
+    if validate:
+        queryset = queryset.filter(Q(limit=-1) | Q(limit__gte=F('usage') + delta))
+    with transaction.atomic():
+        updated = queryset.update(usage=F('usage') + delta)
+        quota = quotas.get()
+        if not updated:
+            return quota
+        quota.send_usage_update_signal(delta, aggregate=aggregate)
+
+
+@python_2_unicode_compatible
+class QuotaRollup(models.Model):
+    """ Precomputed sum of quotas of scope descendants, for example sum of
+        service project links quotas of project.
+
+        Rollups are refreshed periodically, so they could be slightly outdated.
+        Limit is -1 if any of summed quotas is unlimited.
+    """
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'name'),)
+
+    content_type = models.ForeignKey(ct_models.ContentType)
+    object_id = models.PositiveIntegerField()
+    scope = ct_fields.GenericForeignKey('content_type', 'object_id')
+    name = models.CharField(max_length=150)
+    limit = models.FloatField(default=-1)
+    usage = models.FloatField(default=0)
+
+    objects = managers.QuotaRollupManager()
+
+    def __str__(self):
+        return '%s quota rollup for %s' % (self.name, self.scope)
+
+
+class QuotaSample(models.Model):
+    """ Append-only history of quota limit and usage.
+
+        Sample is stored whenever quota is created or its limit or usage is changed,
+        so value of quota at any moment is equal to the latest sample before it.
+    """
+    class Meta:
+        index_together = (('quota', 'timestamp'),)
+
+    quota = models.ForeignKey(Quota, related_name='samples')
+    timestamp = models.DateTimeField(default=timezone.now)
+    limit = models.FloatField()
+    usage = models.FloatField()
+
+    objects = managers.QuotaSampleManager()
+
+    @classmethod
+    def create_samples(cls, quotas_ids, timestamp=None):
+        """ Store current values of quotas with one query. Use it after queryset updates of quotas. """
+        timestamp = timestamp or timezone.now()
+        values = Quota.objects.filter(pk__in=quotas_ids).values_list('pk', 'limit', 'usage')
+        cls.objects.bulk_create([cls(quota_id=quota_id, timestamp=timestamp, limit=limit, usage=usage)
+                                 for quota_id, limit, usage in values])
+
 
 def _fail_silently(method):
 
@@ -125,12 +355,15 @@ class QuotaModelMixin(models.Model):
     Use such methods to change objects quotas:
       set_quota_limit, set_quota_usage, add_quota_usage.
 
-    Helper methods validate_quota_change and get_sum_of_quotas_as_dict provide common operations with objects quotas.
+    Helper methods validate_quota_change, validate_and_reserve and get_sum_of_quotas_as_dict provide
+    common operations with objects quotas.
     Check methods docstrings for more details.
     """
     QUOTAS_NAMES = []  # this list has to be overridden. Deprecated use class Quotas instead
 
     class Quotas(six.with_metaclass(fields.FieldsContainerMeta)):
+        # Quota fields are cached until new field is added with add_quota_field.
+        # Disable caching if Quotas class is modified in other way.
         enable_fields_caching = True
         # register model quota fields here
 
@@ -141,6 +374,7 @@ class QuotaModelMixin(models.Model):
 
     @_fail_silently
     def set_quota_limit(self, quota_name, limit, fail_silently=False):
+        self._reset_quotas_map()
         quota = self.quotas.get(name=quota_name)
         if quota.limit != limit:
             quota.limit = limit
@@ -148,6 +382,7 @@ class QuotaModelMixin(models.Model):
 
     @_fail_silently
     def set_quota_usage(self, quota_name, usage, fail_silently=False):
+        self._reset_quotas_map()
         quota = self.quotas.get(name=quota_name)
         if quota.usage != usage:
             quota.usage = usage
@@ -155,13 +390,49 @@ class QuotaModelMixin(models.Model):
 
     @_fail_silently
     def add_quota_usage(self, quota_name, usage_delta, fail_silently=False, validate=False):
-        quota = self.quotas.get(name=quota_name)
-        if validate and quota.is_exceeded(usage_delta):
-            raise exceptions.QuotaValidationError(
-                _('%(quota)s "%(name)s" quota is over limit. Required: %(usage)s, limit: %(limit)s.') % dict(
-                    quota=self, name=quota_name, usage=quota.usage + usage_delta, limit=quota.limit))
-        quota.usage += usage_delta
-        quota.save(update_fields=['usage'])
+        """ Increase quota usage with atomic update, or postpone it if called within coalesce_usage block """
+        self._reset_quotas_map()
+        if _usage_buffer.deltas is not None:
+            return self._buffer_quota_usage(quota_name, usage_delta, fail_silently, validate)
+
+        exceeded_quota = _add_usage(self.quotas.filter(name=quota_name), usage_delta, validate=validate)
+        if exceeded_quota is not None:
+            self._raise_quota_validation_error(exceeded_quota, usage_delta)
+
+    def _buffer_quota_usage(self, quota_name, usage_delta, fail_silently, validate):
+        content_type = ct_models.ContentType.objects.get_for_model(self)
+        key = (content_type.id, self.pk, six.text_type(quota_name))
+        pending_delta, pending_fail_silently = _usage_buffer.deltas.get(key, (0, True))
+        if validate:
+            quota = self.quotas.get(name=quota_name)
+            if quota.is_exceeded(pending_delta + usage_delta):
+                self._raise_quota_validation_error(quota, pending_delta + usage_delta)
+        _usage_buffer.deltas[key] = [pending_delta + usage_delta, pending_fail_silently and fail_silently]
+
+    def _raise_quota_validation_error(self, quota, usage_delta):
+        raise exceptions.QuotaValidationError(
+            _('%(quota)s "%(name)s" quota is over limit. Required: %(usage)s, limit: %(limit)s.') % dict(
+                quota=self, name=quota.name, usage=quota.usage + usage_delta, limit=quota.limit))
+
+    def get_quotas_map(self):
+        """ Return dictionary that maps quota name to quota.
+
+            Prefetched quotas are used if they are available, otherwise all quotas are fetched with one query.
+            Map is built once per instance and is reset when quotas are changed with mixin methods.
+        """
+        quotas_map = getattr(self, '_quotas_map', None)
+        if quotas_map is None:
+            quotas = getattr(self, '_prefetched_objects_cache', {}).get('quotas')
+            if quotas is None:
+                quotas = self.quotas.all() if self.pk is not None else []
+            quotas_map = {quota.name: quota for quota in quotas}
+            if self.pk is not None:
+                self._quotas_map = quotas_map
+        return quotas_map
+
+    def _reset_quotas_map(self):
+        self._quotas_map = None
+        getattr(self, '_prefetched_objects_cache', {}).pop('quotas', None)
 
     def get_quota_ancestors(self):
         if isinstance(self, DescendantMixin):
@@ -183,18 +454,84 @@ class QuotaModelMixin(models.Model):
             ['ram quota limit: 1024, requires: 2048(instance#1)', ...]
 
         """
+        quotas = {quota.name: quota for quota in self.quotas.filter(name__in=quota_deltas.keys())}
         errors = []
         for name, delta in quota_deltas.iteritems():
-            quota = self.quotas.get(name=name)
-            if quota.is_exceeded(delta):
-                errors.append('%s quota limit: %s, requires %s (%s)\n' % (
-                    quota.name, quota.limit, quota.usage + delta, quota.scope))
+            if name not in quotas:
+                raise Quota.DoesNotExist('Quota %s of %s does not exist.' % (name, self))
+            errors += self._get_quota_errors(quotas[name], delta)
         if not raise_exception:
             return errors
         else:
             if errors:
                 raise exceptions.QuotaExceededException(_('One or more quotas were exceeded: %s') % ';'.join(errors))
 
+    def validate_and_reserve(self, quota_deltas):
+        """
+        Validate quotas of object and its ancestors and add usage deltas to them atomically.
+
+        Quotas of object and usage aggregator quotas of its ancestors that aggregate them are
+        locked and fetched with one SELECT ... FOR UPDATE query, so concurrent reservations
+        are validated sequentially. Deltas are added to all of them before locks are released.
+
+        quota_deltas - dictionary of quotas deltas, example:
+        {
+            'ram': 1024,
+            'storage': 2048,
+            ...
+        }
+        QuotaExceededException is raised if any of quotas will be exceeded.
+        """
+        content_type = ct_models.ContentType.objects.get_for_model(self)
+        deltas = {(content_type.id, self.pk, name): delta for name, delta in quota_deltas.items()}
+        ancestors_deltas = self._get_ancestors_deltas(quota_deltas)
+        query = Q()
+        for content_type_id, object_id, name in list(deltas) + list(ancestors_deltas):
+            query |= Q(content_type_id=content_type_id, object_id=object_id, name=name)
+
+        with transaction.atomic():
+            quotas = list(Quota.objects.select_for_update().filter(query).order_by('pk'))
+            quotas = {(quota.content_type_id, quota.object_id, quota.name): quota for quota in quotas}
+            for key in deltas:
+                if key not in quotas:
+                    raise Quota.DoesNotExist('Quota %s of %s does not exist.' % (key[2], self))
+            # ancestors aggregator quotas that do not exist are skipped like in handle_aggregated_quotas
+            deltas.update({key: delta for key, delta in ancestors_deltas.items() if key in quotas})
+            errors = []
+            for key, delta in deltas.items():
+                errors += self._get_quota_errors(quotas[key], delta)
+            if errors:
+                raise exceptions.QuotaExceededException(_('One or more quotas were exceeded: %s') % ';'.join(errors))
+
+            self._reset_quotas_map()
+            for key, delta in deltas.items():
+                _add_usage(Quota.objects.filter(pk=quotas[key].pk), delta, aggregate=False)
+
+    def _get_ancestors_deltas(self, quota_deltas):
+        """ Return deltas of ancestors usage aggregator quotas: {(content_type_id, object_id, name): delta} """
+        from nodeconductor.quotas import utils
+
+        own_fields = {field.name: field for field in self.get_quotas_fields()}
+        ancestors = self.get_quota_ancestors()
+        deltas = collections.defaultdict(lambda: 0)
+        for name, delta in quota_deltas.items():
+            # usage aggregator quotas are not aggregated further, see handle_aggregated_quotas
+            if isinstance(own_fields.get(name), fields.UsageAggregatorQuotaField):
+                continue
+            for model, field in utils.get_aggregators(name):
+                if field.aggregation_field != 'usage':
+                    continue
+                for ancestor in ancestors:
+                    if isinstance(ancestor, model) and field.is_connected_to_scope(ancestor):
+                        content_type = ct_models.ContentType.objects.get_for_model(ancestor)
+                        deltas[(content_type.id, ancestor.pk, field.name)] += delta
+        return deltas
+
+    def _get_quota_errors(self, quota, delta):
+        if not quota.is_exceeded(delta):
+            return []
+        return ['%s quota limit: %s, requires %s (%s)\n' % (quota.name, quota.limit, quota.usage + delta, quota.scope)]
+
     def can_user_update_quotas(self, user):
         """
         Return True if user has permission to update quota
@@ -215,67 +552,38 @@ class QuotaModelMixin(models.Model):
         All `scopes` have to be instances of the same model.
         `fields` keyword argument defines sum of which fields of quotas will present in result.
         """
+        if isinstance(scopes, models.QuerySet):
+            return Quota.objects.get_sum_of_quotas([scopes], quota_names, fields)
+
         if not scopes:
             return {}
 
-        if quota_names is None:
-            quota_names = cls.get_quotas_names()
-
         scope_models = set([scope._meta.model for scope in scopes])
         if len(scope_models) > 1:
             raise exceptions.QuotaError(_('All scopes have to be instances of the same model.'))
 
-        filter_kwargs = {
-            'content_type': ct_models.ContentType.objects.get_for_model(scopes[0]),
-            'object_id__in': [scope.id for scope in scopes],
-            'name__in': quota_names
-        }
-
-        result = {}
-        if 'usage' in fields:
-            items = Quota.objects.filter(**filter_kwargs)\
-                         .values('name').annotate(usage=Sum('usage'))
-            for item in items:
-                result[item['name'] + '_usage'] = item['usage']
-
-        if 'limit' in fields:
-            unlimited_quotas = Quota.objects.filter(limit=-1, **filter_kwargs)
-            unlimited_quotas = list(unlimited_quotas.values_list('name', flat=True))
-            for quota_name in unlimited_quotas:
-                result[quota_name] = -1
-
-            items = Quota.objects\
-                         .filter(**filter_kwargs)\
-                         .exclude(name__in=unlimited_quotas)\
-                         .values('name')\
-                         .annotate(limit=Sum('limit'))
-            for item in items:
-                result[item['name']] = item['limit']
-
-        return result
+        model = scope_models.pop()
+        queryset = model.objects.filter(pk__in=[scope.pk for scope in scopes])
+        return Quota.objects.get_sum_of_quotas([queryset], quota_names, fields)
 
     @classmethod
     def get_sum_of_quotas_for_querysets(cls, querysets, quota_names=None):
-        partial_sums = [qs.model.get_sum_of_quotas_as_dict(qs, quota_names) for qs in querysets]
-        return reduce(cls._sum_dicts, partial_sums, defaultdict(lambda: 0))
+        """ Sum quotas of scopes from querysets of different models with one query.
 
-    @classmethod
-    def _sum_dicts(cls, total, partial):
-        for key, val in partial.items():
-            if val != -1:
-                total[key] += val
-        for key in partial.keys():
-            if key not in total:
-                total[key] = -1
-        return total
+            Sum of limits is -1 if any of summed quotas is unlimited.
+        """
+        return Quota.objects.get_sum_of_quotas(querysets, quota_names)
 
     @classmethod
     def get_quotas_fields(cls, field_class=None):
-        if not hasattr(cls, '_quota_fields') or not cls.Quotas.enable_fields_caching:
-            cls._quota_fields = dict(inspect.getmembers(cls.Quotas, lambda m: isinstance(m, fields.QuotaField))).values()
+        # Cache is stored in class dictionary, so models do not share cached fields with their parents.
+        version, quota_fields = cls.__dict__.get('_quota_fields', (None, None))
+        if version != fields.FieldsContainerMeta.version or not cls.Quotas.enable_fields_caching:
+            quota_fields = dict(inspect.getmembers(cls.Quotas, lambda m: isinstance(m, fields.QuotaField))).values()
+            cls._quota_fields = (fields.FieldsContainerMeta.version, quota_fields)
         if field_class is not None:
-            return [v for v in cls._quota_fields if isinstance(v, field_class)]
-        return cls._quota_fields
+            return [v for v in quota_fields if isinstance(v, field_class)]
+        return quota_fields
 
     @classmethod
     def get_quotas_names(cls):
@@ -295,8 +603,8 @@ class ExtendableQuotaModelMixin(QuotaModelMixin):
     """
 
     class Quotas(QuotaModelMixin.Quotas):
-        enable_fields_caching = False
         # register model quota fields here
+        pass
 
     class Meta:
         abstract = True
@@ -307,6 +615,8 @@ class ExtendableQuotaModelMixin(QuotaModelMixin):
         # and initialization is not executed automatically.
         quota_field.name = name
         setattr(cls.Quotas, name, quota_field)
+        # Quotas class could be inherited by other models, so cached fields of all models are invalidated.
+        fields.FieldsContainerMeta.version += 1
         from nodeconductor.quotas.apps import QuotasConfig
         # For counter quotas we need to register signals explicitly
         if isinstance(quota_field, fields.CounterQuotaField):
@@ -21,6 +21,21 @@ class TestQuotaField(TransactionTestCase):
         child.save()
         self.assertEqual(child.quotas.get(name='regular_quota').limit, 9)
 
+    def test_quota_limit_field_uses_prefetched_quotas(self):
+        test_models.GrandparentModel.objects.create(regular_quota=7)
+        scope = test_models.GrandparentModel.objects.prefetch_related('quotas').get()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(scope.regular_quota, 7)
+            self.assertEqual(scope.get_quotas_map()['quota_with_default_limit'].limit, 100)
+
+    def test_quota_limit_field_returns_new_value_after_update(self):
+        scope = test_models.GrandparentModel.objects.create(regular_quota=7)
+        self.assertEqual(scope.regular_quota, 7)
+
+        scope.regular_quota = 9
+        self.assertEqual(scope.regular_quota, 9)
+
     # XXX: Ideally this method should belong to ReversionMixin tests and
     #      should be separated into several smaller tests.
     def test_quota_versions(self):
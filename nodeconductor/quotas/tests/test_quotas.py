@@ -3,7 +3,6 @@ from datetime import timedelta
 from ddt import ddt, data
 from django.utils import timezone
 from rest_framework import test, status
-from reversion.models import Version
 
 from nodeconductor.core import utils as core_utils
 from nodeconductor.quotas.tests import factories
@@ -50,10 +49,8 @@ class QuotaHistoryTest(test.APITransactionTestCase):
 
         self.quota = factories.QuotaFactory(scope=self.customer)
         self.url = factories.QuotaFactory.get_url(self.quota, 'history')
-        # Hook for test: lets say that revision was created one hour ago
-        version = Version.objects.get_for_object(self.quota).filter(revision__date_created__lte=timezone.now()).first()
-        version.revision.date_created = timezone.now() - timedelta(hours=1)
-        version.revision.save()
+        # Hook for test: lets say that quota sample was created one hour ago
+        self.quota.samples.update(timestamp=timezone.now() - timedelta(hours=1))
 
     def test_old_version_of_quota_is_available(self):
         old_usage = self.quota.usage
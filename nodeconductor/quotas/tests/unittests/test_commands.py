@@ -1,6 +1,9 @@
 from django.core.management import call_command
+from django.utils.six import StringIO
 from django.test import TestCase
+from reversion import revisions as reversion
 
+from nodeconductor.quotas import models
 from nodeconductor.structure.tests import factories as structure_factories
 
 
@@ -23,3 +26,52 @@ class RecalculateCommandTest(TestCase):
 
         call_command('recalculatequotas')
         self.assertEqual(customer.quotas.get(name='nc_resource_count').usage, 0)
+
+    def test_resource_counter_quota_recalculation(self):
+        resource = structure_factories.TestNewInstanceFactory()
+        project = resource.service_project_link.project
+        project.quotas.filter(name='nc_resource_count').update(usage=10)
+        project.customer.quotas.filter(name='nc_resource_count').update(usage=10)
+
+        call_command('recalculatequotas')
+        self.assertEqual(project.quotas.get(name='nc_resource_count').usage, 1)
+        self.assertEqual(project.customer.quotas.get(name='nc_resource_count').usage, 1)
+
+    def test_quotas_are_not_changed_on_dry_run(self):
+        customer = structure_factories.CustomerFactory()
+        structure_factories.ProjectFactory(customer=customer)
+        customer.quotas.filter(name='nc_project_count').update(usage=10)
+
+        output = StringIO()
+        call_command('recalculatequotas', dry_run=True, stdout=output)
+
+        self.assertEqual(customer.quotas.get(name='nc_project_count').usage, 10)
+        self.assertIn('structure.Customer #%s nc_project_count: 10.0 -> 1' % customer.pk, output.getvalue())
+
+    def test_only_changed_quotas_are_updated(self):
+        customer = structure_factories.CustomerFactory()
+        structure_factories.ProjectFactory(customer=customer)
+        customer.quotas.filter(name='nc_project_count').update(usage=10)
+
+        output = StringIO()
+        call_command('recalculatequotas', stdout=output)
+
+        self.assertIn('1 quotas were updated.', output.getvalue())
+
+
+class BackfillQuotaSamplesCommandTest(TestCase):
+
+    def test_versions_older_than_samples_are_converted(self):
+        customer = structure_factories.CustomerFactory()
+        quota = customer.quotas.get(name='nc_project_count')
+        for usage in (1, 1, 2):
+            with reversion.create_revision():
+                quota.usage = usage
+                quota.save()
+        quota.samples.all().delete()
+        models.QuotaSample.objects.create(quota=quota, limit=quota.limit, usage=3)
+
+        call_command('backfillquotasamples', stdout=StringIO())
+        call_command('backfillquotasamples', stdout=StringIO())
+
+        self.assertEqual(list(quota.samples.order_by('timestamp').values_list('usage', flat=True)), [0, 1, 2, 3])
@@ -1,6 +1,10 @@
-from django.test import TestCase
+import mock
+from django.db import transaction
+from django.db.models import signals
+from django.test import TestCase, TransactionTestCase
 
-from nodeconductor.quotas import models
+from nodeconductor.quotas import handlers, models
+from nodeconductor.quotas.tests import models as test_models
 from nodeconductor.structure import models as structure_models
 from nodeconductor.structure.tests import factories as structure_factories
 
@@ -23,3 +27,61 @@ class GlobalQuotasHandlersTestCase(TestCase):
 
         reread_quota = models.Quota.objects.get(pk=quota.pk)
         self.assertEqual(reread_quota.usage, quota.usage - 1)
+
+
+class AggregatedQuotasHandlersTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.grandparent = test_models.GrandparentModel.objects.create()
+        self.parent = test_models.ParentModel.objects.create(parent=self.grandparent)
+        self.children = [test_models.ChildModel.objects.create(parent=self.parent) for _ in range(3)]
+
+    def get_usage(self, scope):
+        return scope.quotas.get(name='usage_aggregator_quota').usage
+
+    def set_children_usage(self, usage):
+        for child in self.children:
+            child.set_quota_usage('usage_aggregator_quota', usage)
+
+    def test_children_deltas_are_applied_to_aggregator_quota_once_on_commit(self):
+        with mock.patch.object(models.Quota, 'send_usage_update_signal', autospec=True) as send_signal:
+            with transaction.atomic():
+                self.set_children_usage(10)
+                self.assertEqual(self.get_usage(self.parent), 0)
+
+        self.assertEqual(self.get_usage(self.parent), 30)
+        self.assertEqual(self.get_usage(self.grandparent), 30)
+        updated_scopes = [call[0][0].scope for call in send_signal.call_args_list]
+        self.assertEqual(updated_scopes.count(self.parent), 2)  # usage_aggregator_quota and its second aggregator
+
+    def test_children_deltas_are_discarded_if_savepoint_is_rolled_back(self):
+        with transaction.atomic():
+            self.children[0].set_quota_usage('usage_aggregator_quota', 5)
+            try:
+                with transaction.atomic():
+                    self.children[1].set_quota_usage('usage_aggregator_quota', 10)
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        self.assertEqual(self.get_usage(self.parent), 5)
+
+    def test_children_deltas_of_rolled_back_transaction_are_not_applied_by_next_one(self):
+        try:
+            with transaction.atomic():
+                self.children[0].set_quota_usage('usage_aggregator_quota', 5)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with transaction.atomic():
+            self.children[1].set_quota_usage('usage_aggregator_quota', 10)
+
+        self.assertEqual(self.get_usage(self.parent), 10)
+
+    def test_scope_is_not_fetched_for_quota_without_aggregators(self):
+        quota = self.children[0].quotas.get(name='regular_quota')
+        quota = models.Quota.objects.get(pk=quota.pk)
+
+        with self.assertNumQueries(0):
+            handlers.handle_aggregated_quotas(models.Quota, quota, signal=signals.post_save, created=False)
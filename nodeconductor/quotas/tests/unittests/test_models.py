@@ -1,9 +1,15 @@
 import random
+from datetime import timedelta
 
-from django.test import TestCase
+import mock
 
-from ..models import GrandparentModel
-from ... import exceptions
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from reversion.models import Version
+
+from ..models import GrandparentModel, ParentModel, ChildModel
+from ... import exceptions, models
 
 
 class QuotaModelMixinTest(TestCase):
@@ -72,3 +78,194 @@ class QuotaModelMixinTest(TestCase):
         sum_of_quotas = GrandparentModel.get_sum_of_quotas_as_dict(
             instances, quota_names=['regular_quota'], fields=['limit'])
         self.assertEqual({'regular_quota': -1}, sum_of_quotas)
+
+
+class AddQuotaUsageTest(TransactionTestCase):
+
+    def setUp(self):
+        self.grandparent = GrandparentModel.objects.create()
+        self.parent = ParentModel.objects.create(parent=self.grandparent)
+        self.child = ChildModel.objects.create(parent=self.parent)
+
+    def get_usage(self, scope, quota_name):
+        return scope.quotas.get(name=quota_name).usage
+
+    def test_usage_is_increased_even_if_quota_instance_is_stale(self):
+        stale_quota = self.grandparent.quotas.get(name='regular_quota')
+        self.grandparent.add_quota_usage('regular_quota', 3)
+        self.grandparent.add_quota_usage('regular_quota', 4)
+
+        stale_quota.refresh_from_db()
+        self.assertEqual(stale_quota.usage, 7)
+
+    def test_usage_is_not_changed_if_validation_fails(self):
+        self.grandparent.add_quota_usage('quota_with_default_limit', 60, validate=True)
+
+        with self.assertRaises(exceptions.QuotaValidationError):
+            self.grandparent.add_quota_usage('quota_with_default_limit', 60, validate=True)
+        self.assertEqual(self.get_usage(self.grandparent, 'quota_with_default_limit'), 60)
+
+    def test_usage_change_is_propagated_to_aggregator_quotas(self):
+        self.child.add_quota_usage('usage_aggregator_quota', 5)
+
+        self.assertEqual(self.get_usage(self.parent, 'usage_aggregator_quota'), 5)
+        self.assertEqual(self.get_usage(self.grandparent, 'usage_aggregator_quota'), 5)
+
+    def test_error_is_raised_if_quota_does_not_exist(self):
+        with self.assertRaises(models.Quota.DoesNotExist):
+            self.grandparent.add_quota_usage('unknown_quota', 1)
+
+
+class ValidateAndReserveTest(TransactionTestCase):
+
+    def setUp(self):
+        self.grandparent = GrandparentModel.objects.create()
+        self.parent = ParentModel.objects.create(parent=self.grandparent)
+        self.child = ChildModel.objects.create(parent=self.parent)
+
+    def get_usage(self, scope, quota_name):
+        return scope.quotas.get(name=quota_name).usage
+
+    def test_usage_is_added_to_object_and_propagated_to_ancestors(self):
+        self.child.validate_and_reserve({'usage_aggregator_quota': 5, 'regular_quota': 2})
+
+        self.assertEqual(self.get_usage(self.child, 'usage_aggregator_quota'), 5)
+        self.assertEqual(self.get_usage(self.child, 'regular_quota'), 2)
+        self.assertEqual(self.get_usage(self.grandparent, 'usage_aggregator_quota'), 5)
+        self.assertEqual(self.get_usage(self.grandparent, 'regular_quota'), 0)
+
+    def test_usage_is_not_added_if_ancestor_quota_is_exceeded(self):
+        self.grandparent.set_quota_limit('usage_aggregator_quota', 3)
+
+        with self.assertRaises(exceptions.QuotaExceededException):
+            self.child.validate_and_reserve({'usage_aggregator_quota': 5})
+        self.assertEqual(self.get_usage(self.child, 'usage_aggregator_quota'), 0)
+
+    def test_overlapping_reservations_do_not_exceed_ancestor_limit(self):
+        self.grandparent.set_quota_limit('usage_aggregator_quota', 5)
+        other_child = ChildModel.objects.create(parent=self.parent)
+
+        with transaction.atomic():
+            self.child.validate_and_reserve({'usage_aggregator_quota': 3})
+            self.assertEqual(self.get_usage(self.grandparent, 'usage_aggregator_quota'), 3)
+            with self.assertRaises(exceptions.QuotaExceededException):
+                other_child.validate_and_reserve({'usage_aggregator_quota': 3})
+
+        self.assertEqual(self.get_usage(self.grandparent, 'usage_aggregator_quota'), 3)
+        self.assertEqual(self.get_usage(self.parent, 'usage_aggregator_quota'), 3)
+        self.assertEqual(self.get_usage(self.parent, 'second_usage_aggregator_quota'), 3)
+        self.assertEqual(self.get_usage(other_child, 'usage_aggregator_quota'), 0)
+
+    def test_error_is_raised_if_object_quota_does_not_exist(self):
+        with self.assertRaises(models.Quota.DoesNotExist):
+            self.child.validate_and_reserve({'unknown_quota': 1})
+
+
+class CoalesceUsageTest(TransactionTestCase):
+
+    def setUp(self):
+        self.grandparent = GrandparentModel.objects.create()
+        self.parent = ParentModel.objects.create(parent=self.grandparent)
+
+    def get_usage(self, scope, quota_name):
+        return scope.quotas.get(name=quota_name).usage
+
+    def test_deltas_are_applied_with_one_update_on_commit(self):
+        with mock.patch.object(models.Quota, 'send_usage_update_signal', autospec=True) as send_signal:
+            with transaction.atomic(), models.coalesce_usage():
+                for _ in range(3):
+                    ChildModel.objects.create(parent=self.parent)
+                self.assertEqual(self.get_usage(self.parent, 'counter_quota'), 0)
+
+        self.assertEqual(self.get_usage(self.parent, 'counter_quota'), 3)
+        updated_quotas = [call[0][0].name for call in send_signal.call_args_list]
+        self.assertEqual(updated_quotas.count('counter_quota'), 1)
+
+    def test_deltas_are_discarded_if_transaction_is_rolled_back(self):
+        try:
+            with transaction.atomic(), models.coalesce_usage():
+                ChildModel.objects.create(parent=self.parent)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(self.get_usage(self.parent, 'counter_quota'), 0)
+
+    def test_pending_deltas_are_validated(self):
+        with self.assertRaises(exceptions.QuotaValidationError):
+            with models.coalesce_usage():
+                self.grandparent.add_quota_usage('quota_with_default_limit', 60, validate=True)
+                self.grandparent.add_quota_usage('quota_with_default_limit', 60, validate=True)
+
+        self.assertEqual(self.get_usage(self.grandparent, 'quota_with_default_limit'), 0)
+
+    def test_deltas_of_nested_blocks_are_applied_by_outermost_block(self):
+        with models.coalesce_usage():
+            with models.coalesce_usage():
+                self.grandparent.add_quota_usage('regular_quota', 2)
+            self.assertEqual(self.get_usage(self.grandparent, 'regular_quota'), 0)
+
+        self.assertEqual(self.get_usage(self.grandparent, 'regular_quota'), 2)
+
+
+class QuotaSampleTest(TestCase):
+
+    def setUp(self):
+        self.scope = GrandparentModel.objects.create()
+        self.quota = self.scope.quotas.get(name='regular_quota')
+
+    def test_sample_is_created_if_usage_is_changed(self):
+        self.scope.set_quota_usage('regular_quota', 5)
+        self.scope.add_quota_usage('regular_quota', 2)
+
+        self.assertEqual(list(self.quota.samples.order_by('pk').values_list('usage', flat=True)), [0, 5, 7])
+
+    def test_sample_is_not_created_if_values_are_not_changed(self):
+        self.quota.save()
+
+        self.assertEqual(self.quota.samples.count(), 1)
+
+    def test_timeline_contains_latest_values_before_each_point(self):
+        now = timezone.now()
+        self.quota.samples.update(timestamp=now - timedelta(hours=3))
+        models.QuotaSample.objects.create(quota=self.quota, timestamp=now - timedelta(hours=2), limit=10, usage=1)
+        models.QuotaSample.objects.create(quota=self.quota, timestamp=now - timedelta(hours=1), limit=10, usage=2)
+        points = [now, now - timedelta(hours=4), now - timedelta(minutes=150), now - timedelta(minutes=90)]
+
+        with self.assertNumQueries(1):
+            timeline = models.QuotaSample.objects.get_timeline([self.quota.pk], points)
+
+        self.assertEqual(timeline[self.quota.pk], [(10, 2), None, (-1, 0), (10, 1)])
+
+
+class QuotaVersionsTest(TransactionTestCase):
+
+    def setUp(self):
+        self.scopes = [GrandparentModel.objects.create() for _ in range(3)]
+        self.quotas = [scope.quotas.get(name='regular_quota') for scope in self.scopes]
+
+    def get_versions(self, quota):
+        return Version.objects.get_for_object(quota)
+
+    def test_duplicate_is_detected_without_loading_versions(self):
+        quota = self.quotas[0]
+        quota.usage = 13.0
+        quota.save()
+        versions_count = self.get_versions(quota).count()
+
+        quota.usage = 13
+        with mock.patch.object(Version.objects, 'get_for_object') as get_for_object:
+            quota.save()
+            self.assertFalse(get_for_object.called)
+
+        self.assertEqual(self.get_versions(quota).count(), versions_count)
+
+    def test_changed_quotas_are_stored_in_one_revision(self):
+        self.quotas[0].usage = 1
+        self.quotas[1].usage = 2
+
+        models.Quota.save_with_revision(self.quotas)
+
+        versions = [self.get_versions(quota).latest('revision__date_created') for quota in self.quotas[:2]]
+        self.assertEqual(versions[0].revision, versions[1].revision)
+        self.assertFalse(self.get_versions(self.quotas[2]).filter(revision=versions[0].revision).exists())
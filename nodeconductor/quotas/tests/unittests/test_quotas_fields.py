@@ -3,6 +3,8 @@
 # test only models, but it is not really supported by Django.
 
 from django.test import TestCase
+
+from nodeconductor.quotas import fields as quotas_fields
 from nodeconductor.structure import models as structure_models
 from nodeconductor.structure.tests import factories as structure_factories
 
@@ -19,6 +21,19 @@ class QuotaFieldTest(TestCase):
             self.assertTrue(customer.quotas.filter(name=quota_name).exists(),
                             'Quota with name "%s" was not added to customer on creation' % quota_name)
 
+    def test_cached_quotas_fields_are_invalidated_when_field_is_added(self):
+        model = structure_models.ServiceSettings
+        model.get_quotas_fields()
+
+        model.add_quota_field(name='test_quota', quota_field=quotas_fields.QuotaField())
+        self.addCleanup(self.remove_quota_field, model, 'test_quota')
+
+        self.assertIn('test_quota', [f.name for f in model.get_quotas_fields()])
+
+    def remove_quota_field(self, model, name):
+        delattr(model.Quotas, name)
+        quotas_fields.FieldsContainerMeta.version += 1
+
 
 class CounterQuotaFieldTest(TestCase):
 
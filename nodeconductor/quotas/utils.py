@@ -1,6 +1,31 @@
+import collections
+
 from django.apps import apps
-from nodeconductor.quotas import models
+from nodeconductor.quotas import models, fields
 
 
 def get_models_with_quotas():
     return [m for m in apps.get_models() if issubclass(m, models.QuotaModelMixin)]
+
+
+_aggregators = {'version': None, 'index': {}}
+
+
+def build_aggregators_index():
+    """ Map child quota name to list of (model, aggregator field) pairs that aggregate such quotas. """
+    index = collections.defaultdict(list)
+    for model in get_models_with_quotas():
+        for field in model.get_quotas_fields(field_class=fields.AggregatorQuotaField):
+            index[field.get_child_quota_name()].append((model, field))
+    _aggregators['index'] = dict(index)
+    _aggregators['version'] = fields.FieldsContainerMeta.version
+
+
+def get_aggregators(child_quota_name):
+    """ Return list of (model, aggregator field) pairs that aggregate quotas with given name.
+
+        Index is built on application start and is rebuilt only if quota fields are added in runtime.
+    """
+    if _aggregators['version'] != fields.FieldsContainerMeta.version:
+        build_aggregators_index()
+    return _aggregators['index'].get(child_quota_name, [])
@@ -5,7 +5,6 @@ from rest_framework import exceptions as rf_exceptions, decorators, response, st
 from rest_framework import mixins
 from rest_framework import viewsets
 from reversion import revisions as reversion
-from reversion.models import Version
 
 from nodeconductor.core.pagination import UnlimitedLinkHeaderPagination
 from nodeconductor.core.serializers import HistorySerializer
@@ -137,16 +136,15 @@ class QuotaViewSet(mixins.UpdateModelMixin,
 
         quota = self.get_object()
         serializer = self.get_serializer(quota)
+        points = history_serializer.get_filter_data()
+        timeline = models.QuotaSample.objects.get_timeline([quota.pk], points).get(quota.pk, [None] * len(points))
         serialized_versions = []
-        for point_date in history_serializer.get_filter_data():
+        for point_date, value in zip(points, timeline):
             serialized = {'point': datetime_to_timestamp(point_date)}
-            version = Version.objects.get_for_object(quota).filter(revision__date_created__lte=point_date)
-            if version.exists():
-                # make copy of serialized data and update field that are stored in version
-                version_object = version.first()._object_version.object
+            if value is not None:
+                # make copy of serialized data and update fields that are stored in sample
+                limit, usage = value
                 serialized['object'] = serializer.data.copy()
-                serialized['object'].update({
-                    f: getattr(version_object, f) for f in quota.get_version_fields()
-                })
+                serialized['object'].update({'limit': limit, 'usage': usage})
             serialized_versions.append(serialized)
         return response.Response(serialized_versions, status=status.HTTP_200_OK)
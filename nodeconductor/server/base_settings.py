@@ -240,6 +240,16 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(hours=24),
         'args': (),
     },
+    'refresh-quota-rollups': {
+        'task': 'nodeconductor.structure.refresh_quota_rollups',
+        'schedule': timedelta(minutes=10),
+        'args': (),
+    },
+    'send-email-hook-digests': {
+        'task': 'nodeconductor.logging.send_email_hook_digests',
+        'schedule': timedelta(minutes=1),
+        'args': (),
+    },
 }
 
 # Logging
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import os
+import time
 
 from celery import Celery
 from celery import signals
@@ -44,6 +45,13 @@ def pass_event_context(sender=None, body=None, **kwargs):
         body['kwargs']['event_context'] = event_context
 
 
+# Publish time is used to measure how long task was waiting in queue
+@signals.before_task_publish.connect
+def add_publish_time(sender=None, headers=None, **kwargs):
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
 @signals.task_prerun.connect
 def bind_event_context(sender=None, **kwargs):
     try:
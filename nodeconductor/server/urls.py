@@ -45,6 +45,7 @@ urlpatterns += [
     url(r'^api/', include('nodeconductor.logging.urls')),
     url(r'^api/', include('nodeconductor.structure.urls')),
     url(r'^api/version/', core_views.version_detail),
+    url(r'^api/stats/timing/', core_views.timing_stats, name='stats_timing'),
     url(r'^api-auth/password/', core_views.obtain_auth_token, name='auth-password'),
     url(r'^$', TemplateView.as_view(template_name='landing/index.html')),
 ]
@@ -65,6 +65,21 @@ class StructureConfig(AppConfig):
                 dispatch_uid='nodeconductor.structure.handlers.%s' % name,
             )
 
+        for model in structure_models_with_roles:
+            structure_signals.structure_role_granted.connect(
+                handlers.invalidate_hooks_permissions_on_role_change,
+                sender=model,
+                dispatch_uid='nodeconductor.structure.handlers.invalidate_hooks_permissions_on_role_grant_%s' % (
+                    model.__name__),
+            )
+
+            structure_signals.structure_role_revoked.connect(
+                handlers.invalidate_hooks_permissions_on_role_change,
+                sender=model,
+                dispatch_uid='nodeconductor.structure.handlers.invalidate_hooks_permissions_on_role_revoke_%s' % (
+                    model.__name__),
+            )
+
         structure_signals.structure_role_granted.connect(
             handlers.log_customer_role_granted,
             sender=Customer,
@@ -117,6 +132,13 @@ class StructureConfig(AppConfig):
                     model.__name__, index),
             )
 
+            fsm_signals.post_transition.connect(
+                handlers.release_provisioning_slot,
+                sender=model,
+                dispatch_uid='nodeconductor.structure.handlers.release_provisioning_slot_{}_{}'.format(
+                    model.__name__, index),
+            )
+
             signals.post_save.connect(
                 handlers.log_resource_creation_scheduled,
                 sender=model,
@@ -8,7 +8,8 @@ from django.utils import timezone
 from nodeconductor.core import utils
 from nodeconductor.core.tasks import send_task
 from nodeconductor.core.models import StateMixin
-from nodeconductor.structure import SupportedServices, signals
+from nodeconductor.logging import routing
+from nodeconductor.structure import SupportedServices, signals, throttling
 from nodeconductor.structure.log import event_logger
 from nodeconductor.structure.models import (Customer, CustomerPermission, Project, ProjectPermission,
                                             Service, ServiceSettings)
@@ -88,6 +89,10 @@ def log_project_delete(sender, instance, **kwargs):
         })
 
 
+def invalidate_hooks_permissions_on_role_change(sender, structure, user, role, **kwargs):
+    routing.invalidate_permissions(user=user)
+
+
 def log_customer_role_granted(sender, structure, user, role, **kwargs):
     event_logger.customer_role.info(
         'User {affected_user_username} has gained role of {role_name} in customer {customer_name}.',
@@ -205,6 +210,12 @@ def log_resource_action(sender, instance, name, source, target, **kwargs):
         )
 
 
+def release_provisioning_slot(sender, instance, name, source, target, **kwargs):
+    """ Free provisioning slot of service settings when resource provisioning is completed """
+    if target in (StateMixin.States.OK, StateMixin.States.ERRED):
+        throttling.release(utils.serialize_instance(instance))
+
+
 def detect_vm_coordinates(sender, instance, name, source, target, **kwargs):
     # Check if geolocation is enabled
     if not settings.NODECONDUCTOR.get('ENABLE_GEOIP', True):
@@ -30,7 +30,7 @@ from nodeconductor.core.models import CoordinatesMixin, AbstractFieldTracker
 from nodeconductor.core.validators import validate_name, validate_cidr_list
 from nodeconductor.monitoring.models import MonitoringModelMixin
 from nodeconductor.quotas import models as quotas_models, fields as quotas_fields
-from nodeconductor.logging.loggers import LoggableMixin
+from nodeconductor.logging.loggers import LoggableMixin, invalidate_log_context
 from nodeconductor.structure.managers import StructureManager, filter_queryset_for_user, \
     ServiceSettingsManager, PrivateServiceSettingsManager, SharedServiceSettingsManager
 from nodeconductor.structure.signals import structure_role_granted, structure_role_revoked
@@ -103,6 +103,8 @@ class TagMixin(models.Model):
     def clean_tag_cache(self):
         key = self._get_tag_cache_key()
         cache.delete(key)
+        if isinstance(self, LoggableMixin):
+            invalidate_log_context(self)
 
     def _get_tag_cache_key(self):
         return 'tags:%s' % core_utils.serialize_instance(self)
@@ -332,7 +334,6 @@ class Customer(core_models.UuidMixin,
     GLOBAL_COUNT_QUOTA_NAME = 'nc_global_customer_count'
 
     class Quotas(quotas_models.QuotaModelMixin.Quotas):
-        enable_fields_caching = False
         nc_project_count = quotas_fields.CounterQuotaField(
             target_models=lambda: [Project],
             path_to_scope='customer',
@@ -489,7 +490,6 @@ class Project(core_models.DescribableMixin,
     GLOBAL_COUNT_QUOTA_NAME = 'nc_global_project_count'
 
     class Quotas(quotas_models.QuotaModelMixin.Quotas):
-        enable_fields_caching = False
         nc_resource_count = quotas_fields.CounterQuotaField(
             target_models=lambda: ResourceMixin.get_all_models(),
             path_to_scope='project',
@@ -999,12 +999,11 @@ class ResourceMixin(MonitoringModelMixin,
 
         # XXX: a hack for IaaS / PaaS / SaaS tags
         # XXX: should be moved to itacloud assembly
-        if self.tags.filter(name='IaaS').exists():
-            context['resource_delivery_model'] = 'IaaS'
-        elif self.tags.filter(name='PaaS').exists():
-            context['resource_delivery_model'] = 'PaaS'
-        elif self.tags.filter(name='SaaS').exists():
-            context['resource_delivery_model'] = 'SaaS'
+        tags = self.get_tags()
+        for delivery_model in ('IaaS', 'PaaS', 'SaaS'):
+            if delivery_model in tags:
+                context['resource_delivery_model'] = delivery_model
+                break
 
         return context
 
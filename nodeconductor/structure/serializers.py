@@ -1564,7 +1564,7 @@ class AggregateSerializer(serializers.Serializer):
         if self.data['aggregate'] == 'project':
             return queryset.all()
         else:
-            queryset = models.Project.objects.filter(customer__in=list(queryset))
+            queryset = models.Project.objects.filter(customer__in=queryset)
             return filter_queryset_for_user(queryset, user)
 
     def get_service_project_links(self, user):
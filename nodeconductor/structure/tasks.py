@@ -1,15 +1,21 @@
 from __future__ import unicode_literals
 
+import itertools
+import json
 import logging
 
 from celery import shared_task
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core import exceptions
 from django.db import transaction
 from django.db.utils import DatabaseError
 from django.utils import six
+from django.utils.encoding import force_text
 
 from nodeconductor.core import utils as core_utils, tasks as core_tasks, models as core_models
-from nodeconductor.structure import SupportedServices, models, utils, ServiceBackendError
+from nodeconductor.quotas import managers as quotas_managers, models as quotas_models
+from nodeconductor.structure import SupportedServices, models, utils, throttling, ServiceBackendError
 
 
 logger = logging.getLogger(__name__)
@@ -49,6 +55,54 @@ def check_expired_permissions():
             permission.revoke()
 
 
+@shared_task(name='nodeconductor.structure.refresh_quota_rollups')
+def refresh_quota_rollups():
+    """ Store sums of service project links quotas for each project and customer.
+
+        Rollups are used by quota statistics endpoint if QUOTA_ROLLUPS_ENABLED setting is True.
+    """
+    if not settings.NODECONDUCTOR.get('QUOTA_ROLLUPS_ENABLED', False):
+        return
+
+    projects_sums = {}
+    for model in models.ServiceProjectLink.get_all_models():
+        rows = (model.objects
+                .filter(quotas__name__in=model.get_quotas_names())
+                .values('project_id', 'quotas__name')
+                .annotate(**quotas_managers.get_sum_annotations(prefix='quotas__'))
+                .order_by())
+        for row in rows:
+            _add_rollup_sum(projects_sums, (row['project_id'], row['quotas__name']), row)
+
+    project_customers = dict(models.Project.objects.values_list('pk', 'customer_id'))
+    customers_sums = {}
+    for (project_id, name), row in projects_sums.items():
+        if project_id in project_customers:
+            _add_rollup_sum(customers_sums, (project_customers[project_id], name), row)
+
+    rollups = []
+    for model, sums in ((models.Project, projects_sums), (models.Customer, customers_sums)):
+        content_type = ContentType.objects.get_for_model(model)
+        for (object_id, name), row in sums.items():
+            rollups.append(quotas_models.QuotaRollup(
+                content_type=content_type,
+                object_id=object_id,
+                name=name,
+                usage=row['usage_sum'],
+                limit=-1 if row['unlimited_count'] else row['limit_sum'],
+            ))
+
+    with transaction.atomic():
+        quotas_models.QuotaRollup.objects.all().delete()
+        quotas_models.QuotaRollup.objects.bulk_create(rollups)
+
+
+def _add_rollup_sum(sums, key, row):
+    total = sums.setdefault(key, {'usage_sum': 0, 'limit_sum': 0, 'unlimited_count': 0})
+    for field in total:
+        total[field] += row[field] or 0
+
+
 class ConnectSharedSettingsTask(core_tasks.Task):
 
     def execute(self, service_settings):
@@ -73,24 +127,86 @@ class BackgroundPullTask(core_tasks.BackgroundTask):
     """ Pull information about object from backend. Method "pull" should be implemented.
 
         Task marks object as ERRED if pull failed and recovers it if pull succeed.
+
+        Task accepts either one serialized object or list of serialized objects
+        of the same model. In the latter case objects are fetched with one query
+        and backend shared between objects with the same backend key is passed to "pull".
     """
 
     def run(self, serialized_instance):
+        if isinstance(serialized_instance, (list, tuple)):
+            return self.pull_chunk(serialized_instance)
         instance = core_utils.deserialize_instance(serialized_instance)
+        self.pull_instance(instance)
+
+    def pull_chunk(self, serialized_instances):
+        model_names = {serialized.split(':')[0] for serialized in serialized_instances}
+        if len(model_names) > 1:
+            raise ValueError('Pulled chunk should contain objects of the same model.')
+        if not model_names:
+            return
+
+        model = core_utils.get_model_by_label(model_names.pop())
+        select_related = {}
+        if self.get_backend_key_path(model):
+            select_related[model] = [self.get_backend_key_path(model).rsplit('__', 1)[0]]
+        instances = core_utils.deserialize_instances(serialized_instances, select_related=select_related)
+
+        if len(instances) < len(serialized_instances):
+            logger.debug('%s of %s %s objects will not be pulled, because they were deleted.',
+                         len(serialized_instances) - len(instances), len(serialized_instances), model.__name__)
+
+        backends = {}
+        for instance in instances:
+            key = self.get_backend_key(instance)
+            try:
+                if key is not None and key not in backends:
+                    backends[key] = self.get_backend(instance)
+                self.pull_instance(instance, backends.get(key))
+            except Exception as e:
+                # Backend errors are handled by pull_instance, other errors are unexpected.
+                logger.exception('Failed to pull %s %s (PK: %s) in chunk. Error: %s',
+                                 model.__name__, instance, instance.pk, e)
+                raise
+
+    def pull_instance(self, instance, backend=None):
         try:
-            self.pull(instance)
+            if backend is None:
+                self.pull(instance)
+            else:
+                self.pull(instance, backend=backend)
         except ServiceBackendError as e:
             self.on_pull_fail(instance, e)
         else:
             self.on_pull_success(instance)
 
-    def is_equal(self, other_task, serialized_instance):
-        return self.name == other_task.get('name') and serialized_instance in other_task.get('args', [])
+    def get_lock_identity(self, serialized_instance):
+        return json.dumps(serialized_instance)
+
+    def get_backend_key_path(self, model):
+        """ Path to the field that defines whether objects could share backend """
+        if hasattr(model, 'service_project_link'):
+            return 'service_project_link__service__settings'
+
+    def get_backend_key(self, instance):
+        """ Return value of backend key field of instance or None if instance could not share backend """
+        path = self.get_backend_key_path(instance.__class__)
+        if not path:
+            return None
+        key = instance
+        for field in path.split('__')[:-1]:
+            key = getattr(key, field)
+        return getattr(key, path.split('__')[-1] + '_id')
 
-    def pull(self, instance):
+    def get_backend(self, instance):
+        return instance.get_backend()
+
+    def pull(self, instance, backend=None):
         """ Pull instance from backend.
 
             This method should not handle backend exception.
+            In chunk mode backend shared by objects with the same backend key is passed,
+            otherwise use method "get_backend" to get backend of the instance.
         """
         raise NotImplementedError('Pull task should implement pull method.')
 
@@ -124,27 +240,55 @@ class BackgroundPullTask(core_tasks.BackgroundTask):
 
 
 class BackgroundListPullTask(core_tasks.BackgroundTask):
-    """ Schedules pull task for each stable object of the model. """
+    """ Schedules pull task for each stable object of the model.
+
+        If "chunk_size" is defined, objects are grouped by "group_by" field
+        (service settings by default) and pull task is scheduled for each
+        chunk of serialized objects instead of each object.
+    """
     model = NotImplemented
     pull_task = NotImplemented
+    chunk_size = None
+    group_by = 'service_project_link__service__settings'
 
-    def is_equal(self, other_task):
-        return self.name == other_task.get('name')
+    def get_lock_identity(self):
+        return ''
 
     def get_pulled_objects(self):
         States = self.model.States
         return self.model.objects.filter(state__in=[States.ERRED, States.OK]).exclude(backend_id='')
 
+    def get_chunks(self):
+        """ Yield lists of serialized objects. Chunk contains objects of the same group only. """
+        queryset = self.get_pulled_objects()
+        model_name = force_text(queryset.model._meta)
+        if self.group_by:
+            rows = queryset.order_by(self.group_by, 'pk').values_list(self.group_by, 'pk')
+        else:
+            rows = ((None, pk) for pk in queryset.order_by('pk').values_list('pk', flat=True))
+
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            chunk = []
+            for _, pk in group:
+                chunk.append('{}:{}'.format(model_name, pk))
+                if len(chunk) == self.chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
     def run(self):
-        for instance in self.get_pulled_objects():
-            serialized = core_utils.serialize_instance(instance)
-            self.pull_task().delay(serialized)
+        if not self.chunk_size:
+            serialized_instances = core_utils.serialize_instances(self.get_pulled_objects())
+        else:
+            serialized_instances = self.get_chunks()
+        self.pull_task().apply_async_many([((serialized,), {}) for serialized in serialized_instances])
 
 
 class ServiceSettingsBackgroundPullTask(BackgroundPullTask):
 
-    def pull(self, service_settings):
-        backend = service_settings.get_backend()
+    def pull(self, service_settings, backend=None):
+        backend = backend or self.get_backend(service_settings)
         backend.sync()
 
 
@@ -152,6 +296,7 @@ class ServiceSettingsListPullTask(BackgroundListPullTask):
     name = 'nodeconductor.structure.ServiceSettingsListPullTask'
     model = models.ServiceSettings
     pull_task = ServiceSettingsBackgroundPullTask
+    group_by = None
 
     def get_pulled_objects(self):
         States = self.model.States
@@ -164,34 +309,68 @@ class RetryUntilAvailableTask(core_tasks.Task):
 
     def pre_execute(self, instance):
         if not self.is_available(instance):
-            self.retry()
+            self.retry(countdown=self.get_retry_countdown(instance))
         super(RetryUntilAvailableTask, self).pre_execute(instance)
 
     def is_available(self, instance):
         return True
 
+    def get_retry_countdown(self, instance):
+        return self.default_retry_delay
+
 
 class BaseThrottleProvisionTask(RetryUntilAvailableTask):
     """
-    Before starting resource provisioning, count how many resources
-    are already in "creating" state and delay provisioning if there are too many of them.
+    Before starting resource provisioning, acquire one of provisioning slots
+    of service settings and delay provisioning if there are no free slots.
+    Slot is released when resource becomes OK or ERRED.
+
+    Number of slots is defined per service type in NODECONDUCTOR['PROVISIONING_LIMITS'] setting,
+    DEFAULT_LIMIT is used for other service types. Resources wait for free slots in FIFO order,
+    resources that are far from the head of the queue are retried less often.
+    Resources that are already being created when throttle is used first occupy slots too.
     """
     DEFAULT_LIMIT = 4
+    MAX_RETRY_DELAY = 60
+
+    def get_throttle(self, resource):
+        service_settings = resource.service_project_link.service.settings
+        return throttling.ProvisioningThrottle(service_settings.pk, self.get_limit(resource), self.is_waiting)
 
     def is_available(self, resource):
-        usage = self.get_usage(resource)
-        limit = self.get_limit(resource)
-        return usage <= limit
+        throttle = self.get_throttle(resource)
+        throttle.seed(resource._meta.label_lower, lambda: self.get_provisioned_tokens(resource))
+        return throttle.acquire(core_utils.serialize_instance(resource))
 
-    def get_usage(self, resource):
+    def is_waiting(self, token):
+        """ Resource waits for slot until its provisioning is completed or it is deleted """
+        try:
+            resource = core_utils.deserialize_instance(token)
+        except exceptions.ObjectDoesNotExist:
+            return False
+        return resource.state not in (core_models.StateMixin.States.OK, core_models.StateMixin.States.ERRED)
+
+    def get_provisioned_tokens(self, resource):
+        """ Return tokens of resources that had been provisioned before throttle was used """
         service_settings = resource.service_project_link.service.settings
-        model_class = resource._meta.model
-        return model_class.objects.filter(
+        resources = resource._meta.model.objects.filter(
             state=core_models.StateMixin.States.CREATING,
-            service_project_link__service__settings=service_settings).count()
+            service_project_link__service__settings=service_settings,
+        ).exclude(pk=resource.pk)
+        return [core_utils.serialize_instance(provisioned) for provisioned in resources]
+
+    def get_usage(self, resource):
+        return self.get_throttle(resource).get_usage()
 
     def get_limit(self, resource):
-        return self.DEFAULT_LIMIT
+        service_type = resource.service_project_link.service.settings.type
+        limits = settings.NODECONDUCTOR.get('PROVISIONING_LIMITS', {})
+        return limits.get(service_type, self.DEFAULT_LIMIT)
+
+    def get_retry_countdown(self, resource):
+        throttle = self.get_throttle(resource)
+        position = throttle.get_position(core_utils.serialize_instance(resource))
+        return min(self.default_retry_delay * (1 + position // max(throttle.limit, 1)), self.MAX_RETRY_DELAY)
 
 
 class ThrottleProvisionTask(BaseThrottleProvisionTask, core_tasks.BackendMethodTask):
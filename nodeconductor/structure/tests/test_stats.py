@@ -2,12 +2,14 @@ from __future__ import unicode_literals
 
 from datetime import timedelta
 
+from django.conf import settings
+from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework import test, status
 
 from nodeconductor.core import utils as core_utils
-from nodeconductor.structure import models
+from nodeconductor.structure import models, tasks
 from nodeconductor.structure.tests import factories
 
 
@@ -155,3 +157,40 @@ class StatsQuotaTest(BaseQuotaAggregationTest):
             'uuid': self.project.uuid.hex
         })
         return response
+
+
+@override_settings(NODECONDUCTOR=dict(settings.NODECONDUCTOR, QUOTA_ROLLUPS_ENABLED=True))
+class StatsQuotaRollupsTest(BaseQuotaAggregationTest):
+
+    def test_negative_limit(self):
+        self.create_links(limit1=-1, usage1=10, limit2=2, usage2=1)
+        tasks.refresh_quota_rollups()
+
+        response = self.get_response('project', self.project)
+
+        self.assertEqual(-1, response.data['vcpu'])
+        self.assertEqual(11, response.data['vcpu_usage'])
+
+    def test_positive_limit_of_customer(self):
+        self.create_links(limit1=10, usage1=2, limit2=100, usage2=10)
+        tasks.refresh_quota_rollups()
+
+        response = self.get_response('customer', self.project.customer)
+
+        self.assertEqual(110, response.data['vcpu'])
+        self.assertEqual(12, response.data['vcpu_usage'])
+
+    def test_rollups_are_not_updated_until_refresh(self):
+        self.create_links(limit1=10, usage1=2, limit2=100, usage2=10)
+        tasks.refresh_quota_rollups()
+        link = factories.TestServiceProjectLinkFactory._meta.model.objects.filter(project=self.project).first()
+        link.set_quota_usage('vcpu', 50)
+
+        response = self.get_response('project', self.project)
+        self.assertEqual(12, response.data['vcpu_usage'])
+
+    def get_response(self, aggregate, scope):
+        return self.client.get(reverse('stats_quota'), data={
+            'aggregate': aggregate,
+            'uuid': scope.uuid.hex,
+        })
@@ -1,9 +1,11 @@
 from ddt import ddt, data
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
-from mock import patch, Mock
+from mock import patch
 
 from nodeconductor.core import utils
-from nodeconductor.structure import tasks
+from nodeconductor.structure import tasks, ServiceBackendError
 from nodeconductor.structure.tests import factories, models
 
 
@@ -41,24 +43,163 @@ class TestDetectVMCoordinatesTask(TestCase):
 @ddt
 class ThrottleProvisionTaskTest(TestCase):
 
+    def setUp(self):
+        cache.clear()
+        self.link = factories.TestServiceProjectLinkFactory()
+        self.task = tasks.ThrottleProvisionTask()
+
+    def create_instances(self, size, state=models.TestNewInstance.States.CREATING):
+        return factories.TestNewInstanceFactory.create_batch(
+            size=size, state=state, service_project_link=self.link)
+
     @data(
-        dict(size=tasks.ThrottleProvisionTask.DEFAULT_LIMIT + 1, retried=True),
+        dict(size=tasks.ThrottleProvisionTask.DEFAULT_LIMIT, retried=True),
         dict(size=tasks.ThrottleProvisionTask.DEFAULT_LIMIT - 1, retried=False),
     )
     def test_if_limit_is_reached_provisioning_is_delayed(self, params):
-        link = factories.TestServiceProjectLinkFactory()
-        factories.TestNewInstanceFactory.create_batch(
-            size=params['size'],
-            state=models.TestNewInstance.States.CREATING,
-            service_project_link=link)
+        for instance in self.create_instances(params['size']):
+            self.task.is_available(instance)
         vm = factories.TestNewInstanceFactory(
             state=models.TestNewInstance.States.CREATION_SCHEDULED,
-            service_project_link=link)
+            service_project_link=self.link)
         serialized_vm = utils.serialize_instance(vm)
-        mocked_retry = Mock()
-        tasks.ThrottleProvisionTask.retry = mocked_retry
-        tasks.ThrottleProvisionTask().si(
-            serialized_vm,
-            'create',
-            state_transition='begin_starting').apply()
+        with patch.object(tasks.ThrottleProvisionTask, 'retry') as mocked_retry:
+            tasks.ThrottleProvisionTask().si(
+                serialized_vm,
+                'create',
+                state_transition='begin_starting').apply()
         self.assertEqual(mocked_retry.called, params['retried'])
+
+    def test_slot_is_released_when_provisioning_is_completed(self):
+        instances = self.create_instances(tasks.ThrottleProvisionTask.DEFAULT_LIMIT)
+        for instance in instances:
+            self.task.is_available(instance)
+        vm = self.create_instances(1, state=models.TestNewInstance.States.CREATION_SCHEDULED)[0]
+        self.assertFalse(self.task.is_available(vm))
+
+        instances[0].set_ok()
+        instances[0].save()
+
+        self.assertTrue(self.task.is_available(vm))
+
+    def test_waiting_resources_acquire_slots_in_fifo_order(self):
+        instances = self.create_instances(tasks.ThrottleProvisionTask.DEFAULT_LIMIT)
+        for instance in instances:
+            self.task.is_available(instance)
+        first, second = self.create_instances(2, state=models.TestNewInstance.States.CREATION_SCHEDULED)
+        self.assertFalse(self.task.is_available(first))
+        self.assertFalse(self.task.is_available(second))
+
+        instances[0].set_erred()
+        instances[0].save()
+
+        self.assertFalse(self.task.is_available(second))
+        self.assertTrue(self.task.is_available(first))
+
+    def test_resources_that_are_already_being_created_occupy_slots(self):
+        self.create_instances(tasks.ThrottleProvisionTask.DEFAULT_LIMIT)
+        vm = self.create_instances(1, state=models.TestNewInstance.States.CREATION_SCHEDULED)[0]
+
+        self.assertFalse(self.task.is_available(vm))
+
+    def test_erred_waiting_resource_does_not_hold_the_queue(self):
+        instances = self.create_instances(tasks.ThrottleProvisionTask.DEFAULT_LIMIT)
+        for instance in instances:
+            self.task.is_available(instance)
+        first, second = self.create_instances(2, state=models.TestNewInstance.States.CREATION_SCHEDULED)
+        self.assertFalse(self.task.is_available(first))
+        self.assertFalse(self.task.is_available(second))
+
+        first.set_erred()
+        first.save()
+        instances[0].set_ok()
+        instances[0].save()
+
+        self.assertTrue(self.task.is_available(second))
+
+    def test_state_of_waiting_resource_is_not_fetched_on_each_retry(self):
+        instances = self.create_instances(tasks.ThrottleProvisionTask.DEFAULT_LIMIT)
+        for instance in instances:
+            self.task.is_available(instance)
+        first, second = self.create_instances(2, state=models.TestNewInstance.States.CREATION_SCHEDULED)
+        self.task.is_available(first)
+
+        with patch.object(tasks.ThrottleProvisionTask, 'is_waiting') as is_waiting:
+            self.task.is_available(second)
+            self.task.is_available(second)
+
+        self.assertFalse(is_waiting.called)
+
+    def test_limit_is_defined_per_service_type(self):
+        nodeconductor_settings = settings.NODECONDUCTOR.copy()
+        nodeconductor_settings['PROVISIONING_LIMITS'] = {self.link.service.settings.type: 1}
+        first, second = self.create_instances(2, state=models.TestNewInstance.States.CREATION_SCHEDULED)
+
+        with self.settings(NODECONDUCTOR=nodeconductor_settings):
+            self.assertTrue(self.task.is_available(first))
+            self.assertFalse(self.task.is_available(second))
+
+
+class TestPullTask(tasks.BackgroundPullTask):
+    name = 'nodeconductor.structure.tests.TestPullTask'
+
+    def pull(self, instance, backend=None):
+        backend = backend or self.get_backend(instance)
+        if instance.name == 'broken':
+            raise ServiceBackendError('Instance is not available.')
+        if instance.name == 'invalid':
+            raise ValueError('Instance is not valid.')
+
+
+class TestListPullTask(tasks.BackgroundListPullTask):
+    name = 'nodeconductor.structure.tests.TestListPullTask'
+    model = models.TestNewInstance
+    pull_task = TestPullTask
+    chunk_size = 2
+
+
+@patch('nodeconductor.structure.tests.models.TestNewInstance.get_backend')
+class BackgroundPullTaskChunkTest(TestCase):
+
+    def setUp(self):
+        self.link = factories.TestServiceProjectLinkFactory()
+        self.instances = factories.TestNewInstanceFactory.create_batch(
+            size=3, service_project_link=self.link, state=models.TestNewInstance.States.OK, backend_id='id')
+
+    def test_instances_of_chunk_are_pulled_with_shared_backend(self, mocked_get_backend):
+        broken = self.instances[0]
+        broken.name = 'broken'
+        broken.save()
+
+        TestPullTask().run([utils.serialize_instance(instance) for instance in self.instances])
+
+        self.assertEqual(mocked_get_backend.call_count, 1)
+        broken.refresh_from_db()
+        self.assertEqual(broken.state, models.TestNewInstance.States.ERRED)
+        self.instances[1].refresh_from_db()
+        self.assertEqual(self.instances[1].state, models.TestNewInstance.States.OK)
+
+    def test_backends_of_chunk_are_not_reused_by_next_run(self, mocked_get_backend):
+        task = TestPullTask()
+        task.run([utils.serialize_instance(instance) for instance in self.instances])
+
+        task.run(utils.serialize_instance(self.instances[0]))
+
+        self.assertEqual(mocked_get_backend.call_count, 2)
+
+    def test_unexpected_error_is_raised(self, mocked_get_backend):
+        invalid = self.instances[0]
+        invalid.name = 'invalid'
+        invalid.save()
+
+        with self.assertRaises(ValueError):
+            TestPullTask().run([utils.serialize_instance(instance) for instance in self.instances])
+
+    def test_chunks_contain_instances_of_the_same_settings(self, mocked_get_backend):
+        other_instance = factories.TestNewInstanceFactory(state=models.TestNewInstance.States.OK, backend_id='id')
+
+        chunks = list(TestListPullTask().get_chunks())
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(sorted(len(chunk) for chunk in chunks), [1, 1, 2])
+        self.assertIn([utils.serialize_instance(other_instance)], chunks)
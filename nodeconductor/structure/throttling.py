@@ -0,0 +1,155 @@
+""" Limit number of resources that are provisioned concurrently within the same service settings.
+
+    Each provisioned resource holds one of "limit" slots of its service settings.
+    Slot is stored as cache key, so it is acquired atomically using "add" operation
+    and is released when resource leaves provisioning states or when SLOT_TIMEOUT expires.
+
+    Resources get tickets in order of arrival. Resource is allowed to acquire slot
+    only if there are enough free slots for all resources that arrived before it,
+    so waiting resources are provisioned in FIFO order. Head of the queue is moved
+    past tickets that have acquired slots and tickets of resources that are not
+    waiting anymore or have not acquired slot during STALE_TICKET_TIMEOUT.
+    Head and tail are counters changed with atomic "incr" operation.
+"""
+from __future__ import unicode_literals
+
+import time
+
+from django.core.cache import cache
+
+
+SLOT_TIMEOUT = 60 * 60
+STALE_TICKET_TIMEOUT = 5 * 60
+WAITING_CHECK_INTERVAL = 60
+OWNER_KEY = 'provisioning_throttle:owner:%s'
+GONE_KEY = 'provisioning_throttle:gone:%s'
+
+
+class ProvisioningThrottle(object):
+    """ Slots and waiting queue of service settings.
+
+        If is_waiting callback is given, it is called with token of the head of the queue
+        to check whether its resource is still waiting, otherwise the head is skipped.
+    """
+
+    def __init__(self, scope_id, limit, is_waiting=None):
+        self.scope_id = scope_id
+        self.limit = limit
+        self.is_waiting = is_waiting
+
+    def _get_key(self, *parts):
+        return 'provisioning_throttle:%s:%s' % (self.scope_id, ':'.join(str(part) for part in parts))
+
+    def get_slots(self):
+        """ Return dictionary that maps slot index to the token that holds it """
+        keys = {self._get_key('slot', index): index for index in range(self.limit)}
+        return {keys[key]: token for key, token in cache.get_many(keys.keys()).items()}
+
+    def get_usage(self):
+        return len(self.get_slots())
+
+    def seed(self, name, get_tokens):
+        """ Occupy slots with tokens of resources that had been provisioned before throttle was used.
+
+            It is done once per name, get_tokens is called only if it is not done yet.
+        """
+        if not cache.add(self._get_key('seeded', name), True, None):
+            return
+        slots = self.get_slots()
+        for token in get_tokens():
+            if token in slots.values():
+                continue
+            index = self._occupy(token, slots)
+            if index is None:
+                break
+            slots[index] = token
+
+    def get_ticket(self, token):
+        """ Return position of token in waiting queue, issue new ticket on first call """
+        key = self._get_key('ticket', token)
+        ticket = cache.get(key)
+        if ticket is None:
+            cache.add(self._get_key('head'), 1, None)
+            cache.add(self._get_key('tail'), 0, None)
+            ticket = cache.incr(self._get_key('tail'))
+            cache.delete(GONE_KEY % token)
+        # Ticket is refreshed on each poll, so resource keeps its place however long the queue is.
+        cache.set_many({key: ticket, self._get_key('owner', ticket): token}, SLOT_TIMEOUT)
+        return ticket
+
+    def get_head(self):
+        """ Return lowest ticket that has not acquired slot yet, skip tickets of gone owners """
+        cache.add(self._get_key('head'), 1, None)
+        head = cache.get(self._get_key('head'))
+        tail = cache.get(self._get_key('tail')) or 0
+        while head <= tail and self._is_passed(head):
+            # Head is moved by the only process that has marked it as advanced, so it is not moved twice.
+            if not cache.add(self._get_key('advanced', head), True, SLOT_TIMEOUT):
+                break
+            head = cache.incr(self._get_key('head'))
+        return head
+
+    def _is_passed(self, ticket):
+        """ Return True if ticket has acquired slot or its owner is not waiting anymore """
+        admitted_key, owner_key = self._get_key('admitted', ticket), self._get_key('owner', ticket)
+        checked_key = self._get_key('checked', ticket)
+        values = cache.get_many([admitted_key, owner_key, checked_key])
+        if admitted_key in values or owner_key not in values:
+            return True
+        owner = values[owner_key]
+        if cache.get(GONE_KEY % owner):
+            return True
+        # State of owner is checked once per WAITING_CHECK_INTERVAL, owners that complete
+        # provisioning while waiting are marked as gone by release() immediately.
+        if self.is_waiting is not None and checked_key not in values:
+            if not self.is_waiting(owner):
+                return True
+            cache.set(checked_key, True, WAITING_CHECK_INTERVAL)
+        cache.add(self._get_key('since', ticket), time.time(), SLOT_TIMEOUT)
+        since = cache.get(self._get_key('since', ticket)) or time.time()
+        return time.time() - since > STALE_TICKET_TIMEOUT
+
+    def get_position(self, token):
+        """ Return number of resources that are waiting before token """
+        return max(self.get_ticket(token) - self.get_head(), 0)
+
+    def acquire(self, token):
+        """ Return True if slot is held by token, False if token should wait for free slot """
+        slots = self.get_slots()
+        if token in slots.values():
+            return True
+
+        ticket = self.get_ticket(token)
+        free_slots = self.limit - len(slots)
+        if ticket - self.get_head() >= free_slots:
+            return False
+
+        if self._occupy(token, slots) is None:
+            return False
+        # Admitted ticket is passed, so head of the queue is moved forward
+        cache.set(self._get_key('admitted', ticket), True, SLOT_TIMEOUT)
+        self.get_head()
+        return True
+
+    def _occupy(self, token, slots):
+        """ Acquire one of free slots for token, return its index or None if all slots are taken """
+        for index in range(self.limit):
+            if index not in slots and cache.add(self._get_key('slot', index), token, SLOT_TIMEOUT):
+                cache.set(OWNER_KEY % token, (self.scope_id, index), SLOT_TIMEOUT)
+                return index
+        return None
+
+    def release(self, token, index):
+        slot_key = self._get_key('slot', index)
+        if cache.get(slot_key) == token:
+            cache.delete(slot_key)
+        cache.delete_many([self._get_key('ticket', token), OWNER_KEY % token])
+
+
+def release(token):
+    """ Release slot held by token if any, ticket of waiting token is skipped by the queue """
+    cache.set(GONE_KEY % token, True, SLOT_TIMEOUT)
+    owner = cache.get(OWNER_KEY % token)
+    if owner is not None:
+        scope_id, index = owner
+        ProvisioningThrottle(scope_id, index + 1).release(token, index)
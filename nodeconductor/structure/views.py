@@ -7,6 +7,7 @@ from functools import partial
 
 from django.conf import settings as django_settings
 from django.contrib import auth
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
 from django.db.models import Q
 from django.http import Http404
@@ -20,7 +21,6 @@ from rest_framework import serializers as rf_serializers
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import PermissionDenied, MethodNotAllowed, NotFound, APIException, ValidationError
 from rest_framework.response import Response
-from reversion.models import Version
 
 from nodeconductor.core import managers as core_managers
 from nodeconductor.core import mixins as core_mixins
@@ -32,7 +32,7 @@ from nodeconductor.core import views as core_views
 from nodeconductor.core.utils import datetime_to_timestamp, sort_dict
 from nodeconductor.logging import models as logging_models
 from nodeconductor.logging.loggers import expand_alert_groups
-from nodeconductor.quotas.models import QuotaModelMixin, Quota
+from nodeconductor.quotas.models import QuotaModelMixin, Quota, QuotaRollup, QuotaSample
 from nodeconductor.structure import (
     SupportedServices, ServiceBackendError, ServiceBackendNotImplemented,
     filters, managers, models, permissions, serializers)
@@ -1711,6 +1711,8 @@ class AggregatedStatsView(views.APIView):
         - ?uuid=uuid_of_aggregate_model_object (not required. If this parameter will be defined -
           result will contain only object with given uuid)
         - ?quota_name - optional list of quota names, for example ram, vcpu, storage
+
+    If QUOTA_ROLLUPS_ENABLED setting is True, sums are read from periodically refreshed rollups.
     """
     def get(self, request, format=None):
         serializer = serializers.AggregateSerializer(data=request.query_params)
@@ -1719,12 +1721,24 @@ class AggregatedStatsView(views.APIView):
         quota_names = request.query_params.getlist('quota_name')
         if len(quota_names) == 0:
             quota_names = None
-        querysets = serializer.get_service_project_links(request.user)
 
-        total_sum = QuotaModelMixin.get_sum_of_quotas_for_querysets(querysets, quota_names)
+        if django_settings.NODECONDUCTOR.get('QUOTA_ROLLUPS_ENABLED', False):
+            total_sum = self.get_sum_of_rollups(serializer, request.user, quota_names)
+        else:
+            querysets = serializer.get_service_project_links(request.user)
+            total_sum = QuotaModelMixin.get_sum_of_quotas_for_querysets(querysets, quota_names)
         total_sum = sort_dict(total_sum)
         return Response(total_sum, status=status.HTTP_200_OK)
 
+    def get_sum_of_rollups(self, serializer, user, quota_names):
+        # Staff can see all projects of customer, so customer rollups could be used.
+        # Other users may see only some projects of customer, so their rollups are summed.
+        if serializer.data['aggregate'] == 'customer' and (user.is_staff or user.is_support):
+            scopes = serializer.get_aggregates(user)
+        else:
+            scopes = serializer.get_projects(user)
+        return QuotaRollup.objects.get_sum_of_quotas(scopes, quota_names)
+
 
 class QuotaTimelineStatsView(views.APIView):
     """
@@ -1758,11 +1772,9 @@ class QuotaTimelineStatsView(views.APIView):
         items = request.query_params.getlist('item') or self.get_all_spls_quotas()
 
         collector = QuotaTimelineCollector()
-        for item in items:
-            for scope in scopes:
-                values = self.get_stats_for_scope(item, scope, ranges)
-                for (end, start), (limit, usage) in zip(ranges, values):
-                    collector.add_quota(start, end, item, limit, usage)
+        for item, values in self.get_stats(items, scopes, ranges):
+            for (end, start), (limit, usage) in zip(ranges, values):
+                collector.add_quota(start, end, item, limit, usage)
 
         stats = map(sort_dict, collector.to_dict())[::-1]
         return Response(stats, status=status.HTTP_200_OK)
@@ -1786,25 +1798,29 @@ class QuotaTimelineStatsView(views.APIView):
                       for m in models.ServiceProjectLink.get_all_models()]
         return sum([spl_model.get_quotas_names() for spl_model in spl_models], [])
 
-    def get_stats_for_scope(self, quota_name, scope, dates):
-        stats_data = []
-        try:
-            quota = scope.quotas.get(name=quota_name)
-        except Quota.DoesNotExist:
-            return stats_data
-        versions = Version.objects.get_for_object(quota).select_related('revision').filter(
-            revision__date_created__lte=dates[0][0]).iterator()
-        version = None
-        for end, start in dates:
-            try:
-                while version is None or version.revision.date_created > end:
-                    version = versions.next()
-                stats_data.append((version._object_version.object.limit,
-                                   version._object_version.object.usage))
-            except StopIteration:
-                break
-
-        return stats_data
+    def get_stats(self, items, scopes, dates):
+        """ Yield quota name and its values at the end of each range for each scope.
+
+            Values of all quotas are fetched with one query, values are yielded until
+            the first range that does not have samples of quota.
+        """
+        scopes_ids = defaultdict(list)
+        for scope in scopes:
+            scopes_ids[ContentType.objects.get_for_model(scope).id].append(scope.pk)
+        query = Q()
+        for content_type_id, object_ids in scopes_ids.items():
+            query |= Q(content_type_id=content_type_id, object_id__in=object_ids)
+        if not query or not items or not dates:
+            return
+
+        quotas = list(Quota.objects.filter(query, name__in=items).values_list('id', 'name'))
+        timeline = QuotaSample.objects.get_timeline([quota_id for quota_id, _ in quotas],
+                                                    [end for end, start in dates])
+        for quota_id, name in quotas:
+            values = timeline.get(quota_id, [])
+            if None in values:
+                values = values[:values.index(None)]
+            yield name, values
 
     def get_ranges(self, request):
         mapped = {
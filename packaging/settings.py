@@ -45,7 +45,9 @@ config_defaults = {
         'log_file': '',  # empty to disable logging events to file
         'log_level': 'INFO',
         'logserver_host': 'localhost',
+        'logserver_overflow': 'drop',
         'logserver_port': 5959,
+        'logserver_spill_file': '',
         'syslog': 'false',
     },
     'logging': {
@@ -217,18 +219,21 @@ LOGGING = {
             'level': config.get('events', 'log_level').upper(),
         },
         # Send logs to log server
-        # Note that nodeconductor.logging.log.TCPEventHandler does not support exernal formatters
+        # Note that nodeconductor.logging.log.TCPEventHandler and BufferedTCPEventHandler do not support exernal formatters
         'tcp': {
             'class': 'nodeconductor.logging.log.TCPEventHandler',
             'filters': ['is-not-event'],
             'level': config.get('logging', 'log_level').upper(),
         },
+        # Events are sent from background thread, so stalled log server does not slow down requests
         'tcp-event': {
-            'class': 'nodeconductor.logging.log.TCPEventHandler',
+            'class': 'nodeconductor.logging.log.BufferedTCPEventHandler',
             'filters': ['is-event'],
             'host': config.get('events', 'logserver_host'),
             'level': config.get('events', 'log_level').upper(),
             'port': config.getint('events', 'logserver_port'),
+            'overflow': config.get('events', 'logserver_overflow'),
+            'spill_filename': config.get('events', 'logserver_spill_file') or None,
         },
 
         # Send logs to web hook